@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of shift_density and det_hist on synthetic inputs: xsf files
+with periodic grids of 32^3 to 256^3 points and a few atoms, and
+wavefunction files with 10^3 to 10^6 real or complex <ci> entries, all
+generated from a fixed seed. Each case runs in a fresh process and the
+wall time, CPU time and peak resident memory of every stage (parse,
+shift, write, plot...) are recorded in a json file; compared with a
+baseline json file from an earlier run, the stages that got slower or
+bigger than the tolerances are reported and the exit status is 1.
+Everything runs offline, with the Agg backend of matplotlib.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+import numpy
+import numpy.typing as npt
+from instrument import peak_rss, reset_peak
+
+XSF_SIZES = (32, 64, 128, 256)
+DET_SIZES = (1000, 10000, 100000, 1000000)
+QUICK_XSF_SIZES = (32, 64)
+QUICK_DET_SIZES = (1000, 10000)
+SEED = 20240901
+NORB = 16  # single particle states of the synthetic determinants
+NELEC = 4  # electrons per spin of the synthetic determinants
+BUFFER_LINES = 1 << 16  # <ci> lines written at a time
+MIN_TIME = 0.05  # seconds of slack before a stage counts as slower
+
+
+def timed(
+    stages: Dict[str, Dict[str, float]], name: str, function: Callable, *args: Any
+) -> Any:
+    """
+    Calls function(*args), recording its wall time, CPU time and peak memory
+    in stages[name]; returns what function returns.
+    """
+    reset_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+    stages[name] = {
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "peak_rss_mb": peak_rss(),
+    }
+    return result
+
+
+def make_xsf(filename: str, npoints: int, nat: int = 8, seed: int = SEED) -> None:
+    """
+    Writes an xsf file with a smooth periodic density on an npoints^3 grid
+    (closing planes included) and nat atoms in a triclinic cell.
+    """
+    from shift_density import Atoms, close_grid, write_xsf
+
+    rng = numpy.random.default_rng(seed)
+    cell = numpy.array([[8.0, 0.0, 0.0], [1.0, 9.0, 0.0], [0.5, 0.8, 10.0]])
+    frac = rng.random((nat, 3))
+    atoms = Atoms(nat, [str(rng.choice((1, 6, 8))) for _ in range(nat)], frac @ cell)
+    # a sum of gaussians centred on the atoms, in fractional coordinates
+    axis = numpy.arange(npoints - 1) / (npoints - 1)
+    density = numpy.zeros((npoints - 1,) * 3)
+    for center in frac:
+        # periodic distances along each axis, as (z, y, x) factors
+        factors = [
+            numpy.exp(-(((axis - c + 0.5) % 1.0 - 0.5) ** 2) / 0.01)
+            for c in center[::-1]
+        ]
+        density += numpy.einsum("i,j,k->ijk", *factors)
+    nind = numpy.array([npoints] * 3)
+    with contextlib.redirect_stdout(None):
+        write_xsf(filename, cell, atoms, nind, numpy.zeros(3), close_grid(density))
+
+
+def occupations(
+    rng: numpy.random.Generator, ndets: int, norb: int, nelec: int
+) -> List[str]:
+    """
+    Returns ndets random occupation strings of nelec electrons in norb
+    states, the first one being the ground state.
+    """
+    occupied = numpy.argsort(rng.random((ndets, norb)), axis=1)[:, :nelec]
+    occupied[0] = numpy.arange(nelec)
+    strings = numpy.full((ndets, norb), ord("0"), dtype=numpy.uint8)
+    numpy.put_along_axis(strings, occupied, ord("1"), axis=1)
+    return strings.view(f"S{norb}").ravel().astype(str).tolist()
+
+
+def make_wavefunction(
+    filename: str,
+    ndets: int,
+    complex_coeffs: bool = False,
+    norb: int = NORB,
+    nelec: int = NELEC,
+    seed: int = SEED,
+) -> None:
+    """
+    Writes a QMCPack wavefunction file with a detlist of ndets determinants
+    with random occupations and exponentially decaying coefficients.
+    """
+    rng = numpy.random.default_rng(seed)
+    coeffs = rng.normal(size=ndets) * numpy.exp(-numpy.arange(ndets) / (ndets / 5))
+    coeffs[0] = 0.95
+    alpha = occupations(rng, ndets, norb, nelec)
+    beta = occupations(rng, ndets, norb, nelec)
+    with open(filename, "w", encoding="utf-8") as file_out:
+        file_out.write(
+            '<?xml version="1.0"?>\n<qmcsystem>\n'
+            '  <wavefunction name="psi0" target="e">\n'
+            '    <determinantset type="einspline">\n'
+            '      <multideterminant optimize="yes" spo_up="spo-up" spo_dn="spo-dn">\n'
+            f'        <detlist size="{ndets}" type="DETS" nca="0" ncb="0"'
+            f' nea="{nelec}" neb="{nelec}" nstates="{norb}" cutoff="1e-3">\n'
+        )
+        for first in range(0, ndets, BUFFER_LINES):
+            lines = []
+            for n in range(first, min(first + BUFFER_LINES, ndets)):
+                coeff = coeffs[n]
+                if complex_coeffs:
+                    value = f'coeff_real="{coeff:.8g}" coeff_imag="{0.3 * coeff:.8g}"'
+                else:
+                    value = f'coeff="{coeff:.8g}"'
+                lines.append(
+                    f'          <ci id="CIcoeff_{n}" {value}'
+                    f' alpha="{alpha[n]}" beta="{beta[n]}"/>\n'
+                )
+            file_out.write("".join(lines))
+        file_out.write(
+            "        </detlist>\n      </multideterminant>\n"
+            "    </determinantset>\n  </wavefunction>\n</qmcsystem>\n"
+        )
+
+
+def bench_xsf(filename: str, workdir: str) -> Dict[str, Dict[str, float]]:
+    """
+    Times parsing the xsf file, shifting its grid by whole voxels and by an
+    exact sub-voxel vector, and writing it back.
+    """
+    from shift_density import get_shift, read_data, shift_grid, write_xsf
+
+    stages: Dict[str, Dict[str, float]] = {}
+    with contextlib.redirect_stdout(None):
+        cell, atoms, nind, start_coord, values = timed(
+            stages, "parse", read_data, filename
+        )
+        dr = get_shift(numpy.array([1.3, -2.1, 0.7]), nind, cell)
+        shifted = timed(stages, "shift", shift_grid, values, dr)
+        timed(stages, "shift_subvoxel", shift_grid, values, dr, True)
+        fileout = os.path.join(workdir, "shifted.xsf")
+        timed(
+            stages, "write", write_xsf, fileout, cell, atoms, nind, start_coord, shifted
+        )
+    os.remove(fileout)
+    return stages
+
+
+def bench_wavefunction(filename: str, workdir: str) -> Dict[str, Dict[str, float]]:
+    """
+    Times reading the CI coefficients of the wavefunction file and drawing
+    and saving the default histogram.
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from det_hist import histo_complex, histo_real, print_fig, read_coefficients
+
+    def plot(coeffs: npt.NDArray, cutoff: float, plot_file: str) -> None:
+        if numpy.iscomplexobj(coeffs):
+            histo_complex(coeffs, cutoff)
+        else:
+            histo_real(coeffs, cutoff)
+        print_fig(plot_file)
+        plt.close("all")
+
+    stages: Dict[str, Dict[str, float]] = {}
+    with contextlib.redirect_stdout(None):
+        coeffs, cutoff, _, _ = timed(stages, "parse", read_coefficients, filename)
+        plot_file = os.path.join(workdir, "histogram.png")
+        timed(stages, "plot", plot, coeffs, cutoff, plot_file)
+    os.remove(plot_file)
+    return stages
+
+
+def run_case(kind: str, filename: str, workdir: str) -> Dict[str, Dict[str, float]]:
+    """
+    Runs the benchmark of a case (xsf or wavefunction); meant to be called
+    in a fresh process, so that the peak memory is that of the case alone.
+    """
+    os.environ["MPLBACKEND"] = "Agg"
+    if kind == "xsf":
+        return bench_xsf(filename, workdir)
+    return bench_wavefunction(filename, workdir)
+
+
+def build_cases(
+    workdir: str, xsf_sizes: List[int], det_sizes: List[int]
+) -> List[Tuple[str, str, str]]:
+    """
+    Writes the synthetic inputs in workdir (those already there are kept)
+    and returns the name, kind and input file of each case.
+    """
+    cases = []
+    for npoints in xsf_sizes:
+        filename = os.path.join(workdir, f"grid{npoints}.xsf")
+        if not os.path.exists(filename):
+            print(f"Writing {filename}")
+            make_xsf(filename, npoints)
+        cases.append((f"xsf-{npoints}", "xsf", filename))
+    for ndets in det_sizes:
+        for flag in ("real", "complex"):
+            filename = os.path.join(workdir, f"dets{ndets}_{flag}.xml")
+            if not os.path.exists(filename):
+                print(f"Writing {filename}")
+                make_wavefunction(filename, ndets, flag == "complex")
+            cases.append((f"dets-{ndets}-{flag}", "wavefunction", filename))
+    return cases
+
+
+def run_benchmarks(
+    cases: List[Tuple[str, str, str]], workdir: str, repeat: int = 1
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """
+    Runs each case repeat times, each in a new process, keeping for every
+    stage the best wall and CPU times and the smallest peak memory.
+    """
+    context = multiprocessing.get_context("spawn")
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    with ProcessPoolExecutor(1, mp_context=context, max_tasks_per_child=1) as pool:
+        for name, kind, filename in cases:
+            best: Dict[str, Dict[str, float]] = {}
+            for _ in range(repeat):
+                stages = pool.submit(run_case, kind, filename, workdir).result()
+                for stage, values in stages.items():
+                    if stage in best:
+                        for key, value in values.items():
+                            best[stage][key] = min(best[stage][key], value)
+                    else:
+                        best[stage] = values
+            results[name] = best
+            print(
+                f"{name:22s}"
+                + "".join(
+                    f"  {stage} {values['wall']:.3f} s {values['peak_rss_mb']:.0f} MB"
+                    for stage, values in best.items()
+                )
+            )
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, Dict[str, float]]],
+    baseline: Dict[str, Dict[str, Dict[str, float]]],
+    time_tolerance: float = 0.25,
+    memory_tolerance: float = 0.25,
+    min_time: float = MIN_TIME,
+) -> List[str]:
+    """
+    Returns a message for each stage whose wall time grew by more than
+    time_tolerance (and min_time seconds) or whose peak memory grew by more
+    than memory_tolerance with respect to the baseline; cases and stages
+    missing from the baseline are not compared.
+    """
+    regressions = []
+    for name, stages in results.items():
+        for stage, values in stages.items():
+            reference = baseline.get(name, {}).get(stage)
+            if reference is None:
+                continue
+            wall, ref_wall = values["wall"], reference["wall"]
+            if wall > ref_wall * (1.0 + time_tolerance) and wall - ref_wall > min_time:
+                regressions.append(
+                    f"{name} {stage}: {wall:.3f} s, baseline {ref_wall:.3f} s"
+                )
+            memory, ref_memory = values["peak_rss_mb"], reference["peak_rss_mb"]
+            if memory > ref_memory * (1.0 + memory_tolerance):
+                regressions.append(
+                    f"{name} {stage}: {memory:.0f} MB, baseline {ref_memory:.0f} MB"
+                )
+    return regressions
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmarks shift_density and det_hist on synthetic xsf and"
+        " wavefunction files, optionally checking for regressions against a"
+        " baseline."
+    )
+    parser.add_argument(
+        "-o", "--output", default="bench.json", help="the json file of the results"
+    )
+    parser.add_argument(
+        "-b", "--baseline", help="a json file of earlier results to compare with"
+    )
+    parser.add_argument(
+        "--xsf-sizes",
+        nargs="*",
+        type=int,
+        help=f"points per side of the grids (default {' '.join(map(str, XSF_SIZES))})",
+    )
+    parser.add_argument(
+        "--det-sizes",
+        nargs="*",
+        type=int,
+        help=f"numbers of determinants (default {' '.join(map(str, DET_SIZES))})",
+    )
+    parser.add_argument("--quick", action="store_true", help="only the smaller inputs")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="runs per case, the best is kept"
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        help="where the synthetic inputs are written and kept (default a"
+        " temporary directory, removed at the end)",
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative increase of the wall times (default 0.25)",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative increase of the peak memory (default 0.25)",
+    )
+    parsed = parser.parse_args(args)
+    if parsed.xsf_sizes is None:
+        parsed.xsf_sizes = list(QUICK_XSF_SIZES if parsed.quick else XSF_SIZES)
+    if parsed.det_sizes is None:
+        parsed.det_sizes = list(QUICK_DET_SIZES if parsed.quick else DET_SIZES)
+    if any(size < 2 for size in parsed.xsf_sizes + parsed.det_sizes):
+        parser.error("the sizes must be at least 2")
+    return parsed
+
+
+def main() -> None:
+    """
+    Main function: writes the inputs, runs the benchmarks, saves the results
+    and compares them with the baseline.
+    """
+    args = parse_args(sys.argv[1:])
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_tools_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        cases = build_cases(workdir, args.xsf_sizes, args.det_sizes)
+        results = run_benchmarks(cases, workdir, args.repeat)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    report = {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file_out:
+        json.dump(report, file_out, indent=1)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file_in:
+            baseline = json.load(file_in)["results"]
+        regressions = compare(
+            results, baseline, args.time_tolerance, args.memory_tolerance
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions with respect to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Arithmetic on the densities of several xsf files, e.g. the average of the
+densities of independent QMC runs or the difference of two densities.
+The grids are read in lockstep, a chunk of values per file at a time, so
+that only a chunk per file is held in memory whatever the size of the grids;
+the mean and variance are accumulated as running (Welford) sums over the
+files, and the per-voxel error bar of the mean can be written as a second
+xsf file. The files must have the same cell, nind, origin and spanning
+vectors; the atoms are taken from the first one.
+"""
+import sys
+import time
+import argparse
+import contextlib
+from typing import Tuple, List, Dict, Any, Iterable, Iterator, Optional, Sequence
+import numpy
+import numpy.typing as npt
+from shift_density import (
+    _TokenReader,
+    _read_grid_head,
+    _read_structure,
+    find_grid,
+    iter_values,
+    load_index,
+    open_xsf,
+    write_data,
+    write_head,
+    write_lines,
+    write_tail,
+)
+
+OPERATIONS = ("mean", "sum", "diff")
+CHUNK_VALUES = 1 << 19  # grid values per file combined at a time
+
+
+def open_grid(
+    stack: contextlib.ExitStack,
+    filein: str,
+    grid: Optional[str] = None,
+    chunk_values: int = CHUNK_VALUES,
+) -> Tuple[Dict[str, Any], Iterator[npt.NDArray]]:
+    """
+    Opens filein (closed with stack) and reads the structure and the head of
+    a grid (the first one, or the one called grid, see find_grid). Returns a
+    dictionary with cell, atoms, nind, start_coord and span, and an iterator
+    over the grid values in chunks of chunk_values (the last one excepted).
+    """
+    file_in = stack.enter_context(open_xsf(filein))
+    tokens = _TokenReader(file_in)
+    cell, atoms = _read_structure(tokens)
+    if grid is None:
+        tokens.skip_to(b"BEGIN_DATAGRID_3D_")
+    else:
+        file_in.seek(find_grid(load_index(filein), grid)["header"])
+        tokens = _TokenReader(file_in)
+    nind, start_coord, span = _read_grid_head(tokens)
+    head = {
+        "cell": cell,
+        "atoms": atoms,
+        "nind": nind,
+        "start_coord": start_coord,
+        "span": span,
+    }
+    values = iter_values(tokens, int(numpy.prod(nind)), head=tokens.rest())
+    return head, rechunk(values, chunk_values)
+
+
+def rechunk(chunks: Iterable[npt.NDArray], size: int) -> Iterator[npt.NDArray]:
+    """
+    Yields the values of chunks (arrays of any length) in arrays of size
+    values, the last one excepted.
+    """
+    pending: List[npt.NDArray] = []
+    filled = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        filled += chunk.size
+        if filled < size:
+            continue
+        values = numpy.concatenate(pending)
+        full = values.size - values.size % size
+        for start in range(0, full, size):
+            yield values[start : start + size]
+        pending, filled = [values[full:]], values.size - full
+    if filled:
+        yield numpy.concatenate(pending)
+
+
+def check_compatible(heads: Sequence[Dict[str, Any]], files: Sequence[str]) -> None:
+    """
+    Raises a ValueError if the grids do not share cell, nind, start_coord
+    and spanning vectors.
+    """
+    first = heads[0]
+    for filein, head in zip(files[1:], heads[1:]):
+        if not numpy.array_equal(head["nind"], first["nind"]):
+            raise ValueError(
+                f"{filein} has a {head['nind'].tolist()} grid,"
+                f" {files[0]} a {first['nind'].tolist()} one."
+            )
+        for key in ("cell", "start_coord", "span"):
+            if not numpy.allclose(head[key], first[key], rtol=0, atol=1e-6):
+                raise ValueError(f"{filein} and {files[0]} have a different {key}.")
+
+
+class RunningMean:
+    """
+    Defines the running weighted mean and variance of a chunk of grid values
+    over several files (West's version of Welford's algorithm); its members are
+    weight: float, the sum of the weights of the files added
+    weight2: float, the sum of the squared weights
+    mean: np.array, the weighted mean of each value
+    m2: np.array, the weighted sum of the squared deviations from the mean
+    """
+
+    __slots__ = ("weight", "weight2", "mean", "m2")
+
+    def __init__(self, size: int) -> None:
+        self.weight = 0.0
+        self.weight2 = 0.0
+        self.mean = numpy.zeros(size)
+        self.m2 = numpy.zeros(size)
+
+    def add(self, values: npt.NDArray, weight: float = 1.0) -> None:
+        """
+        Adds the values of a file, with the given weight
+        """
+        self.weight += weight
+        self.weight2 += weight * weight
+        delta = values - self.mean
+        self.mean += delta * (weight / self.weight)
+        self.m2 += weight * delta * (values - self.mean)
+
+    def variance(self) -> npt.NDArray:
+        """
+        Returns the (unbiased) variance of the values across the files
+        """
+        neff = self.weight**2 / self.weight2
+        return self.m2 / self.weight * neff / (neff - 1.0)
+
+    def error(self) -> npt.NDArray:
+        """
+        Returns the error bar of the mean, sqrt(variance / N_eff)
+        """
+        neff = self.weight**2 / self.weight2
+        return numpy.sqrt(self.variance() / neff)
+
+
+def combine_chunks(
+    chunks: Sequence[Iterator[npt.NDArray]],
+    operation: str,
+    weights: npt.NDArray,
+    errors: bool = False,
+) -> Iterator[Tuple[npt.NDArray, Optional[npt.NDArray]]]:
+    """
+    Reads the chunks of the grids in lockstep and yields, for each chunk, the
+    combined values and (for the mean, if errors is set) their error bars,
+    else None: the weighted mean, the weighted sum, or the first grid minus
+    the others.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"The operation must be one of {', '.join(OPERATIONS)}.")
+    if errors and (operation != "mean" or len(chunks) < 2):
+        raise ValueError("The error bars need the mean of at least two files.")
+    for values in zip(*chunks):
+        sizes = {chunk.size for chunk in values}
+        if len(sizes) != 1:
+            raise ValueError("The grids have a different number of values.")
+        if operation == "mean":
+            running = RunningMean(values[0].size)
+            for chunk, weight in zip(values, weights):
+                running.add(chunk, weight)
+            yield running.mean, running.error() if errors else None
+        elif operation == "sum":
+            total = values[0] * weights[0]
+            for chunk, weight in zip(values[1:], weights[1:]):
+                total += chunk * weight
+            yield total, None
+        else:
+            difference = values[0].copy()
+            for chunk in values[1:]:
+                difference -= chunk
+            yield difference, None
+
+
+def combine_files(
+    files: Sequence[str],
+    fileout: str,
+    operation: str = "mean",
+    weights: Optional[Sequence[float]] = None,
+    fileerr: Optional[str] = None,
+    grid: Optional[str] = None,
+    chunk_values: int = CHUNK_VALUES,
+) -> None:
+    """
+    Combines a grid of the files (the first one, or the one called grid)
+    with operation (see combine_chunks) and writes the result to fileout,
+    and the error bars of the mean to fileerr if given.
+    chunk_values must be a multiple of 4, so that every chunk but the last
+    one fills whole grid lines.
+    """
+    if chunk_values % 4:
+        raise ValueError("The number of values per chunk must be a multiple of 4.")
+    if weights is None:
+        weights = numpy.ones(len(files))
+    weights = numpy.asarray(weights, dtype=float)
+    if len(weights) != len(files):
+        raise ValueError(f"{len(files)} weights expected, {len(weights)} given.")
+    errors = bool(fileerr) and operation == "mean"
+    if errors and len(files) < 2:
+        raise ValueError("The error bars need at least two files.")
+    with contextlib.ExitStack() as stack:
+        opened = [open_grid(stack, filein, grid, chunk_values) for filein in files]
+        heads = [head for head, _ in opened]
+        check_compatible(heads, files)
+        first = heads[0]
+        outputs = [stack.enter_context(open_xsf(fileout, "w"))]
+        if errors:
+            outputs.append(stack.enter_context(open_xsf(fileerr, "w")))
+        for file_out in outputs:
+            write_head(
+                file_out,
+                first["cell"],
+                first["atoms"],
+                first["nind"],
+                first["start_coord"],
+                first["span"],
+            )
+        last: Tuple[npt.NDArray, ...] = ()
+        for result in combine_chunks(
+            [chunks for _, chunks in opened], operation, weights, errors
+        ):
+            # the previous chunk fills whole lines, the last one closes the grid
+            for file_out, values in zip(outputs, last):
+                write_lines(file_out, values)
+            last = result
+        for file_out, values in zip(outputs, last):
+            write_data(file_out, values)
+            write_tail(file_out)
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Mean (with per-voxel error bars), weighted sum or difference"
+        " (the first file minus the others) of the densities of xsf files,"
+        " read in lockstep a chunk at a time."
+    )
+    parser.add_argument("operation", choices=OPERATIONS)
+    parser.add_argument("files", nargs="+", help="the xsf files")
+    parser.add_argument("-o", "--output", required=True, help="the output file")
+    parser.add_argument(
+        "-e", "--error", help="mean only: the file for the error bars of the mean"
+    )
+    parser.add_argument(
+        "-w",
+        "--weights",
+        nargs="+",
+        type=float,
+        help="a weight per file for the mean and the sum (default 1)",
+    )
+    parser.add_argument(
+        "-g", "--grid", help="the grid to combine, by name (default the first one)"
+    )
+    parsed = parser.parse_args(args)
+    if parsed.operation == "diff" and parsed.weights:
+        parser.error("the difference takes no weights")
+    if parsed.operation == "diff" and len(parsed.files) < 2:
+        parser.error("the difference needs at least two files")
+    if parsed.error and parsed.operation != "mean":
+        parser.error("the error bars are only given for the mean")
+    return parsed
+
+
+def main() -> None:
+    """
+    Main function: combines the grids and writes the result.
+    """
+    args = parse_args(sys.argv[1:])
+    start = time.perf_counter()
+    # keep the standard output clean when the result is written there
+    with contextlib.redirect_stdout(sys.stderr if args.output == "-" else sys.stdout):
+        combine_files(
+            args.files, args.output, args.operation, args.weights, args.error, args.grid
+        )
+    print(
+        f"{args.operation} of {len(args.files)} files written to {args.output}"
+        f" ({time.perf_counter() - start:.2f} s)",
+        file=sys.stderr if args.output == "-" else sys.stdout,
+    )
+    if args.error:
+        print(f"Error bars written to {args.error}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
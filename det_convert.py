@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+This script converts a multideterminant expansion between the XML <detlist>
+of QMCPack wavefunction files (or the determinants.dat files of gen_det)
+and a compact binary file with the packed occupations and the coefficients:
+HDF5 if the h5py module is available, else NumPy .npz. The direction is
+given by the extension of the input file; sizes and load times of the two
+formats are reported.
+"""
+
+import os
+import sys
+import time
+import argparse
+from typing import List, Optional
+from det_set import read_store, write_detlist
+from det_store import binary_name, is_binary
+
+
+def convert(filein: str, fileout: str) -> float:
+    """
+    Converts filein (XML or binary) to fileout (binary or XML); returns
+    the time taken to read filein.
+    """
+    start = time.perf_counter()
+    store, cutoff = read_store(filein)
+    elapsed = time.perf_counter() - start
+    if is_binary(fileout):
+        store.save(fileout, cutoff)
+    else:
+        write_detlist(store, fileout, cutoff)
+    print(f"{len(store)} determinants, {store.norb} states")
+    return elapsed
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Main function: converts the file and prints the size and load time of
+    both formats.
+    """
+    parser = argparse.ArgumentParser(
+        description="Converts a detlist between XML and a binary format"
+        " (.h5 with h5py, else .npz)."
+    )
+    parser.add_argument("input", help="the XML, determinants.dat, .h5 or .npz file")
+    parser.add_argument(
+        "output",
+        nargs="?",
+        help="the output file (default: the input with .h5/.npz, or .xml"
+        " for binary input)",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        action="store_true",
+        help="also time reading the output file",
+    )
+    parsed = parser.parse_args(args)
+    output = parsed.output
+    if output is None:
+        if is_binary(parsed.input):
+            output = os.path.splitext(parsed.input)[0] + ".xml"
+        else:
+            output = binary_name(parsed.input)
+    if is_binary(parsed.input) == is_binary(output):
+        parser.error("one of input and output must be binary (.h5, .hdf5, .npz)")
+
+    times = {parsed.input: convert(parsed.input, output)}
+    if parsed.benchmark:
+        start = time.perf_counter()
+        read_store(output)
+        times[output] = time.perf_counter() - start
+    for filename in (parsed.input, output):
+        size = os.path.getsize(filename) / 1e6
+        loaded = f", loaded in {times[filename]:.3f} s" if filename in times else ""
+        print(f"{filename}: {size:.2f} MB{loaded}")
+    print(f"Output written to {output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,46 +6,194 @@ histograms of the CI coefficients
 """
 
 import sys
-from xml.dom import minidom
-from typing import Tuple, List
+import argparse
+from xml.etree import ElementTree
+from typing import Tuple, List, Optional
+import numpy
+import numpy.typing as npt
 import matplotlib.pyplot as plt
+import instrument
+from det_store import DetStore, is_binary
 
+CHUNK_SIZE = 1 << 20  # bytes of XML fed to the parser at a time
+MODES = ("bars", "envelope", "distribution", "cumulative", "excitations")
+MAX_BARS = 2000  # above this, bars are replaced by a min/max envelope
+MAX_TICKS = 50  # above this, no tick for every determinant
+DECIMATE_BINS = 1000
+DISTRIBUTION_BINS = 60
+RASTER_THRESHOLD = 1000
 
-def initialize(args: List[str]) -> Tuple[minidom.NodeList, float, str]:
+
+def read_coefficients(
+    filename: str, strings: bool = False, chunk_size: int = CHUNK_SIZE
+) -> Tuple[npt.NDArray, float, Optional[List[str]], Optional[List[str]]]:
+    """
+    Streams the CI coefficients out of a wavefunction or optimization file,
+    parsing it incrementally and dropping each <ci> element once read, so
+    that the memory used only grows with the number of determinants.
+    A bare list of <ci> lines, as written by gen_det, is also read, as well
+    as the binary files (.h5, .npz) written by DetStore.save.
+    Returns the coefficients (complex if the file has coeff_real/coeff_imag)
+    of all the detlists in order, the cutoff of the first detlist and, if
+    strings is set, the alpha and beta occupation strings.
+    """
+    if is_binary(filename):
+        store, cutoff = DetStore.load(filename)
+        if not strings:
+            return store.coeffs, cutoff, None, None
+        return store.coeffs, cutoff, store.strings("alpha"), store.strings("beta")
+    # the attributes are complete at the start of an element; the end events
+    # only close the parents
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    coeffs = numpy.empty(0)
+    count = 0
+    detlists = 0
+    cutoff = 0.0
+    alpha: Optional[List[str]] = [] if strings else None
+    beta: Optional[List[str]] = [] if strings else None
+    # the open elements, whose children are dropped after each chunk
+    parents: List[ElementTree.Element] = []
+    fragment = None
+    with open(filename, "rb") as file_in:
+        for chunk in iter(lambda: file_in.read(chunk_size), b""):
+            if fragment is None and chunk.strip():
+                # <ci> lines without a root element get a detlist around them
+                fragment = chunk.lstrip().startswith(b"<ci")
+                if fragment:
+                    parser.feed(b"<detlist>")
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == "end":
+                    if elem.tag != "ci":
+                        parents.pop()
+                    continue
+                if elem.tag != "ci":
+                    if elem.tag == "detlist":
+                        # the coefficients of further detlists are appended
+                        if not detlists:
+                            cutoff = float(elem.get("cutoff", 0.0))
+                            coeffs = numpy.empty(int(elem.get("size", 0)))
+                        detlists += 1
+                    parents.append(elem)
+                    continue
+                attrib = elem.attrib
+                if "coeff_real" in attrib and coeffs.dtype != complex:
+                    coeffs = coeffs.astype(complex)
+                if count >= coeffs.size:
+                    coeffs = numpy.resize(coeffs, max(2 * count, 1024))
+                if coeffs.dtype == complex:
+                    coeffs[count] = complex(
+                        float(attrib["coeff_real"]), float(attrib["coeff_imag"])
+                    )
+                else:
+                    coeffs[count] = float(attrib["coeff"])
+                count += 1
+                if alpha is not None and beta is not None:
+                    alpha.append(attrib["alpha"])
+                    beta.append(attrib["beta"])
+            for parent in parents:
+                del parent[:]
+    if fragment:
+        parser.feed(b"</detlist>")
+    parser.close()
+    return coeffs[:count], cutoff, alpha, beta
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Plots the CI coefficients of a QMCPack wavefunction"
+        " or optimization file."
+    )
+    parser.add_argument("file", nargs="?", help="the wavefunction file")
+    parser.add_argument(
+        "plot", nargs="?", help="the plot file (png, pdf, eps or svg), else on screen"
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=MODES,
+        default="bars",
+        help="bars: one bar per determinant (min/max envelope if too many);"
+        " envelope: |c| by rank; distribution: histogram of |c|;"
+        " cumulative: cumulative weight by rank;"
+        " excitations: weight by excitation level from the reference determinant",
+    )
+    instrument.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def initialize(
+    filename: Optional[str], strings: bool = False
+) -> Tuple[npt.NDArray, float, str, Optional[DetStore]]:
     """
     Reads determinants and cutoff, asking for the input file if needed;
-    asks if the coeffients are real or complex.
+    the coefficients are real or complex depending on the file. If strings
+    is set, the occupations are also read and packed in a DetStore.
     """
-    if len(args) == 1:
+    if not filename:
         filename = input("Insert the wavefunction file name: ")
+
+    store = None
+    with instrument.phase("parse"):
+        if strings and is_binary(filename):
+            # the occupations are already packed
+            store, cutoff = DetStore.load(filename)
+            coeffs = store.coeffs
+        else:
+            coeffs, cutoff, alpha, beta = read_coefficients(filename, strings)
+            if alpha is not None and beta is not None:
+                store = DetStore.from_strings(alpha, beta, coeffs)
+    flag = "c" if numpy.iscomplexobj(coeffs) else "r"
+    return coeffs, cutoff, flag, store
+
+
+def decimate(vals: npt.NDArray, nbins: int = DECIMATE_BINS) -> Tuple[npt.NDArray, ...]:
+    """
+    Splits vals in nbins consecutive groups and returns the central index,
+    the minimum and the maximum of each group.
+    """
+    starts = numpy.unique(numpy.linspace(0, len(vals), nbins + 1).astype(int)[:-1])
+    ends = numpy.append(starts[1:], len(vals))
+    lows = numpy.minimum.reduceat(vals, starts)
+    highs = numpy.maximum.reduceat(vals, starts)
+    return (starts + ends - 1) / 2, lows, highs
+
+
+def draw_bars(axis: plt.Axes, vals: npt.NDArray) -> None:
+    """
+    Draws a bar per determinant; above MAX_BARS determinants draws instead
+    the min/max envelope of DECIMATE_BINS groups of determinants, so that
+    the cost does not depend on their number.
+    """
+    if len(vals) <= MAX_BARS:
+        axis.bar(numpy.arange(len(vals)), vals, color="mediumblue")
     else:
-        filename = args[1]
+        dets, lows, highs = decimate(vals)
+        axis.vlines(
+            dets, numpy.minimum(lows, 0), numpy.maximum(highs, 0), color="mediumblue"
+        )
+    if len(vals) <= MAX_TICKS:
+        axis.set_xticks(range(len(vals)))
 
-    flag = input("Are your coefficients [R]eal or [C]omplex? ").lower()
-    while flag not in ("r", "c"):
-        flag = input("Are your coefficients [R]eal or [C]omplex? ").lower()
 
-    wf_file = minidom.parse(filename)
-    determinants = wf_file.getElementsByTagName("ci")
-    cutoff = float(
-        wf_file.getElementsByTagName("detlist")[0].attributes["cutoff"].value
-    )
-    return determinants, cutoff, flag
+def log_ranks(ndets: int, npoints: int = DECIMATE_BINS) -> npt.NDArray:
+    """
+    Returns about npoints ranks between 0 and ndets-1, evenly spaced on a log scale.
+    """
+    return numpy.unique(numpy.geomspace(1, ndets, npoints).astype(int)) - 1
 
 
-def histo_real(determinants: minidom.NodeList, cutoff: float) -> None:
+def histo_real(coeffs: npt.NDArray, cutoff: float) -> None:
     """
     Builds the histogram (real case).
     """
-    dets = []
-    vals = []
-    for det in determinants:
-        dets.append(len(dets))
-        vals.append(float(det.attributes["coeff"].value))
-    ymax = max(vals) * 1.1
-    ymin = min(min(vals) * 1.1, -0.1)
-    plt.bar(dets, vals, color="mediumblue")
-    plt.xticks(range(len(dets)))
+    vals = coeffs
+    ymax = vals.max() * 1.1
+    ymin = min(vals.min() * 1.1, -0.1)
+    draw_bars(plt.gca(), vals)
     plt.xlabel("Determinant")
     plt.ylabel(r"CI Coefficient")
     plt.ylim([ymin, ymax])
@@ -56,24 +204,18 @@ def histo_real(determinants: minidom.NodeList, cutoff: float) -> None:
     plt.axhline(y=-1, color="steelblue", linestyle="--")
 
 
-def histo_complex(determinants: minidom.NodeList, cutoff: float) -> None:
+def histo_complex(coeffs: npt.NDArray, cutoff: float) -> None:
     """
     Builds the histogram (complex case).
     """
-    dets = []
-    vals_r = []
-    vals_i = []
-    for det in determinants:
-        dets.append(len(dets))
-        vals_r.append(float(det.attributes["coeff_real"].value))
-        vals_i.append(float(det.attributes["coeff_imag"].value))
-    ymax = max(max(vals_r) * 1.1, max(vals_i) * 1.1)
-    ymin = min(min(min(vals_r) * 1.1, -0.1), min(min(vals_i) * 1.1, -0.1))
+    vals_r = coeffs.real
+    vals_i = coeffs.imag
+    ymax = max(vals_r.max() * 1.1, vals_i.max() * 1.1)
+    ymin = min(vals_r.min() * 1.1, vals_i.min() * 1.1, -0.1)
     fig, axs = plt.subplots(2, constrained_layout=True)
     fig.suptitle("CI coefficients")
 
-    axs[0].bar(dets, vals_r, color="mediumblue")
-    axs[0].set_xticks(range(len(dets)))
+    draw_bars(axs[0], vals_r)
     axs[0].set_xlabel("Determinant")
     axs[0].set_ylabel(r"Real part")
     axs[0].set_ylim([ymin, ymax])
@@ -83,8 +225,7 @@ def histo_complex(determinants: minidom.NodeList, cutoff: float) -> None:
     axs[0].axhline(y=1, color="steelblue", linestyle="--")
     axs[0].axhline(y=-1, color="steelblue", linestyle="--")
 
-    axs[1].bar(dets, vals_i, color="mediumblue")
-    axs[1].set_xticks(range(len(dets)))
+    draw_bars(axs[1], vals_i)
     axs[1].set_xlabel("Determinant")
     axs[1].set_ylabel(r"Imaginary part")
     axs[1].set_ylim([ymin, ymax])
@@ -95,16 +236,101 @@ def histo_complex(determinants: minidom.NodeList, cutoff: float) -> None:
     axs[1].axhline(y=-1, color="steelblue", linestyle="--")
 
 
-def print_fig(args: List[str]) -> None:
+def plot_envelope(coeffs: npt.NDArray, cutoff: float) -> None:
+    """
+    Plots the magnitude of the coefficients, sorted in decreasing order, on a log scale.
+    """
+    mags = numpy.sort(numpy.abs(coeffs))[::-1]
+    ranks = log_ranks(len(mags))
+    plt.loglog(ranks + 1, mags[ranks], color="mediumblue")
+    plt.xlabel("Rank")
+    plt.ylabel(r"|CI Coefficient|")
+    plt.axhline(y=cutoff, color="red")
+
+
+def plot_distribution(coeffs: npt.NDArray, cutoff: float) -> None:
+    """
+    Plots the distribution of the magnitude of the coefficients, in log spaced bins.
+    """
+    mags = numpy.abs(coeffs)
+    mags = mags[mags > 0]
+    bins = numpy.geomspace(mags.min(), mags.max() * (1 + 1e-12), DISTRIBUTION_BINS + 1)
+    counts, _ = numpy.histogram(mags, bins)
+    plt.stairs(counts, bins, fill=True, color="mediumblue")
+    plt.xscale("log")
+    plt.xlabel(r"|CI Coefficient|")
+    plt.ylabel("Determinants")
+    plt.axvline(x=cutoff, color="red")
+
+
+def plot_cumulative(coeffs: npt.NDArray, cutoff: float) -> None:
+    """
+    Plots the fraction of the total weight sum |c|^2 carried by the
+    determinants with the largest coefficients, marking how many are
+    above the cutoff.
+    """
+    weights = numpy.sort(numpy.abs(coeffs) ** 2)[::-1]
+    cumulative = numpy.cumsum(weights) / weights.sum()
+    ranks = log_ranks(len(weights))
+    kept = int(numpy.count_nonzero(numpy.abs(coeffs) >= cutoff))
+    plt.semilogx(ranks + 1, cumulative[ranks], color="mediumblue")
+    plt.xlabel("Number of determinants")
+    plt.ylabel("Cumulative weight")
+    if kept:
+        plt.axvline(x=kept, color="red")
+        plt.axhline(y=cumulative[kept - 1], color="red", linestyle="--")
+        print(
+            f"{kept} determinants above the cutoff, weight {cumulative[kept - 1]:.6f}"
+        )
+
+
+def plot_excitations(store: DetStore) -> None:
+    """
+    Plots the fraction of the weight sum |c|^2 carried by the determinants
+    of each excitation level (singles, doubles...) with respect to the
+    determinant with the largest coefficient.
+    """
+    counts, weight = store.weight_by_rank()
+    ranks = numpy.arange(len(counts))
+    present = counts > 0
+    plt.bar(ranks[present], weight[present], color="mediumblue")
+    plt.yscale("log")
+    plt.xticks(ranks[present])
+    plt.xlabel("Excitation level")
+    plt.ylabel("Weight")
+    print("Level  Determinants  Weight")
+    for rank in ranks[present]:
+        print(f"{rank:5d}  {counts[rank]:12d}  {weight[rank]:.6e}")
+
+
+def rasterize_large(threshold: int = RASTER_THRESHOLD) -> None:
+    """
+    Rasterizes the artists of the current figure with more than threshold
+    points, paths or patches, so that vector outputs stay small.
+    """
+    for axis in plt.gcf().axes:
+        for line in axis.lines:
+            if len(line.get_xdata()) > threshold:
+                line.set_rasterized(True)
+        for collection in axis.collections:
+            if len(collection.get_paths()) > threshold:
+                collection.set_rasterized(True)
+        if len(axis.patches) > threshold:
+            for patch in axis.patches:
+                patch.set_rasterized(True)
+
+
+def print_fig(plot_file: Optional[str]) -> None:
     """
     Print the histogram, either on screen or on the output file
     designated as an argument.
     """
-    if len(args) > 2:
-        plot_file = args[2]
+    if plot_file:
         if plot_file[-3:] in ("png", "pdf", "eps", "svg"):
             print(f"Saving plot in {plot_file}")
-            plt.savefig(plot_file)
+            with instrument.phase("render"):
+                rasterize_large()
+                plt.savefig(plot_file)
         else:
             print("Invalid format (png, pdf, eps or svg)")
     else:
@@ -115,14 +341,27 @@ def main() -> None:
     """
     Main functions, calls initialize, the figure builder and print_fig.
     """
-    determinants, cutoff, flag = initialize(sys.argv)
-    if flag == "r":
-        histo_real(determinants, cutoff)
-    elif flag == "c":
-        histo_complex(determinants, cutoff)
-    else:
-        raise NameError("Irregular Real/Complex flag. This should not be happening.")
-    print_fig(sys.argv)
+    args = parse_args(sys.argv[1:])
+    instrument.setup("det_hist", args.instrument, args.debug)
+    coeffs, cutoff, flag, store = initialize(args.file, args.mode == "excitations")
+    with instrument.phase("render"):
+        if store is not None:
+            plot_excitations(store)
+        elif args.mode == "envelope":
+            plot_envelope(coeffs, cutoff)
+        elif args.mode == "distribution":
+            plot_distribution(coeffs, cutoff)
+        elif args.mode == "cumulative":
+            plot_cumulative(coeffs, cutoff)
+        elif flag == "r":
+            histo_real(coeffs, cutoff)
+        elif flag == "c":
+            histo_complex(coeffs, cutoff)
+        else:
+            raise NameError(
+                "Irregular Real/Complex flag. This should not be happening."
+            )
+    print_fig(args.plot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""
+This script merges, intersects or subtracts the determinant lists of
+QMCPack wavefunction or optimization files, or of determinants.dat files
+written by gen_det. Determinants are identified by their packed (alpha,
+beta) occupations through a hash table, so each operation is linear in
+the number of determinants; the coefficients of the determinants found more
+than once are combined by a merge policy and the result is written as a
+new <detlist>.
+"""
+
+import sys
+import time
+import argparse
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy
+import numpy.typing as npt
+from det_hist import read_coefficients
+from det_store import DetStore, is_binary, popcount, unpack_strings
+
+OPERATIONS = ("union", "intersection", "difference")
+POLICIES = ("first", "maxabs", "sum")
+BUFFER_LINES = 1 << 16  # <ci> lines written at a time
+
+
+class DetIndex:
+    """
+    Defines a hash index over the determinants of several sets; its members are
+    norb: int, the number of single particle states
+    lookup: dict, the packed (alpha, beta) occupations of each distinct
+        determinant, mapped to its position in order of first appearance
+    groups: list of arrays, for each set added the position of each of its
+        determinants in the index
+    """
+
+    __slots__ = ("norb", "lookup", "groups")
+
+    def __init__(self, norb: int) -> None:
+        self.norb = norb
+        self.lookup: Dict[bytes, int] = {}
+        self.groups: List[npt.NDArray] = []
+
+    def __len__(self) -> int:
+        return len(self.lookup)
+
+    def add(self, store: DetStore) -> npt.NDArray:
+        """
+        Adds the determinants of store to the index; returns (and keeps)
+        their positions in it.
+        """
+        if store.norb != self.norb:
+            raise ValueError(
+                f"Determinants with {store.norb} states cannot be indexed"
+                f" with ones with {self.norb}."
+            )
+        packed = numpy.ascontiguousarray(numpy.hstack((store.alpha, store.beta)))
+        keys = packed.view(f"V{packed.shape[1] * packed.itemsize}").ravel().tolist()
+        lookup = self.lookup
+        group = numpy.fromiter(
+            (lookup.setdefault(key, len(lookup)) for key in keys),
+            dtype=numpy.int64,
+            count=len(keys),
+        )
+        self.groups.append(group)
+        return group
+
+    def members(self) -> npt.NDArray:
+        """
+        Returns an (nsets, ndistinct) boolean array, True where a
+        determinant of the index is found in a set.
+        """
+        found = numpy.zeros((len(self.groups), len(self)), dtype=bool)
+        for which, group in enumerate(self.groups):
+            found[which, group] = True
+        return found
+
+
+def merge_coefficients(
+    coeffs: npt.NDArray, group: npt.NDArray, ngroups: int, policy: str
+) -> npt.NDArray:
+    """
+    Returns a coefficient for each group, combining those of the
+    determinants in it: the first one, the one with the largest |c|, or
+    their sum.
+    """
+    if policy == "sum":
+        merged = numpy.bincount(group, weights=coeffs.real, minlength=ngroups)
+        if numpy.iscomplexobj(coeffs):
+            merged = merged + 1j * numpy.bincount(
+                group, weights=coeffs.imag, minlength=ngroups
+            )
+        return merged
+    if policy == "first":
+        order = numpy.arange(len(group))
+    elif policy == "maxabs":
+        # stable sort, so that ties keep the first value
+        order = numpy.argsort(-numpy.abs(coeffs), kind="stable")
+    else:
+        raise ValueError(f"The merge policy must be one of {', '.join(POLICIES)}.")
+    # numpy.unique gives the first row of each group in the given order
+    groups, first = numpy.unique(group[order], return_index=True)
+    merged = numpy.zeros(ngroups, dtype=coeffs.dtype)
+    merged[groups] = coeffs[order[first]]
+    return merged
+
+
+def combine(
+    stores: Sequence[DetStore], operation: str = "union", policy: str = "first"
+) -> DetStore:
+    """
+    Returns the union, intersection or difference (the first set minus the
+    others) of the determinant sets, in order of first appearance; the
+    coefficients of the determinants repeated in or across the sets are
+    merged according to policy.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"The operation must be one of {', '.join(OPERATIONS)}.")
+    index = DetIndex(stores[0].norb)
+    for store in stores:
+        index.add(store)
+    group = numpy.concatenate(index.groups)
+    found = index.members()
+    if operation == "union":
+        keep = numpy.ones(len(index), dtype=bool)
+    elif operation == "intersection":
+        keep = found.all(axis=0)
+    else:
+        keep = found[0] & ~found[1:].any(axis=0)
+    coeffs = numpy.concatenate([store.coeffs for store in stores])
+    merged = merge_coefficients(coeffs, group, len(index), policy)
+    # the occupations come from the first appearance of each determinant
+    _, rows = numpy.unique(group, return_index=True)
+    alpha = numpy.concatenate([store.alpha for store in stores])
+    beta = numpy.concatenate([store.beta for store in stores])
+    rows = rows[keep]
+    return DetStore(index.norb, alpha[rows], beta[rows], merged[keep])
+
+
+def read_store(filename: str) -> Tuple[DetStore, float]:
+    """
+    Reads the determinants of a wavefunction, optimization, determinants.dat
+    or binary (.h5, .npz) file in a DetStore; returns it and the cutoff.
+    """
+    if is_binary(filename):
+        return DetStore.load(filename)
+    coeffs, cutoff, alpha, beta = read_coefficients(filename, strings=True)
+    if alpha is None or beta is None:
+        raise ValueError(f"No occupation strings were read from {filename}.")
+    return DetStore.from_strings(alpha, beta, coeffs), cutoff
+
+
+def write_detlist(
+    store: DetStore,
+    filename: str,
+    cutoff: Optional[float] = None,
+    buffer_lines: int = BUFFER_LINES,
+) -> None:
+    """
+    Writes the determinants as a <detlist> element; the cutoff defaults to
+    the smallest |c|.
+    """
+    mags = numpy.abs(store.coeffs)
+    if cutoff is None:
+        cutoff = float(mags.min()) if len(mags) else 0.0
+    nea = int(popcount(store.alpha[:1]).sum())
+    neb = int(popcount(store.beta[:1]).sum())
+    complex_coeffs = numpy.iscomplexobj(store.coeffs)
+    with open(filename, "w") as file_out:
+        file_out.write(
+            f'<detlist size="{len(store)}" type="DETS" nca="0" ncb="0"'
+            f' nea="{nea}" neb="{neb}" nstates="{store.norb}" cutoff="{cutoff!r}">\n'
+        )
+        for first in range(0, len(store), buffer_lines):
+            last = min(first + buffer_lines, len(store))
+            alpha = unpack_strings(store.alpha[first:last], store.norb)
+            beta = unpack_strings(store.beta[first:last], store.norb)
+            lines = []
+            for n, coeff in enumerate(store.coeffs[first:last].tolist()):
+                if complex_coeffs:
+                    value = f'coeff_real="{coeff.real!r}" coeff_imag="{coeff.imag!r}"'
+                else:
+                    value = f'coeff="{coeff!r}"'
+                lines.append(
+                    f'  <ci id="CIcoeff_{first + n}" {value}'
+                    f' alpha="{alpha[n]}" beta="{beta[n]}"/>\n'
+                )
+            file_out.write("".join(lines))
+        file_out.write("</detlist>\n")
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Main function: reads the files, combines the determinants and writes
+    the resulting detlist.
+    """
+    parser = argparse.ArgumentParser(
+        description="Union, intersection or difference (first file minus the"
+        " others) of the determinants of QMCPack wavefunction, optimization"
+        " or determinants.dat files."
+    )
+    parser.add_argument("operation", choices=OPERATIONS)
+    parser.add_argument("files", nargs="+", help="the input files")
+    parser.add_argument("-o", "--output", required=True, help="the output file")
+    parser.add_argument(
+        "-p",
+        "--policy",
+        choices=POLICIES,
+        default="first",
+        help="coefficient of a repeated determinant: the first found, the"
+        " largest |c| or the sum",
+    )
+    parsed = parser.parse_args(args)
+
+    stores = [read_store(filename)[0] for filename in parsed.files]
+    for filename, store in zip(parsed.files, stores):
+        print(f"{filename}: {len(store)} determinants")
+    start = time.perf_counter()
+    result = combine(stores, parsed.operation, parsed.policy)
+    print(
+        f"{parsed.operation}: {len(result)} determinants"
+        f" ({time.perf_counter() - start:.2f} s)"
+    )
+    write_detlist(result, parsed.output)
+    print(f"Output written to {parsed.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
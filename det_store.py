@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+Compact storage of multideterminant expansions: the alpha and beta
+occupation strings are packed in uint64 words (one bit per single particle
+state, one array per spin), so that millions of determinants take a few
+bytes each and can be compared with vectorized XOR/popcount operations,
+e.g. to find the excitation level of each determinant with respect to a
+reference and the CI weight carried by singles, doubles, triples...
+A store can be saved in a compact binary file, HDF5 if the h5py module is
+available or else NumPy .npz, with the packed occupations and the
+coefficients.
+"""
+
+import os
+import sys
+from typing import Tuple, List, Optional, Sequence
+import numpy
+import numpy.typing as npt
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+PACK_CHUNK = 1 << 16  # strings packed at a time, bounds the temporary arrays
+WORD_BITS = 64
+HDF5 = (".h5", ".hdf5")
+BINARY = HDF5 + (".npz",)
+_BYTE_COUNTS = numpy.array([bin(n).count("1") for n in range(256)], dtype=numpy.uint8)
+
+
+def is_binary(filename: str) -> bool:
+    """
+    Tells whether filename is a binary determinant file (by its extension).
+    """
+    return filename.lower().endswith(BINARY)
+
+
+def binary_name(filename: str) -> str:
+    """
+    Returns the name of the binary file for filename: .h5 if h5py is
+    available, else .npz.
+    """
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() in (".xml", ".dat") + BINARY:
+        filename = stem
+    return filename + (".h5" if h5py is not None else ".npz")
+
+
+def popcount(words: npt.NDArray) -> npt.NDArray:
+    """
+    Returns the number of set bits of each element of an uint64 array.
+    """
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(words)
+    # numpy < 2.0: count the bits of each byte through a table
+    as_bytes = numpy.ascontiguousarray(words).view(numpy.uint8)
+    counts = _BYTE_COUNTS[as_bytes].reshape(words.shape + (8,))
+    return counts.sum(axis=-1, dtype=numpy.uint8)
+
+
+def pack_strings(strings: Sequence[str], norb: Optional[int] = None) -> npt.NDArray:
+    """
+    Packs occupation strings ("1" occupied, anything else empty) in an
+    (ndet, nwords) uint64 array; state i is bit i % 64 of word i // 64.
+    """
+    if norb is None:
+        norb = len(strings[0]) if len(strings) else 0
+    if any(len(string) != norb for string in strings):
+        raise ValueError(f"All the occupation strings must have {norb} states.")
+    nwords = max((norb + WORD_BITS - 1) // WORD_BITS, 1)
+    packed = numpy.zeros((len(strings), nwords), dtype=numpy.uint64)
+    for first in range(0, len(strings), PACK_CHUNK):
+        chunk = strings[first : first + PACK_CHUNK]
+        text = "".join(chunk).encode("ascii")
+        occupied = numpy.zeros((len(chunk), nwords * WORD_BITS), dtype=bool)
+        occupied[:, :norb] = numpy.frombuffer(text, dtype=numpy.uint8).reshape(
+            len(chunk), norb
+        ) == ord("1")
+        words = numpy.packbits(occupied, axis=1, bitorder="little").view("<u8")
+        packed[first : first + len(chunk)] = words
+    return packed
+
+
+def unpack_strings(packed: npt.NDArray, norb: int) -> List[str]:
+    """
+    Returns the occupation strings of an array made by pack_strings.
+    """
+    as_bytes = numpy.ascontiguousarray(packed, dtype="<u8").view(numpy.uint8)
+    occupied = numpy.unpackbits(as_bytes, axis=1, bitorder="little")[:, :norb]
+    text = (occupied + ord("0")).astype(numpy.uint8).tobytes().decode("ascii")
+    return [text[n * norb : (n + 1) * norb] for n in range(len(packed))]
+
+
+class DetStore:
+    """
+    Defines a set of determinants; its members are
+    norb: int, the number of single particle states
+    alpha: (ndet, nwords) uint64 array, the packed alpha occupations
+    beta: (ndet, nwords) uint64 array, the packed beta occupations
+    coeffs: (ndet,) array, the CI coefficients (real or complex)
+    """
+
+    __slots__ = ("norb", "alpha", "beta", "coeffs")
+
+    def __init__(
+        self,
+        norb: int,
+        alpha: npt.NDArray,
+        beta: npt.NDArray,
+        coeffs: Optional[npt.NDArray] = None,
+    ) -> None:
+        if alpha.shape != beta.shape:
+            raise ValueError("Alpha and beta occupations must have the same shape.")
+        if coeffs is None:
+            coeffs = numpy.ones(len(alpha))
+        if len(coeffs) != len(alpha):
+            raise ValueError(
+                f"{len(coeffs)} coefficients given for {len(alpha)} determinants."
+            )
+        self.norb = norb
+        self.alpha = alpha
+        self.beta = beta
+        self.coeffs = numpy.asarray(coeffs)
+
+    @classmethod
+    def from_strings(
+        cls,
+        alpha: Sequence[str],
+        beta: Sequence[str],
+        coeffs: Optional[npt.NDArray] = None,
+    ) -> "DetStore":
+        """
+        Builds the store from the occupation strings of the <ci> elements.
+        """
+        norb = len(alpha[0]) if len(alpha) else 0
+        return cls(norb, pack_strings(alpha, norb), pack_strings(beta, norb), coeffs)
+
+    def __len__(self) -> int:
+        return len(self.coeffs)
+
+    def save(self, filename: str, cutoff: float = 0.0) -> None:
+        """
+        Writes the store in a binary file, HDF5 (.h5, .hdf5) or .npz.
+        """
+        if filename.lower().endswith(HDF5):
+            if h5py is None:
+                raise ImportError("The h5py module is needed for HDF5 files.")
+            with h5py.File(filename, "w") as file_out:
+                file_out.attrs["norb"] = self.norb
+                file_out.attrs["cutoff"] = cutoff
+                for name in ("alpha", "beta", "coeffs"):
+                    file_out.create_dataset(name, data=getattr(self, name))
+        elif filename.lower().endswith(".npz"):
+            numpy.savez(
+                filename,
+                norb=self.norb,
+                cutoff=cutoff,
+                alpha=self.alpha,
+                beta=self.beta,
+                coeffs=self.coeffs,
+            )
+        else:
+            raise ValueError(f"Unknown binary format for {filename}.")
+
+    @classmethod
+    def load(cls, filename: str) -> Tuple["DetStore", float]:
+        """
+        Reads a store and its cutoff from a file written by save.
+        """
+        if filename.lower().endswith(HDF5):
+            if h5py is None:
+                raise ImportError("The h5py module is needed for HDF5 files.")
+            with h5py.File(filename, "r") as file_in:
+                data = {name: file_in[name][()] for name in ("alpha", "beta", "coeffs")}
+                norb = int(file_in.attrs["norb"])
+                cutoff = float(file_in.attrs["cutoff"])
+        elif filename.lower().endswith(".npz"):
+            with numpy.load(filename) as file_in:
+                data = {name: file_in[name] for name in ("alpha", "beta", "coeffs")}
+                norb = int(file_in["norb"])
+                cutoff = float(file_in["cutoff"])
+        else:
+            raise ValueError(f"Unknown binary format for {filename}.")
+        return cls(norb, data["alpha"], data["beta"], data["coeffs"]), cutoff
+
+    def strings(self, spin: str = "alpha") -> List[str]:
+        """
+        Returns the occupation strings of the given spin ("alpha" or "beta").
+        """
+        return unpack_strings(getattr(self, spin), self.norb)
+
+    def electrons(self) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Returns the number of alpha and beta electrons of each determinant.
+        """
+        return (
+            popcount(self.alpha).sum(axis=1, dtype=numpy.int64),
+            popcount(self.beta).sum(axis=1, dtype=numpy.int64),
+        )
+
+    def reference_index(self) -> int:
+        """
+        Returns the index of the determinant with the largest |c|.
+        """
+        return int(numpy.argmax(numpy.abs(self.coeffs)))
+
+    def excitation_levels(
+        self, reference: Optional[int] = None
+    ) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Returns the alpha and beta excitation levels of each determinant with
+        respect to the reference one (by default the largest |c|), that is the
+        number of electrons moved out of the reference occupied states;
+        if the number of electrons changes, the largest of holes and particles.
+        """
+        if reference is None:
+            reference = self.reference_index()
+        levels = []
+        for packed in (self.alpha, self.beta):
+            ref = packed[reference]
+            holes = popcount(ref & ~packed).sum(axis=1, dtype=numpy.int64)
+            particles = popcount(packed & ~ref).sum(axis=1, dtype=numpy.int64)
+            levels.append(numpy.maximum(holes, particles))
+        return levels[0], levels[1]
+
+    def weight_by_rank(
+        self, reference: Optional[int] = None
+    ) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Returns, for each total excitation rank (0 for the reference, 1 for
+        singles, 2 for doubles...), the number of determinants and the
+        fraction of the weight sum |c|^2 they carry.
+        """
+        alpha_levels, beta_levels = self.excitation_levels(reference)
+        ranks = alpha_levels + beta_levels
+        weights = numpy.abs(self.coeffs) ** 2
+        counts = numpy.bincount(ranks)
+        weight = numpy.bincount(ranks, weights=weights) / weights.sum()
+        return counts, weight
+
+
+def main() -> None:
+    """
+    Prints the number of determinants and the CI weight by excitation rank
+    for the wavefunction file given as an argument.
+    """
+    from det_hist import read_coefficients
+
+    if len(sys.argv) < 2:
+        print("Usage: det_store.py <wavefunction file>")
+        return
+    coeffs, _, alpha, beta = read_coefficients(sys.argv[1], strings=True)
+    if alpha is None or beta is None:
+        raise ValueError("No occupation strings were read.")
+    store = DetStore.from_strings(alpha, beta, coeffs)
+    counts, weight = store.weight_by_rank()
+    print(f"{len(store)} determinants, {store.norb} states")
+    print("Rank  Determinants  Weight")
+    for rank, (count, frac) in enumerate(zip(counts, weight)):
+        if count:
+            print(f"{rank:4d}  {count:12d}  {frac:.6e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+This script truncates the multideterminant expansion of a QMCPack
+wavefunction or optimization file, dropping the determinants whose CI
+coefficient is below a threshold or keeping only the largest ones.
+The file is streamed twice (once by det_hist to read the coefficients,
+once to rewrite it): everything outside the dropped <ci> elements is copied
+byte for byte, apart from the size and cutoff attributes of the detlist.
+"""
+
+import os
+import re
+import sys
+import argparse
+from typing import IO, List, Optional
+import numpy
+import numpy.typing as npt
+from det_hist import read_coefficients
+
+CHUNK_SIZE = 1 << 20
+CI = re.compile(rb"[ \t]*<ci\b[^>]*?(?:/>|>.*?</ci\s*>)[ \t]*(?:\r?\n)?", re.DOTALL)
+DETLIST_TAG = re.compile(rb"<detlist\b[^>]*>")
+
+
+def select(
+    coeffs: npt.NDArray, threshold: Optional[float] = None, top: Optional[int] = None
+) -> npt.NDArray:
+    """
+    Returns the mask of the determinants to keep: those with |c| >= threshold,
+    or the top ones with the largest |c|.
+    """
+    mags = numpy.abs(coeffs)
+    if threshold is not None:
+        return mags >= threshold
+    if top is None:
+        raise ValueError("Either a threshold or a number of determinants is needed.")
+    keep = numpy.zeros(len(mags), dtype=bool)
+    if top >= len(mags):
+        keep[:] = True
+    elif top > 0:
+        keep[numpy.argpartition(-mags, top - 1)[:top]] = True
+    return keep
+
+
+def set_attribute(tag: bytes, name: str, value: str) -> bytes:
+    """
+    Sets the value of the attribute name in the start tag, adding it if missing.
+    """
+    pattern = re.compile(rb"(\s" + name.encode() + rb"\s*=\s*)([\"'])[^\"']*\2")
+    if pattern.search(tag):
+        return pattern.sub(
+            lambda match: match.group(1)
+            + match.group(2)
+            + value.encode()
+            + match.group(2),
+            tag,
+            count=1,
+        )
+    end = -2 if tag.endswith(b"/>") else -1
+    return tag[:end] + f' {name}="{value}"'.encode() + tag[end:]
+
+
+def _line_start(buffer: bytes, position: int, start: int) -> int:
+    """
+    Moves start back to the beginning of its line (not before position)
+    if only spaces precede it.
+    """
+    line = max(buffer.rfind(b"\n", position, start) + 1, position)
+    return line if not buffer[line:start].strip() else start
+
+
+def rewrite(
+    file_in: IO[bytes],
+    file_out: IO[bytes],
+    keep: npt.NDArray,
+    cutoff: float,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """
+    Copies file_in to file_out, dropping the <ci> elements whose keep entry
+    is False and updating size and cutoff in the detlist tag. Returns the
+    number of <ci> elements found.
+    """
+    buffer = b""
+    position = 0
+    state = "head"  # head -> detlist -> tail
+    count = 0
+    eof = False
+    while True:
+        if not eof:
+            chunk = file_in.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+        if state == "head":
+            match = DETLIST_TAG.search(buffer, position)
+            if match is None:
+                # keep a possible partial tag for the next chunk
+                start = buffer.rfind(b"<", position)
+                start = len(buffer) if start < 0 or eof else start
+                file_out.write(buffer[position:start])
+                position = start
+            else:
+                tag = set_attribute(match.group(0), "size", str(int(keep.sum())))
+                tag = set_attribute(tag, "cutoff", repr(float(cutoff)))
+                file_out.write(buffer[position : match.start()] + tag)
+                position = match.end()
+                state = "detlist"
+        if state == "detlist":
+            closing = buffer.find(b"</detlist", position)
+            if closing >= 0:
+                limit = closing
+            elif eof:
+                limit = len(buffer)
+            else:
+                limit = max(buffer.rfind(b"\n", position) + 1, position)
+            pieces = []
+            for match in CI.finditer(buffer, position, limit):
+                pieces.append(buffer[position : match.start()])
+                if count >= len(keep):
+                    raise ValueError("More <ci> elements than coefficients read.")
+                if keep[count]:
+                    pieces.append(match.group(0))
+                count += 1
+                position = match.end()
+            # an element left is incomplete, unless this is the end of the detlist
+            partial = buffer.find(b"<ci", position, limit)
+            if partial >= 0 and (closing >= 0 or eof):
+                raise ValueError("Malformed or truncated <ci> element.")
+            stop = limit if partial < 0 else _line_start(buffer, position, partial)
+            pieces.append(buffer[position:stop])
+            position = stop
+            file_out.write(b"".join(pieces))
+            if closing >= 0:
+                state = "tail"
+        if state == "tail":
+            if DETLIST_TAG.search(buffer, position):
+                raise ValueError("Only files with a single detlist can be truncated.")
+            file_out.write(buffer[position:])
+            position = len(buffer)
+        if eof:
+            break
+    if state == "head":
+        raise ValueError("No detlist in the file.")
+    return count
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Main function: reads the coefficients, selects the determinants and
+    writes the truncated file.
+    """
+    parser = argparse.ArgumentParser(
+        description="Truncates the determinant list of a QMCPack wavefunction"
+        " or optimization file."
+    )
+    parser.add_argument("input", help="the wavefunction (or optimization) file")
+    parser.add_argument("output", help="the truncated file")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "-t", "--threshold", type=float, help="keep the determinants with |c| >= T"
+    )
+    group.add_argument(
+        "-k", "--top", type=int, help="keep the K determinants with the largest |c|"
+    )
+    parsed = parser.parse_args(args)
+
+    coeffs, cutoff, _, _ = read_coefficients(parsed.input)
+    keep = select(coeffs, parsed.threshold, parsed.top)
+    if not keep.any():
+        raise ValueError("No determinant would be left.")
+    if parsed.threshold is not None:
+        cutoff = parsed.threshold
+    else:
+        cutoff = float(numpy.abs(coeffs[keep]).min())
+    # written next to the output and moved there once checked
+    temp = f"{parsed.output}.{os.getpid()}"
+    try:
+        with open(parsed.input, "rb") as file_in, open(temp, "wb") as file_out:
+            count = rewrite(file_in, file_out, keep, cutoff)
+        if count != len(coeffs):
+            raise ValueError(f"Found {count} <ci> elements, expected {len(coeffs)}.")
+        os.replace(temp, parsed.output)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    weight = numpy.sum(numpy.abs(coeffs[keep]) ** 2) / numpy.sum(numpy.abs(coeffs) ** 2)
+    print(
+        f"Kept {int(keep.sum())} of {len(coeffs)} determinants"
+        f" ({weight:.6f} of the weight), cutoff {cutoff}"
+    )
+    print(f"Output written to {parsed.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
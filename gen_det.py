@@ -6,19 +6,30 @@ This script is used to generate binary strings used to describe determinants
 to be used in MD wave function specifications for QMCPack; the state with
 the respective labels can be found in the einspline*.dat files.
 Given the number of single particle states and electrons the resulting
-determinants will be stored in the determinants.dat file.
+determinants will be stored in the determinants.dat file; they are either
+built one by one (interactively) or all the excitations up to a given rank
+are generated in bulk (see parse_args).
 """
 
+import sys
+import heapq
+import argparse
+from itertools import combinations, islice, takewhile
+from typing import Any, Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy
+import instrument
+from det_store import DetStore, is_binary, pack_strings
+
+BUFFER_LINES = 1 << 16  # <ci> lines written at a time
+CHANNELS = ("alpha", "beta", "both")
+
 
 def convert_to_list(in_list: list) -> str:
     """
     This function takes a list and returns it as a single
     uninterrupted string
     """
-    converted = ""
-    for inp in in_list:
-        converted += str(inp)
-    return converted
+    return "".join(map(str, in_list))
 
 
 def build_excitation(state: list, hole: int, particle: int) -> str:
@@ -39,9 +50,9 @@ def build_excitation(state: list, hole: int, particle: int) -> str:
     return excitation_str
 
 
-def main() -> None:
+def interactive() -> None:
     """
-    Main function for gen_det. It builds the ground state of the system and
+    Interactive mode of gen_det. It builds the ground state of the system and
     uses a loop to build the desired determinants. The loop is broken if the
     input of hole and particle has some problem (e.g. wrong format or type,
     but also simply pressing enter). The output is (over)written in
@@ -77,7 +88,9 @@ def main() -> None:
                     continue
                 state_str = build_excitation(ground_state, hole, particle)
                 print(state_str)
-                output_file.write(f"<ci id=\"{hole}-{particle}\" coeff=\"1\" alpha=\"{state_str}\" beta=\"{convert_to_list(ground_state)}\"/>\n")
+                output_file.write(
+                    f'<ci id="{hole}-{particle}" coeff="1" alpha="{state_str}" beta="{convert_to_list(ground_state)}"/>\n'
+                )
             except ValueError:
                 break
             except IndexError:
@@ -85,5 +98,434 @@ def main() -> None:
     print("Output written to determinants.dat")
 
 
+def excitations(
+    ground: str, rank: int, holes: Sequence[int], particles: Sequence[int]
+) -> Iterator[str]:
+    """
+    Lazily yields the occupation strings of all the excitations of exactly
+    rank electrons from ground, moving them from the occupied states among
+    holes to the empty states among particles.
+    """
+    base = ground.encode("ascii")
+    occupied = [hole for hole in holes if base[hole] == ord("1")]
+    empty = [particle for particle in particles if base[particle] == ord("0")]
+    for hole_set in combinations(occupied, rank):
+        for particle_set in combinations(empty, rank):
+            state = bytearray(base)
+            for hole in hole_set:
+                state[hole] = ord("0")
+            for particle in particle_set:
+                state[particle] = ord("1")
+            yield state.decode("ascii")
+
+
+def generate(
+    number_of_states: int,
+    alpha_electrons: int,
+    beta_electrons: int,
+    max_rank: int,
+    channel: str = "both",
+    holes: Optional[Sequence[int]] = None,
+    particles: Optional[Sequence[int]] = None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily yields the (alpha, beta) occupation strings of the ground state
+    and of all its excitations up to max_rank, in increasing rank; channel
+    selects alpha-only, beta-only or also mixed excitations. holes and
+    particles restrict the states that can be emptied or filled (the
+    active space); by default all of them.
+    """
+    states = range(number_of_states)
+    holes = states if holes is None else holes
+    particles = states if particles is None else particles
+    alpha_ground = convert_to_list([1 if n < alpha_electrons else 0 for n in states])
+    beta_ground = convert_to_list([1 if n < beta_electrons else 0 for n in states])
+    for alpha_rank, beta_rank in rank_pairs(max_rank, channel):
+        for alpha in excitations(alpha_ground, alpha_rank, holes, particles):
+            for beta in excitations(beta_ground, beta_rank, holes, particles):
+                yield alpha, beta
+
+
+def rank_pairs(max_rank: int, channel: str) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the (alpha, beta) excitation ranks up to a total of max_rank
+    allowed by channel, in increasing total rank.
+    """
+    if channel not in CHANNELS:
+        raise ValueError(f"The channel must be one of {', '.join(CHANNELS)}.")
+    for rank in range(max_rank + 1):
+        for alpha_rank in range(rank, -1, -1):
+            beta_rank = rank - alpha_rank
+            if (channel == "alpha" and beta_rank) or (channel == "beta" and alpha_rank):
+                continue
+            yield alpha_rank, beta_rank
+
+
+def read_energies(filename: str) -> List[float]:
+    """
+    Reads the orbital energies from an einspline*.bandinfo.dat file (the
+    Energy column, found from the header), or one energy per line.
+    """
+    energies = []
+    column = 4
+    with open(filename, "r") as file_in:
+        for line in file_in:
+            words = line.split()
+            if not words:
+                continue
+            if words[0].startswith("#"):
+                names = line.lstrip("#").split()
+                if "Energy" in names:
+                    column = names.index("Energy")
+                continue
+            energies.append(float(words[column] if len(words) > column else words[-1]))
+    return energies
+
+
+def cheapest_subsets(
+    costs: Sequence[float], size: int
+) -> Iterator[Tuple[float, Tuple[int, ...]]]:
+    """
+    Yields the subsets of size indices of costs (sorted in increasing order)
+    in increasing total cost, as (cost, indices): a best-first search from
+    the cheapest subset, where each popped subset pushes the ones with a
+    single index moved to the next cost.
+    """
+    if size > len(costs):
+        return
+    first = tuple(range(size))
+    heap = [(sum(costs[i] for i in first), first)]
+    seen = {first}
+    while heap:
+        cost, subset = heapq.heappop(heap)
+        yield cost, subset
+        for j in range(size):
+            moved = subset[j] + 1
+            if moved < (subset[j + 1] if j + 1 < size else len(costs)):
+                new = subset[:j] + (moved,) + subset[j + 1 :]
+                if new not in seen:
+                    seen.add(new)
+                    heapq.heappush(heap, (cost - costs[subset[j]] + costs[moved], new))
+
+
+def cheapest_pairs(
+    first: Iterator[Tuple[float, Any]], second: Iterator[Tuple[float, Any]]
+) -> Iterator[Tuple[float, Tuple[Any, Any]]]:
+    """
+    Yields the pairs of items of two streams sorted by cost in increasing
+    total cost, as (cost, (item, item)); the streams are read only as far
+    as needed.
+    """
+    streams = (first, second)
+    items: Tuple[List[Tuple[float, Any]], List[Tuple[float, Any]]] = ([], [])
+
+    def get(which: int, index: int) -> Optional[Tuple[float, Any]]:
+        while len(items[which]) <= index:
+            item = next(streams[which], None)
+            if item is None:
+                return None
+            items[which].append(item)
+        return items[which][index]
+
+    start = (get(0, 0), get(1, 0))
+    if start[0] is None or start[1] is None:
+        return
+    heap = [(start[0][0] + start[1][0], 0, 0)]
+    seen = {(0, 0)}
+    while heap:
+        cost, i, j = heapq.heappop(heap)
+        yield cost, (items[0][i][1], items[1][j][1])
+        for new in ((i + 1, j), (i, j + 1)):
+            if new in seen:
+                continue
+            left, right = get(0, new[0]), get(1, new[1])
+            if left is not None and right is not None:
+                seen.add(new)
+                heapq.heappush(heap, (left[0] + right[0], new[0], new[1]))
+
+
+def channel_excitations(
+    energies: Sequence[float],
+    ground: str,
+    rank: int,
+    holes: Sequence[int],
+    particles: Sequence[int],
+) -> Iterator[Tuple[float, str]]:
+    """
+    Yields the excitations of exactly rank electrons from ground, as
+    (excitation energy, occupation string) in increasing energy.
+    """
+    occupied = sorted(
+        (hole for hole in holes if ground[hole] == "1"), key=lambda n: -energies[n]
+    )
+    empty = sorted(
+        (particle for particle in particles if ground[particle] == "0"),
+        key=lambda n: energies[n],
+    )
+    hole_costs = [-energies[n] for n in occupied]
+    particle_costs = [energies[n] for n in empty]
+    base = ground.encode("ascii")
+    pairs = cheapest_pairs(
+        cheapest_subsets(hole_costs, rank), cheapest_subsets(particle_costs, rank)
+    )
+    for cost, (hole_set, particle_set) in pairs:
+        state = bytearray(base)
+        for hole in hole_set:
+            state[occupied[hole]] = ord("0")
+        for particle in particle_set:
+            state[empty[particle]] = ord("1")
+        yield cost, state.decode("ascii")
+
+
+def generate_by_energy(
+    alpha_energies: Sequence[float],
+    beta_energies: Sequence[float],
+    alpha_electrons: int,
+    beta_electrons: int,
+    max_rank: int,
+    channel: str = "both",
+    holes: Optional[Sequence[int]] = None,
+    particles: Optional[Sequence[int]] = None,
+) -> Iterator[Tuple[float, str, str]]:
+    """
+    Lazily yields (excitation energy, alpha, beta) for the ground state and
+    its excitations up to max_rank in increasing excitation energy (the sum
+    of the particle energies minus the sum of the hole energies), through a
+    best-first search, so that only the determinants actually taken are
+    ever built; the arguments are as in generate.
+    """
+    states = range(len(alpha_energies))
+    holes = states if holes is None else holes
+    particles = states if particles is None else particles
+    alpha_ground = convert_to_list([1 if n < alpha_electrons else 0 for n in states])
+    beta_ground = convert_to_list([1 if n < beta_electrons else 0 for n in states])
+    streams = []
+    for alpha_rank, beta_rank in rank_pairs(max_rank, channel):
+        alpha = channel_excitations(
+            alpha_energies, alpha_ground, alpha_rank, holes, particles
+        )
+        beta = channel_excitations(
+            beta_energies, beta_ground, beta_rank, holes, particles
+        )
+        streams.append(cheapest_pairs(alpha, beta))
+    for energy, (alpha_state, beta_state) in heapq.merge(
+        *streams, key=lambda item: item[0]
+    ):
+        yield energy, alpha_state, beta_state
+
+
+def write_determinants(
+    determinants: Iterable[Tuple[str, str]],
+    filename: str,
+    buffer_lines: int = BUFFER_LINES,
+) -> int:
+    """
+    Writes a <ci> line for each (alpha, beta) pair, buffer_lines at a time;
+    returns the number of determinants written.
+    """
+    pairs = iter(determinants)
+    count = 0
+    with open(filename, "w") as output_file:
+        while True:
+            with instrument.phase("generate"):
+                chunk = list(islice(pairs, buffer_lines))
+            if not chunk:
+                break
+            with instrument.phase("format"):
+                text = "".join(
+                    f'<ci id="CIcoeff_{count + n}" coeff="1"'
+                    f' alpha="{alpha}" beta="{beta}"/>\n'
+                    for n, (alpha, beta) in enumerate(chunk)
+                )
+            with instrument.phase("write"):
+                output_file.write(text)
+            count += len(chunk)
+    return count
+
+
+def write_binary(
+    determinants: Iterable[Tuple[str, str]],
+    filename: str,
+    buffer_lines: int = BUFFER_LINES,
+) -> int:
+    """
+    Packs the (alpha, beta) pairs buffer_lines at a time and saves them,
+    with unit coefficients, in a binary file (.h5 or .npz, see
+    DetStore.save); returns the number of determinants written.
+    """
+    pairs = iter(determinants)
+    alpha_words, beta_words = [], []
+    norb = 0
+    while True:
+        with instrument.phase("generate"):
+            chunk = list(islice(pairs, buffer_lines))
+        if not chunk:
+            break
+        with instrument.phase("format"):
+            alpha, beta = zip(*chunk)
+            norb = len(alpha[0])
+            alpha_words.append(pack_strings(alpha, norb))
+            beta_words.append(pack_strings(beta, norb))
+    if not alpha_words:
+        raise ValueError("No determinants to write.")
+    store = DetStore(
+        norb, numpy.concatenate(alpha_words), numpy.concatenate(beta_words)
+    )
+    with instrument.phase("write"):
+        store.save(filename)
+    return len(store)
+
+
+def state_range(text: str) -> range:
+    """
+    Converts a FIRST:LAST string (both included) in a range of states.
+    """
+    first, _, last = text.partition(":")
+    return range(int(first), int(last or first) + 1)
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Generates the ground state and all its excitations up to"
+        " a given rank as <ci> lines for a QMCPack detlist."
+    )
+    parser.add_argument("states", type=int, help="number of single particle states")
+    parser.add_argument("electrons", type=int, help="number of alpha electrons")
+    parser.add_argument(
+        "-b", "--beta", type=int, help="number of beta electrons (default as alpha)"
+    )
+    parser.add_argument(
+        "-r", "--rank", type=int, default=1, help="maximum excitation rank (default 1)"
+    )
+    parser.add_argument(
+        "-c",
+        "--channel",
+        choices=CHANNELS,
+        default="both",
+        help="excite only alpha, only beta, or both electrons (also mixed)",
+    )
+    parser.add_argument(
+        "--holes",
+        type=state_range,
+        metavar="FIRST:LAST",
+        help="states that can be emptied (default all)",
+    )
+    parser.add_argument(
+        "--particles",
+        type=state_range,
+        metavar="FIRST:LAST",
+        help="states that can be filled (default all)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="determinants.dat",
+        help="the output file; .h5 or .npz for the binary format",
+    )
+    parser.add_argument(
+        "-e",
+        "--energies",
+        nargs="+",
+        metavar="FILE",
+        help="einspline bandinfo file(s) with the orbital energies (alpha, then"
+        " beta if different): the determinants are written in increasing"
+        " excitation energy",
+    )
+    parser.add_argument(
+        "-k", "--top", type=int, help="with --energies, the K lowest determinants"
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=float,
+        metavar="EMAX",
+        help="with --energies, the determinants with excitation energy up to EMAX",
+    )
+    instrument.add_arguments(parser)
+    parsed = parser.parse_args(args)
+    if (parsed.top is not None or parsed.window is not None) and not parsed.energies:
+        parser.error("--top and --window need --energies")
+    if parsed.energies and len(parsed.energies) > 2:
+        parser.error("--energies takes one or two files")
+    if parsed.beta is None:
+        parsed.beta = parsed.electrons
+    for name in ("electrons", "beta"):
+        if not 0 <= getattr(parsed, name) <= parsed.states:
+            parser.error(f"the number of {name} must be between 0 and {parsed.states}")
+    for name in ("holes", "particles"):
+        active = getattr(parsed, name)
+        if active is not None and (active.start < 0 or active.stop > parsed.states):
+            parser.error(f"the {name} must be between 0 and {parsed.states - 1}")
+    return parsed
+
+
+def generate_selected(args: argparse.Namespace) -> None:
+    """
+    Writes the determinants selected by excitation energy (see parse_args).
+    """
+    alpha_energies = read_energies(args.energies[0])
+    beta_energies = read_energies(args.energies[-1])
+    if min(len(alpha_energies), len(beta_energies)) < args.states:
+        raise ValueError(f"Less than {args.states} energies in {args.energies}.")
+    selected = generate_by_energy(
+        alpha_energies[: args.states],
+        beta_energies[: args.states],
+        args.electrons,
+        args.beta,
+        args.rank,
+        args.channel,
+        args.holes,
+        args.particles,
+    )
+    if args.window is not None:
+        selected = takewhile(lambda item: item[0] <= args.window, selected)
+    if args.top is not None:
+        selected = islice(selected, args.top)
+    last = [0.0]
+
+    def strings() -> Iterator[Tuple[str, str]]:
+        for energy, alpha, beta in selected:
+            last[0] = energy
+            yield alpha, beta
+
+    write = write_binary if is_binary(args.output) else write_determinants
+    count = write(strings(), args.output)
+    print(
+        f"{count} determinants written to {args.output},"
+        f" excitation energies up to {last[0]}"
+    )
+
+
+def main() -> None:
+    """
+    Main function for gen_det: without arguments builds the determinants
+    interactively, otherwise generates them in bulk (see parse_args).
+    """
+    if len(sys.argv) == 1:
+        instrument.setup("gen_det")
+        interactive()
+        return
+    args = parse_args(sys.argv[1:])
+    instrument.setup("gen_det", args.instrument, args.debug)
+    if args.energies:
+        generate_selected(args)
+        return
+    determinants = generate(
+        args.states,
+        args.electrons,
+        args.beta,
+        args.rank,
+        args.channel,
+        args.holes,
+        args.particles,
+    )
+    write = write_binary if is_binary(args.output) else write_determinants
+    count = write(determinants, args.output)
+    print(f"{count} determinants written to {args.output}")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Phase-level instrumentation shared by the tools: code wrapped in
+`with instrument.phase("parse"):` has its wall time, CPU time, bytes read
+and written (from /proc/self/io) and peak resident memory recorded, the
+phases with the same name being summed. Recording is off unless setup is
+given an output file or the QMC_INSTRUMENT environment variable is set, in
+which case a phase costs a few system calls and, at exit, a json line
+summarizing the run (tool, arguments, totals, phases and a trace of the
+phase events) is appended to the file, so that the runs of a batch can be
+collected in one place; the phases run in pool workers are added to the
+totals of their parent (see worker_setup). Run as a script, it aggregates
+such files.
+setup also configures the logging of the tools (debug messages with
+--debug or QMC_LOG_LEVEL=DEBUG).
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import logging
+import argparse
+import resource
+import contextlib
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+ENV_OUTPUT = "QMC_INSTRUMENT"  # json lines file of the run summaries
+ENV_LOG_LEVEL = "QMC_LOG_LEVEL"
+MAX_EVENTS = 10000  # phase events kept in the trace of a run
+COUNTERS = ("wall", "cpu", "read_bytes", "write_bytes")
+
+_DISABLED = contextlib.nullcontext()
+
+
+def peak_rss() -> float:
+    """
+    Returns the peak resident memory of the process in MB, since the last
+    reset_peak if the kernel allows resetting it.
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak() -> None:
+    """
+    Resets the peak resident memory of the process (Linux >= 4.0); elsewhere
+    the peak is that of the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as clear:
+            clear.write("5")
+    except OSError:
+        pass
+
+
+def io_bytes() -> Tuple[int, int]:
+    """
+    Returns the bytes read and written by the process so far (0, 0 where
+    /proc/self/io is not available).
+    """
+    read = written = 0
+    try:
+        with open("/proc/self/io", "r", encoding="utf-8") as counters:
+            for line in counters:
+                if line.startswith("rchar:"):
+                    read = int(line.split()[1])
+                elif line.startswith("wchar:"):
+                    written = int(line.split()[1])
+    except OSError:
+        pass
+    return read, written
+
+
+def _sample() -> Dict[str, float]:
+    """
+    Returns the current value of the counters.
+    """
+    read, written = io_bytes()
+    return {
+        "wall": time.perf_counter(),
+        "cpu": time.process_time(),
+        "read_bytes": read,
+        "write_bytes": written,
+    }
+
+
+class _Phase:
+    """
+    Context manager recording one occurrence of a phase in a Recorder.
+    """
+
+    __slots__ = ("recorder", "name", "start", "peak")
+
+    def __init__(self, recorder: "Recorder", name: str) -> None:
+        self.recorder = recorder
+        self.name = name
+        self.start: Dict[str, float] = {}
+        self.peak = 0.0
+
+    def __enter__(self) -> "_Phase":
+        self.recorder.enter(self)
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.recorder.exit(self)
+
+
+class Recorder:
+    """
+    Defines the record of a run; its members are
+    tool: str, the name of the instrumented tool
+    output: str, the file the summary is appended to ("-" for stderr)
+    start: dict, the counters at the start of the run
+    phases: dict, for each phase name its count, the sums of the counters
+        and the peak memory
+    events: list, (name, start, wall time) of the phases, in order of end
+    dropped: int, the events beyond MAX_EVENTS, not kept in events
+    open: list, the phases being recorded, innermost last
+    peak: float, the peak memory (MB) seen when the phases were reset
+    """
+
+    __slots__ = (
+        "tool",
+        "output",
+        "start",
+        "phases",
+        "events",
+        "dropped",
+        "open",
+        "peak",
+    )
+
+    def __init__(self, tool: str, output: str) -> None:
+        self.tool = tool
+        self.output = output
+        self.start = _sample()
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.events: List[Tuple[str, float, float]] = []
+        self.dropped = 0
+        self.open: List[_Phase] = []
+        self.peak = 0.0
+
+    def phase(self, name: str) -> _Phase:
+        """
+        Returns a context manager recording the phase called name
+        """
+        return _Phase(self, name)
+
+    def _fold_peak(self) -> None:
+        """
+        Passes the current peak memory to the open phases, before it is reset
+        """
+        peak = peak_rss()
+        self.peak = max(self.peak, peak)
+        for open_phase in self.open:
+            open_phase.peak = max(open_phase.peak, peak)
+
+    def enter(self, phase: _Phase) -> None:
+        """
+        Starts recording phase
+        """
+        self._fold_peak()
+        reset_peak()
+        self.open.append(phase)
+        phase.start = _sample()
+
+    def exit(self, phase: _Phase) -> None:
+        """
+        Stops recording phase and adds it to the totals
+        """
+        end = _sample()
+        self._fold_peak()
+        self.open.remove(phase)
+        occurrence = {key: end[key] - phase.start[key] for key in COUNTERS}
+        self.add_phases(
+            {phase.name: {"count": 1, **occurrence, "peak_rss_mb": phase.peak}}
+        )
+        if len(self.events) < MAX_EVENTS:
+            self.events.append(
+                (
+                    phase.name,
+                    round(phase.start["wall"] - self.start["wall"], 6),
+                    round(end["wall"] - phase.start["wall"], 6),
+                )
+            )
+        else:
+            self.dropped += 1
+
+    def take_phases(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the phase totals recorded so far and starts new ones
+        """
+        phases, self.phases = self.phases, {}
+        return phases
+
+    def add_phases(self, phases: Dict[str, Dict[str, float]]) -> None:
+        """
+        Adds phase totals, e.g. those of another process (a pool worker)
+        """
+        for name, values in phases.items():
+            totals = self.phases.setdefault(
+                name, {"count": 0, **{key: 0 for key in COUNTERS}, "peak_rss_mb": 0.0}
+            )
+            totals["count"] += values["count"]
+            for key in COUNTERS:
+                totals[key] += values[key]
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], values["peak_rss_mb"])
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns the summary of the run, as a json serializable dictionary
+        """
+        end = _sample()
+        return {
+            "tool": self.tool,
+            "argv": sys.argv,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "start": time.strftime(
+                "%Y-%m-%dT%H:%M:%S",
+                time.localtime(time.time() - (end["wall"] - self.start["wall"])),
+            ),
+            **{key: end[key] - self.start[key] for key in COUNTERS},
+            "peak_rss_mb": max(self.peak, peak_rss()),
+            "phases": self.phases,
+            "events": self.events,
+            "dropped_events": self.dropped,
+        }
+
+    def write(self) -> None:
+        """
+        Appends the summary of the run, as a json line, to the output file
+        """
+        line = json.dumps(self.summary()) + "\n"
+        if self.output == "-":
+            sys.stderr.write(line)
+            return
+        # a single append, so that concurrent runs do not mix their lines
+        fd = os.open(self.output, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+_recorder: Optional[Recorder] = None
+
+
+def setup(tool: str, output: Optional[str] = None, debug: bool = False) -> None:
+    """
+    Configures the logging of the tools (debug level if debug is set, else
+    the one in QMC_LOG_LEVEL, else warnings) and, if output or the
+    QMC_INSTRUMENT environment variable give a file, starts recording the
+    phases of the run, whose summary is appended to the file at exit.
+    """
+    global _recorder
+    level = "DEBUG" if debug else os.environ.get(ENV_LOG_LEVEL, "WARNING").upper()
+    known = level in logging.getLevelNamesMapping()
+    logging.basicConfig(
+        level=level if known else "WARNING", format="%(name)s: %(message)s"
+    )
+    if not known:
+        logging.getLogger("instrument").warning(
+            "unknown %s=%s, using WARNING", ENV_LOG_LEVEL, level
+        )
+    output = output or os.environ.get(ENV_OUTPUT)
+    if output and _recorder is None:
+        _recorder = Recorder(tool, output)
+        atexit.register(_recorder.write)
+
+
+def enabled() -> bool:
+    """
+    Returns whether the phases are being recorded.
+    """
+    return _recorder is not None
+
+
+def worker_setup(enable: bool, tool: str = "worker") -> None:
+    """
+    Pool initializer: records the phases of the worker if enable is set
+    (pass enabled() from the parent), without the phases inherited from
+    the parent and without writing a summary; the worker returns them
+    with take_phases, for the parent to pass to add_phases.
+    """
+    global _recorder
+    _recorder = Recorder(tool, "") if enable else None
+
+
+def take_phases() -> Dict[str, Dict[str, float]]:
+    """
+    Returns the phase totals recorded so far by this process, and clears
+    them (empty if the recording is off).
+    """
+    if _recorder is None:
+        return {}
+    return _recorder.take_phases()
+
+
+def add_phases(phases: Dict[str, Dict[str, float]]) -> None:
+    """
+    Adds the phase totals returned by take_phases in another process.
+    """
+    if _recorder is not None:
+        _recorder.add_phases(phases)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the --instrument and --debug options of setup to parser.
+    """
+    parser.add_argument(
+        "--instrument",
+        metavar="FILE",
+        help=f"append a json summary of the phases of the run to FILE"
+        f" (also {ENV_OUTPUT}=FILE); the phases of worker processes are"
+        " summed into the totals, but not traced as events",
+    )
+    parser.add_argument("--debug", action="store_true", help="print debug messages")
+
+
+def phase(name: str) -> ContextManager:
+    """
+    Returns a context manager recording the phase called name, or doing
+    nothing if the recording is off.
+    """
+    if _recorder is None:
+        return _DISABLED
+    return _recorder.phase(name)
+
+
+def aggregate(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Sums the counters of the runs for each tool and phase ("total" for the
+    whole run); also keeps the number of runs and the largest peak memory.
+    """
+    tools: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        phases = tools.setdefault(record["tool"], {})
+        entries = [("total", record, 1)]
+        entries += [
+            (name, values, values["count"]) for name, values in record["phases"].items()
+        ]
+        for name, values, count in entries:
+            totals = phases.setdefault(
+                name,
+                {
+                    "runs": 0,
+                    "count": 0,
+                    **{key: 0 for key in COUNTERS},
+                    "peak_rss_mb": 0.0,
+                },
+            )
+            totals["runs"] += 1
+            totals["count"] += count
+            for key in COUNTERS:
+                totals[key] += values[key]
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], values["peak_rss_mb"])
+    return tools
+
+
+def read_records(files: List[str]) -> List[Dict[str, Any]]:
+    """
+    Reads the run summaries (json lines) of the files.
+    """
+    records = []
+    for filename in files:
+        with open(filename, "r", encoding="utf-8") as file_in:
+            records.extend(json.loads(line) for line in file_in if line.strip())
+    return records
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Main function: prints (or writes as json) the totals of the runs
+    recorded in the files, per tool and phase.
+    """
+    parser = argparse.ArgumentParser(
+        description="Aggregates the run summaries written by the tools when"
+        f" instrumented (--instrument FILE or {ENV_OUTPUT}=FILE)."
+    )
+    parser.add_argument("files", nargs="+", help="the json lines files")
+    parser.add_argument("-j", "--json", help="also write the totals to this file")
+    parsed = parser.parse_args(args)
+
+    records = read_records(parsed.files)
+    tools = aggregate(records)
+    print(f"{len(records)} runs")
+    for tool, phases in tools.items():
+        print(f"\n{tool}")
+        print(
+            f"{'phase':12s} {'runs':>6s} {'count':>8s} {'wall (s)':>10s}"
+            f" {'cpu (s)':>10s} {'read (MB)':>10s} {'written (MB)':>12s}"
+            f" {'peak (MB)':>10s}"
+        )
+        for name, totals in phases.items():
+            print(
+                f"{name:12s} {totals['runs']:6d} {totals['count']:8d}"
+                f" {totals['wall']:10.3f} {totals['cpu']:10.3f}"
+                f" {totals['read_bytes'] / 1e6:10.1f}"
+                f" {totals['write_bytes'] / 1e6:12.1f} {totals['peak_rss_mb']:10.1f}"
+            )
+    if parsed.json:
+        with open(parsed.json, "w", encoding="utf-8") as file_out:
+            json.dump(tools, file_out, indent=1)
+        print(f"Totals written to {parsed.json}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
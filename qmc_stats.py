@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+"""
+Statistics of QMCPack scalar.dat/dmc.dat outputs, read directly from the
+files: every column is fed to an online binary blocking accumulator
+(Flyvbjerg-Petersen), which keeps a few sums per block size 2^k, so that
+the memory grows as log(N) and arbitrarily long (or still growing) series
+are analyzed in a single streaming pass. Data can be weighted (the
+BlockWeight or Weight column by default), and the accumulators of several
+runs can be merged, or saved and resumed when a file grows.
+Alternatively (--method fft) the series are kept in memory and their
+autocorrelation functions are computed by FFT for all the columns at once,
+the integrated correlation time being summed over a self-consistent window.
+"""
+import os
+import sys
+import argparse
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy
+import numpy.typing as npt
+
+CHUNK_SIZE = 1 << 22  # bytes of data parsed at a time
+MIN_BLOCKS = 32  # blocking levels with fewer blocks are not used for the plateau
+WEIGHT_COLUMNS = ("BlockWeight", "Weight")
+WINDOW_C = 5.0  # the correlation time is summed up to lags of WINDOW_C * tau
+MIN_LAGS = 256  # first number of lags tried for the window
+SEGMENT = 1 << 12  # length of the FFTs, at least 8 times the lags
+FFT_BYTES = 1 << 26  # memory used by the FFT of a batch of segments
+STATE = (
+    "count",
+    "weight",
+    "weight2",
+    "sums",
+    "squares",
+    "pending",
+    "pending_weight",
+    "pending_sums",
+)
+
+
+class BlockingAccumulator:
+    """
+    Online binary blocking of a weighted series of ncols columns: at level k
+    the blocks hold 2^k consecutive samples; for each level its members keep
+    count: (nlevels,) array, the number of complete blocks
+    weight: (nlevels,) array, the sum of the block weights W
+    weight2: (nlevels,) array, the sum of W^2
+    sums: (nlevels, ncols) array, the sum of W*m (m the block averages)
+    squares: (nlevels, ncols) array, the sum of W*m^2
+    pending: bool array, True if a block is waiting for the next one
+    pending_weight, pending_sums: the weight and W*m of that block
+    """
+
+    def __init__(self, ncols: int) -> None:
+        self.ncols = ncols
+        self.count = numpy.zeros(0, dtype=numpy.int64)
+        self.weight = numpy.zeros(0)
+        self.weight2 = numpy.zeros(0)
+        self.sums = numpy.zeros((0, ncols))
+        self.squares = numpy.zeros((0, ncols))
+        self.pending = numpy.zeros(0, dtype=bool)
+        self.pending_weight = numpy.zeros(0)
+        self.pending_sums = numpy.zeros((0, ncols))
+
+    @property
+    def nlevels(self) -> int:
+        return len(self.count)
+
+    def _grow(self, nlevels: int) -> None:
+        """
+        Adds empty levels up to nlevels.
+        """
+        extra = nlevels - self.nlevels
+        if extra <= 0:
+            return
+        for name in ("count", "weight", "weight2", "pending", "pending_weight"):
+            array = getattr(self, name)
+            setattr(
+                self, name, numpy.concatenate((array, numpy.zeros(extra, array.dtype)))
+            )
+        for name in ("sums", "squares", "pending_sums"):
+            array = getattr(self, name)
+            setattr(self, name, numpy.vstack((array, numpy.zeros((extra, self.ncols)))))
+
+    def add(self, values: npt.NDArray, weights: Optional[npt.NDArray] = None) -> None:
+        """
+        Adds the (nsamples, ncols) values, with the given weights (1 if None);
+        the new blocks of each level are handled at once, so the cost is
+        linear in nsamples.
+        """
+        values = numpy.asarray(values, dtype=float).reshape(-1, self.ncols)
+        weight = (
+            numpy.ones(len(values))
+            if weights is None
+            else numpy.asarray(weights, dtype=float)
+        )
+        sums = values * weight[:, None]
+        level = 0
+        while len(weight):
+            self._grow(level + 1)
+            self.count[level] += len(weight)
+            self.weight[level] += weight.sum()
+            self.weight2[level] += numpy.dot(weight, weight)
+            self.sums[level] += sums.sum(axis=0)
+            nonzero = weight > 0
+            self.squares[level] += (sums[nonzero] ** 2 / weight[nonzero, None]).sum(
+                axis=0
+            )
+            # the block left from the previous call comes first
+            if self.pending[level]:
+                weight = numpy.concatenate(([self.pending_weight[level]], weight))
+                sums = numpy.vstack((self.pending_sums[level], sums))
+                self.pending[level] = False
+            if len(weight) % 2:
+                self.pending[level] = True
+                self.pending_weight[level] = weight[-1]
+                self.pending_sums[level] = sums[-1]
+                weight, sums = weight[:-1], sums[:-1]
+            weight = weight[0::2] + weight[1::2]
+            sums = sums[0::2] + sums[1::2]
+            level += 1
+
+    def merge(self, other: "BlockingAccumulator") -> None:
+        """
+        Adds the blocks of an independent run; its incomplete blocks are not
+        joined to the ones of this run (their samples are already counted
+        in the lower levels).
+        """
+        if other.ncols != self.ncols:
+            raise ValueError(f"Cannot merge {other.ncols} columns with {self.ncols}.")
+        self._grow(other.nlevels)
+        levels = other.nlevels
+        for name in ("count", "weight", "weight2", "sums", "squares"):
+            getattr(self, name)[:levels] += getattr(other, name)
+
+    def mean(self) -> npt.NDArray:
+        """
+        Returns the weighted average of each column.
+        """
+        return self.sums[0] / self.weight[0]
+
+    def errors(self) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Returns the (nlevels, ncols) error of the mean estimated from the
+        blocks of each level, and its own uncertainty; nan for the levels
+        with less than two blocks.
+        """
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mean = self.sums / self.weight[:, None]
+            variance = numpy.maximum(
+                self.squares / self.weight[:, None] - mean**2, 0.0
+            )
+            neff = self.weight**2 / self.weight2
+            errors = numpy.sqrt(variance / (neff - 1.0)[:, None])
+            spread = errors / numpy.sqrt(2.0 * (self.count - 1.0))[:, None]
+        errors[self.count < 2] = numpy.nan
+        spread[self.count < 2] = numpy.nan
+        return errors, spread
+
+    def plateau(
+        self, min_blocks: int = MIN_BLOCKS
+    ) -> Tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+        """
+        Returns, for each column, the error at the first level where it
+        stops growing (the next two levels are within their uncertainty),
+        that level, and whether such a plateau was found among the levels
+        with at least min_blocks blocks (else the last of them is used).
+        """
+        errors, spread = self.errors()
+        usable = max(int(numpy.count_nonzero(self.count >= min_blocks)), 1)
+        level = numpy.full(self.ncols, usable - 1)
+        converged = numpy.zeros(self.ncols, dtype=bool)
+        for k in range(usable - 2, -1, -1):
+            flat = numpy.ones(self.ncols, dtype=bool)
+            for j in range(k + 1, min(k + 3, usable)):
+                flat &= numpy.abs(errors[j] - errors[k]) <= spread[j]
+            level[flat] = k
+            converged |= flat
+        columns = numpy.arange(self.ncols)
+        return errors[level, columns], level, converged
+
+    def state(self) -> Dict[str, npt.NDArray]:
+        """
+        Returns the arrays describing the accumulator.
+        """
+        return {name: getattr(self, name) for name in STATE}
+
+    @classmethod
+    def from_state(cls, arrays: Dict[str, npt.NDArray]) -> "BlockingAccumulator":
+        """
+        Builds an accumulator from the arrays returned by state.
+        """
+        accumulator = cls(arrays["sums"].shape[1])
+        for name in STATE:
+            setattr(accumulator, name, numpy.array(arrays[name]))
+        return accumulator
+
+
+def save_state(
+    filename: str,
+    files: List[str],
+    columns: List[str],
+    accumulators: List[BlockingAccumulator],
+    offsets: List[int],
+    rows_read: List[int],
+) -> None:
+    """
+    Saves the accumulators of the files, and where they were left, in a .npz file.
+    """
+    arrays = {
+        "files": numpy.array(files),
+        "columns": numpy.array(columns),
+        "offsets": numpy.array(offsets),
+        "rows_read": numpy.array(rows_read),
+    }
+    for n, accumulator in enumerate(accumulators):
+        for name, array in accumulator.state().items():
+            arrays[f"{name}_{n}"] = array
+    numpy.savez(filename, **arrays)
+
+
+def load_state(
+    filename: str, files: List[str], columns: List[str]
+) -> Tuple[List[BlockingAccumulator], List[int], List[int]]:
+    """
+    Reads the state written by save_state, checking that it refers to the
+    same files and columns.
+    """
+    with numpy.load(filename) as data:
+        arrays = {name: data[name] for name in data.files}
+    if arrays["files"].tolist() != files or arrays["columns"].tolist() != columns:
+        raise ValueError(f"The state in {filename} is for other files or columns.")
+    accumulators = [
+        BlockingAccumulator.from_state({name: arrays[f"{name}_{n}"] for name in STATE})
+        for n in range(len(files))
+    ]
+    return accumulators, arrays["offsets"].tolist(), arrays["rows_read"].tolist()
+
+
+def read_header(filename: str) -> List[str]:
+    """
+    Returns the column names of a QMCPack .dat file (from its # header line,
+    else col0, col1...).
+    """
+    with open(filename, "r") as file_in:
+        line = file_in.readline()
+        while line and not line.strip():
+            line = file_in.readline()
+    if line.startswith("#"):
+        return line[1:].split()
+    return [f"col{n}" for n in range(len(line.split()))]
+
+
+def parse_rows(text: bytes, ncols: int, filename: str) -> Optional[npt.NDArray]:
+    """
+    Returns the rows in text (lines of a .dat file) as an (nrows, ncols)
+    array, or None if it only has comments and blank lines.
+    """
+    if b"#" in text:
+        text = b"".join(
+            line for line in text.splitlines(True) if not line.lstrip().startswith(b"#")
+        )
+    if not text.strip():
+        return None
+    values = numpy.fromstring(text.decode(), sep=" ")
+    if values.size % ncols:
+        raise ValueError(f"Rows of {filename} do not have {ncols} columns.")
+    return values.reshape(-1, ncols)
+
+
+def iter_rows(
+    filename: str,
+    ncols: int,
+    offset: int = 0,
+    chunk_size: int = CHUNK_SIZE,
+    partial: bool = True,
+) -> Iterator[Tuple[npt.NDArray, int]]:
+    """
+    Yields the rows of a .dat file, a chunk of complete lines at a time,
+    starting from the byte offset, as an (nrows, ncols) array and the
+    offset after the last line read; comment lines are skipped.
+    A last line without a newline is read if partial is set, else it is
+    left (and the offset before it) for when the file is appended to.
+    """
+    with open(filename, "rb") as file_in:
+        file_in.seek(offset)
+        rest = b""
+        for chunk in iter(lambda: file_in.read(chunk_size), b""):
+            chunk = rest + chunk
+            end = chunk.rfind(b"\n") + 1
+            text, rest = chunk[:end], chunk[end:]
+            offset += end
+            rows = parse_rows(text, ncols, filename)
+            if rows is not None:
+                yield rows, offset
+        if partial and rest:
+            rows = parse_rows(rest, ncols, filename)
+            if rows is not None:
+                yield rows, offset + len(rest)
+
+
+def accumulate(
+    filename: str,
+    columns: List[int],
+    weight_column: Optional[int],
+    equilibration: int = 0,
+    accumulator: Optional[BlockingAccumulator] = None,
+    offset: int = 0,
+    rows_read: int = 0,
+    partial: bool = True,
+) -> Tuple[BlockingAccumulator, int, int]:
+    """
+    Feeds the rows of filename (from the byte offset, rows_read rows being
+    already read) to the accumulator, skipping the first equilibration
+    rows; returns the accumulator, the new offset and the rows read.
+    A last line without a newline is only read if partial is set (see
+    iter_rows).
+    """
+    ncols = len(read_header(filename))
+    if accumulator is None:
+        accumulator = BlockingAccumulator(len(columns))
+    for rows, offset in iter_rows(filename, ncols, offset, partial=partial):
+        skip = min(max(equilibration - rows_read, 0), len(rows))
+        rows_read += len(rows)
+        rows = rows[skip:]
+        weights = None if weight_column is None else rows[:, weight_column]
+        accumulator.add(rows[:, columns], weights)
+    return accumulator, offset, rows_read
+
+
+def read_series(
+    filename: str,
+    columns: List[int],
+    weight_column: Optional[int],
+    equilibration: int = 0,
+) -> Tuple[npt.NDArray, Optional[npt.NDArray]]:
+    """
+    Returns the (nsamples, ncols) values of the columns of filename, after
+    the first equilibration rows, and their weights (None if unweighted).
+    """
+    ncols = len(read_header(filename))
+    chunks = [rows for rows, _ in iter_rows(filename, ncols)]
+    rows = numpy.concatenate(chunks) if chunks else numpy.zeros((0, ncols))
+    rows = rows[equilibration:]
+    weights = None if weight_column is None else rows[:, weight_column].copy()
+    return rows[:, columns], weights
+
+
+def lagged_sums(series: npt.NDArray, max_lag: int) -> npt.NDArray:
+    """
+    Returns the (max_lag, ncols) sums over k of x[k] * x[k + t] for each
+    lag t < max_lag and column of the (nsamples, ncols) series, through
+    FFTs of segments (each correlated with itself and the first max_lag
+    samples of the next one), so that the cost is O(N log(max_lag)).
+    """
+    nsamples, ncols = series.shape
+    # FFTs of a power of two length, most of it filled by the segment
+    nfft = max(SEGMENT, 1 << (8 * max_lag - 1).bit_length())
+    segment = nfft - max_lag
+    nsegments = -(-nsamples // segment)
+    batch = max(FFT_BYTES // (16 * nfft * ncols), 1)
+    sums = numpy.zeros((ncols, max_lag))
+    window = numpy.arange(segment + max_lag)
+    for first in range(0, nsegments, batch):
+        last = min(first + batch, nsegments)
+        # the samples of the batch plus max_lag, zero padded at the end, with
+        # the samples of each column contiguous for the FFTs
+        padded = numpy.zeros((ncols, (last - first) * segment + max_lag))
+        chunk = series[first * segment : last * segment + max_lag]
+        padded[:, : len(chunk)] = chunk.T
+        heads = padded[:, : (last - first) * segment].reshape(ncols, -1, segment)
+        tails = padded[:, numpy.arange(last - first)[:, None] * segment + window]
+        spectrum = numpy.conj(numpy.fft.rfft(heads, nfft))
+        spectrum *= numpy.fft.rfft(tails, nfft)
+        sums += numpy.fft.irfft(spectrum, nfft)[..., :max_lag].sum(axis=1)
+    return sums.T
+
+
+def autocorrelation(
+    series: List[Tuple[npt.NDArray, Optional[npt.NDArray]]], max_lag: int
+) -> Tuple[npt.NDArray, npt.NDArray, npt.NDArray, float]:
+    """
+    Returns the weighted autocorrelation functions rho(t), t < max_lag, of
+    the columns of the runs in series (independent, so their lagged sums
+    are added), as in stats.cpp: sum_k sqrt(w_k w_k+t) dv_k dv_k+t divided
+    by sum_k sqrt(w_k w_k+t), normalized to rho(0) = 1. Also returns the
+    weighted mean and variance of each column and the effective number of
+    samples (sum w)^2 / sum w^2.
+    """
+    ncols = series[0][0].shape[1]
+    roots = [
+        numpy.ones(len(values)) if weights is None else numpy.sqrt(weights)
+        for values, weights in series
+    ]
+    total = sum(numpy.dot(root, root) for root in roots)
+    weight2 = sum(numpy.dot(root**2, root**2) for root in roots)
+    mean = sum(root**2 @ values for root, (values, _) in zip(roots, series)) / total
+    denominator = numpy.zeros(max_lag)
+    for root in roots:
+        lags = min(max_lag, len(root))
+        denominator[:lags] += lagged_sums(root[:, None], lags)[:, 0]
+    # a few columns at a time, to bound the memory used by the deviations
+    longest = max(len(root) for root in roots)
+    group = max(FFT_BYTES // (8 * longest), 1)
+    numerator = numpy.zeros((max_lag, ncols))
+    for start in range(0, ncols, group):
+        columns = slice(start, start + group)
+        for root, (values, _) in zip(roots, series):
+            deviations = values[:, columns] - mean[columns]
+            deviations *= root[:, None]
+            lags = min(max_lag, len(root))
+            numerator[:lags, columns] += lagged_sums(deviations, lags)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        covariance = numerator / denominator[:, None]
+        rho = covariance / covariance[0]
+    rho[denominator == 0] = 0.0
+    neff = total**2 / weight2
+    # the lag 0 sums are the weighted squared deviations
+    variance = numerator[0] / total * neff / (neff - 1.0)
+    return rho, mean, variance, neff
+
+
+def correlation_analysis(
+    series: List[Tuple[npt.NDArray, Optional[npt.NDArray]]], c: float = WINDOW_C
+) -> Dict[str, npt.NDArray]:
+    """
+    Returns mean, error, correlation time tau = 1 + 2 sum_t rho(t) and
+    effective number of independent samples of each column; the sum over t
+    stops at the first window M >= c * tau(M) (Sokal's self-consistent
+    window), the number of lags computed being doubled until all columns
+    have their window (or half the length of the longest run is reached).
+    """
+    longest = max(len(values) for values, _ in series)
+    max_lag = min(MIN_LAGS, longest)
+    while True:
+        rho, mean, variance, neff = autocorrelation(series, max_lag)
+        taus = 1.0 + 2.0 * numpy.cumsum(rho[1:], axis=0)
+        lags = numpy.arange(1, max_lag)[:, None]
+        inside = lags >= c * taus
+        found = inside.any(axis=0)
+        if found.all() or 2 * max_lag > longest // 2:
+            break
+        max_lag *= 2
+    window = numpy.where(found, inside.argmax(axis=0) + 1, max_lag - 1)
+    tau = numpy.maximum(taus[window - 1, numpy.arange(len(mean))], 1.0)
+    return {
+        "mean": mean,
+        "error": numpy.sqrt(variance * tau / neff),
+        "tau": tau,
+        "neff": neff / tau,
+        "window": window,
+        "converged": found,
+        "rho": rho,
+    }
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Mean and (reblocked) error of the columns of QMCPack"
+        " scalar.dat/dmc.dat files; several files are merged as independent runs."
+    )
+    parser.add_argument("files", nargs="+", help="the .dat files")
+    parser.add_argument(
+        "-e", "--equilibration", type=int, default=0, help="rows skipped in each file"
+    )
+    parser.add_argument(
+        "-c",
+        "--columns",
+        nargs="+",
+        help="the columns analyzed (default all but index and the weights)",
+    )
+    parser.add_argument(
+        "-w",
+        "--weight",
+        help="the weight column (default BlockWeight or Weight if present);"
+        " 'none' for unweighted data",
+    )
+    parser.add_argument(
+        "--state",
+        help="a .npz file with the state of the analysis: if present the files"
+        " are read from where they were left, and it is updated",
+    )
+    parser.add_argument(
+        "--blocks", help="write the error for each block size to this file"
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        choices=("blocking", "fft"),
+        default="blocking",
+        help="streaming blocking analysis, or FFT autocorrelation functions"
+        " with automatic windowing (the data are kept in memory)",
+    )
+    parser.add_argument(
+        "--corr", help="with --method fft, write the autocorrelation functions here"
+    )
+    return parser.parse_args(args)
+
+
+def report(
+    accumulator: BlockingAccumulator, names: List[str], blocks: Optional[str] = None
+) -> None:
+    """
+    Prints mean, reblocked error, naive error and correlation time (the
+    squared ratio of the two errors) of each column; optionally writes the
+    error for each block size.
+    """
+    mean = accumulator.mean()
+    errors, _ = accumulator.errors()
+    error, level, converged = accumulator.plateau()
+    tau = (error / errors[0]) ** 2
+    print(f"{int(accumulator.count[0])} samples")
+    print(
+        f"{'Column':<20} {'Mean':>18} {'Error':>12} {'Naive error':>12}"
+        f" {'Tau':>8} {'Block':>8}"
+    )
+    for n, name in enumerate(names):
+        flag = "" if converged[n] else "  * no plateau"
+        print(
+            f"{name:<20} {mean[n]:>18.10g} {error[n]:>12.4e} {errors[0, n]:>12.4e}"
+            f" {tau[n]:>8.2f} {2 ** int(level[n]):>8d}{flag}"
+        )
+    if blocks:
+        with open(blocks, "w") as file_out:
+            file_out.write("# block_size nblocks " + " ".join(names) + "\n")
+            for k in range(accumulator.nlevels):
+                if accumulator.count[k] < 2:
+                    break
+                values = " ".join(f"{error:.8e}" for error in errors[k])
+                file_out.write(f"{2 ** k} {accumulator.count[k]} {values}\n")
+        print(f"Errors by block size written to {blocks}")
+
+
+def report_correlation(
+    results: Dict[str, npt.NDArray], names: List[str], corr: Optional[str] = None
+) -> None:
+    """
+    Prints mean, error, correlation time, effective samples and window of
+    each column; optionally writes the autocorrelation functions.
+    """
+    print(
+        f"{'Column':<20} {'Mean':>18} {'Error':>12} {'Tau':>8}"
+        f" {'N_eff':>12} {'Window':>8}"
+    )
+    for n, name in enumerate(names):
+        flag = "" if results["converged"][n] else "  * no window"
+        print(
+            f"{name:<20} {results['mean'][n]:>18.10g} {results['error'][n]:>12.4e}"
+            f" {results['tau'][n]:>8.2f} {results['neff'][n]:>12.1f}"
+            f" {int(results['window'][n]):>8d}{flag}"
+        )
+    if corr:
+        rho = results["rho"]
+        numpy.savetxt(
+            corr,
+            numpy.column_stack((numpy.arange(len(rho)), rho)),
+            fmt=["%d"] + ["%.8e"] * rho.shape[1],
+            header="lag " + " ".join(names),
+        )
+        print(f"Autocorrelation functions written to {corr}")
+
+
+def main() -> None:
+    """
+    Main function: reads the files (or their new rows, with --state) and
+    prints the table of the results.
+    """
+    args = parse_args(sys.argv[1:])
+    names = read_header(args.files[0])
+    if args.weight is None:
+        weight_name = next((name for name in WEIGHT_COLUMNS if name in names), None)
+    else:
+        weight_name = None if args.weight.lower() == "none" else args.weight
+    selected = args.columns or [
+        name for name in names if name not in ("index", weight_name)
+    ]
+    for name in selected + ([weight_name] if weight_name else []):
+        if name not in names:
+            raise ValueError(f"No column {name} in {args.files[0]}.")
+    columns = [names.index(name) for name in selected]
+    weight_column = names.index(weight_name) if weight_name else None
+    if weight_name:
+        print(f"Weights from the {weight_name} column")
+
+    if args.method == "fft":
+        if args.state:
+            raise ValueError("--state needs the streaming (blocking) method.")
+        series = [
+            read_series(filename, columns, weight_column, args.equilibration)
+            for filename in args.files
+        ]
+        print(f"{sum(len(values) for values, _ in series)} samples")
+        report_correlation(correlation_analysis(series), selected, args.corr)
+        return
+    nfiles = len(args.files)
+    accumulators: List[Optional[BlockingAccumulator]] = [None] * nfiles
+    offsets, rows_read = [0] * nfiles, [0] * nfiles
+    if args.state and os.path.exists(args.state):
+        loaded, offsets, rows_read = load_state(args.state, args.files, selected)
+        accumulators = list(loaded)
+    for n, filename in enumerate(args.files):
+        accumulators[n], offsets[n], rows_read[n] = accumulate(
+            filename,
+            columns,
+            weight_column,
+            args.equilibration,
+            accumulators[n],
+            offsets[n],
+            rows_read[n],
+            # an unfinished last line is read once complete, in a later run
+            partial=not args.state,
+        )
+    done = [accumulator for accumulator in accumulators if accumulator is not None]
+    if args.state:
+        save_state(args.state, args.files, selected, done, offsets, rows_read)
+    total = BlockingAccumulator(len(columns))
+    for accumulator in done:
+        total.merge(accumulator)
+    report(total, selected, args.blocks)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,160 +1,441 @@
 #!/usr/bin/env python3
+"""
+Generates basic QMCPack input files (VMC, DMC or wave function optimization).
+The templates can be used without a display: render and write_input build a
+single input from a dict of parameters, write_sweep expands a grid of
+parameters (e.g. timestep x walkers x method) into one input per point plus
+a job-array manifest. estimate_cost reads the electron and determinant
+counts from the system and wave function files and estimates the size and
+cost of a run. Without arguments the tkinter GUI is launched (see
+qmcpack_input_gui.py, imported only then).
+"""
+import os
+import sys
+import math
+import argparse
+from functools import lru_cache
+from itertools import product
+from xml.etree import ElementTree
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-import tkinter as tk
-from tkinter import ttk
-
-default_dict = {'name':'test'}
-pack_opt = {'fill':'x','expand':True, 'padx':10}
-
-class InpBuilder(tk.Tk):
-    def __init__(self):
-        super().__init__()
-
-        self.data = dict()
-        self.methods = ('Variational Monte Carlo','Diffusion Monte Carlo','Wave function optimization')
-
-        run_name = tk.StringVar()
-        run_num  = tk.StringVar()
-        sys_file = tk.StringVar()
-        ham_file = tk.StringVar()
-        wf_file  = tk.StringVar()
-        method = tk.StringVar()
-        n_blocks = tk.StringVar()
-        n_steps  = tk.StringVar()
-        timestep = tk.StringVar()
-        walkers  = tk.StringVar()
-        warmup  = tk.StringVar()
-        substeps  = tk.StringVar()
-
-        self.make_title()
-        self.data_entry("Run name:",run_name,"test",True)
-        self.data_entry("Run number:",run_num,"0")
-        self.data_entry("System file:",sys_file,".ptcl.xml")
-        self.data_entry("Hamiltonian file:",ham_file,".ham.xml")
-        self.data_entry("Wave function file:",wf_file,".wfs.xml")
-
-        self.method_label = ttk.Label(self, text="QMC method:")
-        self.method_label.pack(pack_opt,pady=(10,0))
-        self.method_menu = ttk.OptionMenu(self,method,self.methods[0],*self.methods)
-        self.method_menu.pack(pack_opt)
-
-        self.data_entry("Blocks:",n_blocks,"10")
-        self.data_entry("Steps:",n_steps,"100")
-        self.data_entry("Substeps:",substeps,"1")
-        self.data_entry("Warmup steps:",warmup,"10")
-        self.data_entry("Timestep:",timestep,"1.0")
-        self.data_entry("Walkers:",walkers,"1")
-
-        self.data['name'] = run_name
-        self.data['num']  = run_num
-        self.data['sys']  = sys_file
-        self.data['ham']  = ham_file
-        self.data['wf']   = wf_file
-        self.data['method'] = method
-        self.data['blocks'] = n_blocks
-        self.data['steps']  = n_steps
-        self.data['timestep'] = timestep
-        self.data['walkers']  = walkers
-        self.data['warmup']  = warmup
-        self.data['substeps'] = substeps
-
-        self.button = ttk.Button(self, text=f"Save file")
-        self.button['command']= self.print_file
-        self.button.pack(pack_opt,pady=(20,10))
-
-    def make_title(self):
-        self.label = ttk.Label(self,text='Input generator for QMCPack', font = ('Helvetica',14,'bold'),padding=5).pack()
-        self.label2= ttk.Label(self,text='The files with information on the system and wave function are' 
-             ' assumed to be created with the pw2qmcpack script!', font = ('Helvetica',12),padding=5, wraplength=600).pack()
-        self.title("QMCPack input generator")
-        self.bind('<Control-q>', lambda x:self.destroy())
-        self.bind('<Control-w>', lambda x:self.destroy())
-
-    def data_entry(self,descr,variable,default=None,toFocus=False):
-        label = ttk.Label(self, text=descr)
-        if default:
-            variable.set(default)
-        label.pack(pack_opt,pady=(10,0))
-        entry = ttk.Entry(self, textvariable=variable)
-        entry.pack(pack_opt)
-        if toFocus:
-            entry.focus()
-
-    def print_file(self):
-        name = self.data['name'].get()
-        num = self.data['num'].get()
-        sys = self.data['sys'].get()
-        ham = self.data['ham'].get()
-        wf = self.data['wf'].get()
-        method = self.data['method'].get()
-        blocks = self.data['blocks'].get()
-        steps  = self.data['steps'].get()
-        timestep = self.data['timestep'].get()
-        walkers  = self.data['walkers'].get()
-        warmup  = self.data['warmup'].get()
-        substeps  = self.data['substeps'].get()
-
-        with open(name+'.in.xml','w') as fileout:
-            fileout.write(f'<?xml version="1.0"?>\n')
-            fileout.write(f'<simulation>\n')
-            fileout.write(f'\n')
-            fileout.write(f'  <project id={name} series={num}>\n')
-            fileout.write(f'    <application name="qmcpack" role="molecu" class="serial" version="1.0"/>\n')
-            fileout.write(f'  </project>\n')
-            fileout.write(f'\n')
-            fileout.write(f'  <include href="{sys}"/>\n')
-            fileout.write(f'  <include href="{ham}"/>\n')
-            fileout.write(f'  <include href="{wf}"/>\n')
-            fileout.write(f'\n')
-            if method=="Variational Monte Carlo":
-                fileout.write(f'  <qmc method="vmc" move="pbyp" checkpoint="0">\n')
-                fileout.write(f'    <parameter name="warmupsteps">  {warmup:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="blocks"     >  {blocks:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="steps"      >  {steps:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="substeps"   >  {substeps:4}  </parameter> \n')
-                fileout.write(f'    <parameter name="timestep"   >  {timestep:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="walkers"    >  {walkers:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="usedrift"   >   yes  </parameter>\n')
-                fileout.write(f'  </qmc>\n')
-            elif method=="Diffusion Monte Carlo":
-                fileout.write(f'  <qmc method="dmc" move="pbyp" checkpoint="0">\n')
-                fileout.write(f'    <parameter name="warmupsteps"   >  {warmup:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="blocks"        >  {blocks:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="steps"         >  {steps:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="substeps"      >  {substeps:4}  </parameter> \n')
-                fileout.write(f'    <parameter name="timestep"      >  {timestep:4}  </parameter>\n')
-                fileout.write(f'    <parameter name="targetwalkers" >  {walkers:4}  </parameter>\n')
-                fileout.write(f'  </qmc>\n')
-            elif method=="Wave function optimization":
-                fileout.write(f'  <loop max="10">\n')
-                fileout.write(f'    <qmc method="linear" move="pbyp" checkpoint="0">\n')
-                fileout.write(f'      <parameter name="warmupsteps">  {warmup:4}  </parameter>\n')
-                fileout.write(f'      <parameter name="blocks"     >  {blocks:4}  </parameter>\n')
-                fileout.write(f'      <parameter name="steps"      >  {steps:4}  </parameter>\n')
-                fileout.write(f'      <parameter name="substeps"   >  {substeps:4}  </parameter> \n')
-                fileout.write(f'      <parameter name="timestep"   >  {timestep:4}  </parameter>\n')
-                fileout.write(f'      <parameter name="walkers"    >  {walkers:4}  </parameter>\n')
-                fileout.write(f'      <parameter name="usedrift"   >   no   </parameter>\n')
-                fileout.write(f'      <parameter name="MinMethod"  >   OneShiftOnly  </parameter>\n')
-                fileout.write(f'      <parameter name="minwalkers" >           0.01  </parameter>\n')
-                fileout.write(f'      <parameter name="samples"             >  9999  </parameter>\n')
-                fileout.write(f'      <parameter name="stepsbetweensamples" >     1  </parameter>\n')
-                fileout.write(f'      <cost name="energy"              > 0.7 </cost>\n')
-                fileout.write(f'      <cost name="unreweightedvariance"> 0.3 </cost>\n')
-                fileout.write(f'      <cost name="reweightedvariance"  > 0.0 </cost>\n')
-                #fileout.write(f'      \n')
-                fileout.write(f'    </qmc>\n')
-                fileout.write(f'  <\loop>\n')
-            else:
-                raise ValueError("Something very wrong is happening when choosing the QMC method.")
-            fileout.write(f'\n')
-            fileout.write(f'</simulation>\n')
-        print(f"Output written to the {name+'.in.xml'} file!")
-
-
-def main():
-    app = InpBuilder()
-    app.mainloop()
-
-if __name__ == '__main__':
+METHODS = {
+    "Variational Monte Carlo": "vmc",
+    "Diffusion Monte Carlo": "dmc",
+    "Wave function optimization": "opt",
+}
+DEFAULTS = {
+    "name": "test",
+    "num": "0",
+    "sys": ".ptcl.xml",
+    "ham": ".ham.xml",
+    "wf": ".wfs.xml",
+    "method": "Variational Monte Carlo",
+    "blocks": "10",
+    "steps": "100",
+    "substeps": "1",
+    "warmup": "10",
+    "timestep": "1.0",
+    "walkers": "1",
+}
+
+HEAD = """<?xml version="1.0"?>
+<simulation>
+
+  <project id="{name}" series="{num}">
+    <application name="qmcpack" role="molecu" class="serial" version="1.0"/>
+  </project>
+
+  <include href="{sys}"/>
+  <include href="{ham}"/>
+  <include href="{wf}"/>
+
+"""
+VMC = """  <qmc method="vmc" move="pbyp" checkpoint="0">
+    <parameter name="warmupsteps">  {warmup:4}  </parameter>
+    <parameter name="blocks"     >  {blocks:4}  </parameter>
+    <parameter name="steps"      >  {steps:4}  </parameter>
+    <parameter name="substeps"   >  {substeps:4}  </parameter>
+    <parameter name="timestep"   >  {timestep:4}  </parameter>
+    <parameter name="walkers"    >  {walkers:4}  </parameter>
+    <parameter name="usedrift"   >   yes  </parameter>
+  </qmc>
+"""
+DMC = """  <qmc method="dmc" move="pbyp" checkpoint="0">
+    <parameter name="warmupsteps"   >  {warmup:4}  </parameter>
+    <parameter name="blocks"        >  {blocks:4}  </parameter>
+    <parameter name="steps"         >  {steps:4}  </parameter>
+    <parameter name="substeps"      >  {substeps:4}  </parameter>
+    <parameter name="timestep"      >  {timestep:4}  </parameter>
+    <parameter name="targetwalkers" >  {walkers:4}  </parameter>
+  </qmc>
+"""
+OPT = """  <loop max="10">
+    <qmc method="linear" move="pbyp" checkpoint="0">
+      <parameter name="warmupsteps">  {warmup:4}  </parameter>
+      <parameter name="blocks"     >  {blocks:4}  </parameter>
+      <parameter name="steps"      >  {steps:4}  </parameter>
+      <parameter name="substeps"   >  {substeps:4}  </parameter>
+      <parameter name="timestep"   >  {timestep:4}  </parameter>
+      <parameter name="walkers"    >  {walkers:4}  </parameter>
+      <parameter name="usedrift"   >   no   </parameter>
+      <parameter name="MinMethod"  >   OneShiftOnly  </parameter>
+      <parameter name="minwalkers" >           0.01  </parameter>
+      <parameter name="samples"             >  9999  </parameter>
+      <parameter name="stepsbetweensamples" >     1  </parameter>
+      <cost name="energy"              > 0.7 </cost>
+      <cost name="unreweightedvariance"> 0.3 </cost>
+      <cost name="reweightedvariance"  > 0.0 </cost>
+    </qmc>
+  </loop>
+"""
+TAIL = """
+</simulation>
+"""
+TEMPLATES = {"vmc": VMC, "dmc": DMC, "opt": OPT}
+CHUNK_SIZE = 1 << 16  # bytes of XML fed to the parser at a time
+
+
+def method_key(method: str) -> str:
+    """
+    Returns the short name (vmc, dmc, opt) of a QMC method, given either
+    as in the GUI or by its short name.
+    """
+    if method in METHODS:
+        return METHODS[method]
+    if method.lower() in TEMPLATES:
+        return method.lower()
+    raise ValueError(
+        f"Unknown QMC method {method}; use one of"
+        f" {', '.join(list(METHODS) + list(TEMPLATES))}."
+    )
+
+
+def complete(params: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Returns the parameters, as strings, with the defaults for those missing.
+    """
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise KeyError(f"Unknown parameters: {', '.join(sorted(unknown))}.")
+    full = dict(DEFAULTS)
+    full.update({key: str(value) for key, value in params.items()})
+    return full
+
+
+def render(params: Dict[str, Any]) -> str:
+    """
+    Returns the text of the input file for the given parameters (see DEFAULTS).
+    """
+    full = complete(params)
+    body = TEMPLATES[method_key(full["method"])]
+    return (HEAD + body + TAIL).format_map(full)
+
+
+def write_input(params: Dict[str, Any], directory: str = "") -> str:
+    """
+    Writes <name>.in.xml in directory (by default the current one);
+    returns its path.
+    """
+    full = complete(params)
+    filename = os.path.join(directory, full["name"] + ".in.xml")
+    with open(filename, "w") as fileout:
+        fileout.write(render(full))
+    return filename
+
+
+def expand_grid(
+    base: Dict[str, Any], grid: Dict[str, List[str]]
+) -> Iterator[Tuple[Dict[str, str], Dict[str, str]]]:
+    """
+    Yields the parameters of each point of the grid (the product of the
+    values of each swept parameter) on top of base, and the swept values;
+    each point is named after the base name and its values.
+    """
+    base = complete(base)
+    keys = list(grid)
+    for values in product(*(grid[key] for key in keys)):
+        point = dict(zip(keys, (str(value) for value in values)))
+        params = dict(base)
+        params.update(point)
+        if "name" not in point:
+            labels = []
+            for key, value in point.items():
+                if key == "method":
+                    value = method_key(value)
+                labels.append(f"{key}{value}".replace(os.sep, "-"))
+            params["name"] = "_".join([base["name"]] + labels)
+        yield params, point
+
+
+def write_sweep(
+    base: Dict[str, Any],
+    grid: Dict[str, List[str]],
+    directory: str = ".",
+    manifest: Optional[str] = "manifest.tsv",
+) -> List[str]:
+    """
+    Writes an input file for each point of the grid in directory and, if
+    manifest is given, a tab separated file next to them with a line per
+    input (task number from 1, file and swept values), e.g. for a job array
+    reading line $SLURM_ARRAY_TASK_ID; returns the files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    written = set()
+    lines = ["# task\tinput\t" + "\t".join(grid) + "\n"]
+    for task, (params, point) in enumerate(expand_grid(base, grid), start=1):
+        filename = write_input(params, directory)
+        if filename in written:
+            raise ValueError(f"Two points of the grid would write {filename}.")
+        written.add(filename)
+        files.append(filename)
+        fields = [str(task), os.path.basename(filename)] + list(point.values())
+        lines.append("\t".join(fields) + "\n")
+    if manifest:
+        with open(os.path.join(directory, manifest), "w") as fileout:
+            fileout.write("".join(lines))
+    return files
+
+
+def _stream_starts(filename: str) -> Iterator[ElementTree.Element]:
+    """
+    Yields the elements of an XML file as their start tags are parsed
+    (attributes only), dropping the parsed content as it goes.
+    """
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    # the open elements, whose children are dropped after each chunk
+    parents: List[ElementTree.Element] = []
+    with open(filename, "rb") as file_in:
+        for chunk in iter(lambda: file_in.read(CHUNK_SIZE), b""):
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == "start":
+                    parents.append(elem)
+                    yield elem
+                else:
+                    parents.pop()
+            for parent in parents:
+                del parent[:]
+
+
+def count_electrons(ptcl_file: str) -> int:
+    """
+    Returns the number of electrons (the sizes of the groups of the
+    particleset named e) of a .ptcl.xml file.
+    """
+    return _count_electrons(ptcl_file, os.stat(ptcl_file).st_mtime_ns)
+
+
+def count_determinants(wfs_file: str) -> int:
+    """
+    Returns the number of determinants of a .wfs.xml file: the size of the
+    detlist (or its number of <ci> elements), 1 for a single determinant.
+    """
+    return _count_determinants(wfs_file, os.stat(wfs_file).st_mtime_ns)
+
+
+# cached by path and modification time, as sweeps share the same files
+@lru_cache(maxsize=None)
+def _count_electrons(ptcl_file: str, mtime: int) -> int:
+    electrons = 0
+    particleset = None
+    for elem in _stream_starts(ptcl_file):
+        if elem.tag == "particleset":
+            particleset = elem.get("name")
+        elif elem.tag == "group" and particleset == "e":
+            electrons += int(elem.get("size", 0))
+    return electrons
+
+
+@lru_cache(maxsize=None)
+def _count_determinants(wfs_file: str, mtime: int) -> int:
+    count = 0
+    for elem in _stream_starts(wfs_file):
+        if elem.tag == "detlist" and elem.get("size"):
+            return int(elem.get("size", 0))
+        if elem.tag == "ci":
+            count += 1
+    return max(count, 1)
+
+
+def estimate_cost(
+    params: Dict[str, Any],
+    cores: Optional[int] = None,
+    variance: Optional[float] = None,
+    tau: float = 1.0,
+    target: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Estimates the size of a run: the total number of samples
+    (blocks x steps x walkers) and the relative cost, counting the work of
+    each electron move as N_e + N_det (the update of the Slater matrices and
+    of the determinant table) for N_e electron moves per substep. With
+    cores, suggests the walkers per rank (the total rounded up to a multiple
+    of cores); with the variance of the local energy and its correlation
+    time tau (in steps), gives the error bar of the run and, with a target
+    error, the blocks needed to reach it.
+    """
+    full = complete(params)
+    electrons = count_electrons(full["sys"])
+    determinants = count_determinants(full["wf"])
+    blocks, steps = int(full["blocks"]), int(full["steps"])
+    substeps, walkers = int(full["substeps"]), int(full["walkers"])
+    samples = blocks * steps * walkers
+    estimate: Dict[str, Any] = {
+        "electrons": electrons,
+        "determinants": determinants,
+        "samples": samples,
+        "cost": float(samples * substeps * electrons * (electrons + determinants)),
+    }
+    if cores:
+        per_rank = max(math.ceil(walkers / cores), 1)
+        estimate["walkers_per_rank"] = per_rank
+        estimate["walkers_total"] = per_rank * cores
+    if variance is not None:
+        estimate["error"] = math.sqrt(variance * tau / samples)
+        if target:
+            estimate["blocks_needed"] = math.ceil(
+                variance * tau / (target**2 * steps * walkers)
+            )
+    return estimate
+
+
+def format_estimate(estimate: Dict[str, Any]) -> str:
+    """
+    Returns a one line summary of an estimate.
+    """
+    text = (
+        f"{estimate['electrons']} electrons, {estimate['determinants']}"
+        f" determinants, {estimate['samples']} samples,"
+        f" relative cost {estimate['cost']:.3e}"
+    )
+    if "walkers_per_rank" in estimate:
+        text += (
+            f", {estimate['walkers_per_rank']} walkers per rank"
+            f" ({estimate['walkers_total']} in total)"
+        )
+    if "error" in estimate:
+        text += f", error {estimate['error']:.3e}"
+    if "blocks_needed" in estimate:
+        text += f", {estimate['blocks_needed']} blocks for the target error"
+    return text
+
+
+def key_value(text: str) -> Tuple[str, str]:
+    """
+    Splits a KEY=VALUE argument.
+    """
+    key, sep, value = text.partition("=")
+    if not sep or key not in DEFAULTS:
+        raise argparse.ArgumentTypeError(
+            f"expected KEY=VALUE with KEY in {', '.join(DEFAULTS)}"
+        )
+    return key, value
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Generates QMCPack input files without a display; a"
+        " parameter given with --sweep takes each of its values in turn, and"
+        " an input is written for each combination. Without arguments the"
+        " GUI is launched."
+    )
+    parser.add_argument(
+        "--set",
+        type=key_value,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help=f"a parameter ({', '.join(DEFAULTS)}); the method can be vmc,"
+        " dmc or opt",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=key_value,
+        action="append",
+        default=[],
+        metavar="KEY=V1,V2,...",
+        help="a parameter taking several values",
+    )
+    parser.add_argument(
+        "-d", "--directory", default=".", help="where the inputs are written"
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        default="manifest.tsv",
+        help="the job-array manifest, written in the directory of the inputs"
+        " (empty for none)",
+    )
+    parser.add_argument("--gui", action="store_true", help="launch the GUI")
+    parser.add_argument(
+        "-e",
+        "--estimate",
+        action="store_true",
+        help="print the estimated size and cost of each run (needs the sys"
+        " and wf files)",
+    )
+    parser.add_argument(
+        "--cores", type=int, help="with --estimate, suggest the walkers per rank"
+    )
+    parser.add_argument(
+        "--variance",
+        type=float,
+        help="with --estimate, the variance of the local energy, to project"
+        " the error bar",
+    )
+    parser.add_argument(
+        "--tau",
+        type=float,
+        default=1.0,
+        help="with --variance, the correlation time in steps (default 1)",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        help="with --variance, the target error bar, to find the blocks needed",
+    )
+    return parser.parse_args(args)
+
+
+def __getattr__(name: str) -> Any:
+    # the GUI classes are still reachable from here, importing tkinter only then
+    if name in ("InpBuilder", "default_dict", "pack_opt"):
+        import qmcpack_input_gui
+
+        return getattr(qmcpack_input_gui, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main() -> None:
+    """
+    Main function: launches the GUI, or writes the inputs (see parse_args).
+    """
+    args = parse_args(sys.argv[1:])
+    if len(sys.argv) == 1 or args.gui:
+        import qmcpack_input_gui
+
+        qmcpack_input_gui.main()
+        return
+    base = dict(args.set)
+    grid = {key: values.split(",") for key, values in args.sweep}
+    files = write_sweep(base, grid, args.directory, args.manifest or None)
+    print(f"{len(files)} input files written in {args.directory}")
+    if args.manifest:
+        print(f"Manifest written to {os.path.join(args.directory, args.manifest)}")
+    if args.estimate:
+        total = 0.0
+        for params, _ in expand_grid(base, grid):
+            estimate = estimate_cost(
+                params, args.cores, args.variance, args.tau, args.target
+            )
+            total += estimate["cost"]
+            print(f"{params['name']}: {format_estimate(estimate)}")
+        print(f"Total relative cost {total:.3e}")
+
+
+if __name__ == "__main__":
     main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+A GUI (made with tkinter) for qmcpack_input_generator: the entries fill the
+parameters of the input templates, written with write_input; the estimate
+button shows the size and relative cost of the run.
+"""
+import tkinter as tk
+from tkinter import ttk
+from xml.etree import ElementTree
+from qmcpack_input_generator import (
+    DEFAULTS,
+    METHODS,
+    estimate_cost,
+    format_estimate,
+    write_input,
+)
+
+default_dict = {"name": "test"}
+pack_opt = {"fill": "x", "expand": True, "padx": 10}
+
+
+class InpBuilder(tk.Tk):
+    def __init__(self):
+        super().__init__()
+
+        self.data = dict()
+        self.methods = tuple(METHODS)
+
+        run_name = tk.StringVar()
+        run_num = tk.StringVar()
+        sys_file = tk.StringVar()
+        ham_file = tk.StringVar()
+        wf_file = tk.StringVar()
+        method = tk.StringVar()
+        n_blocks = tk.StringVar()
+        n_steps = tk.StringVar()
+        timestep = tk.StringVar()
+        walkers = tk.StringVar()
+        warmup = tk.StringVar()
+        substeps = tk.StringVar()
+
+        self.make_title()
+        self.data_entry("Run name:", run_name, DEFAULTS["name"], True)
+        self.data_entry("Run number:", run_num, DEFAULTS["num"])
+        self.data_entry("System file:", sys_file, DEFAULTS["sys"])
+        self.data_entry("Hamiltonian file:", ham_file, DEFAULTS["ham"])
+        self.data_entry("Wave function file:", wf_file, DEFAULTS["wf"])
+
+        self.method_label = ttk.Label(self, text="QMC method:")
+        self.method_label.pack(pack_opt, pady=(10, 0))
+        self.method_menu = ttk.OptionMenu(self, method, self.methods[0], *self.methods)
+        self.method_menu.pack(pack_opt)
+
+        self.data_entry("Blocks:", n_blocks, DEFAULTS["blocks"])
+        self.data_entry("Steps:", n_steps, DEFAULTS["steps"])
+        self.data_entry("Substeps:", substeps, DEFAULTS["substeps"])
+        self.data_entry("Warmup steps:", warmup, DEFAULTS["warmup"])
+        self.data_entry("Timestep:", timestep, DEFAULTS["timestep"])
+        self.data_entry("Walkers:", walkers, DEFAULTS["walkers"])
+
+        self.data["name"] = run_name
+        self.data["num"] = run_num
+        self.data["sys"] = sys_file
+        self.data["ham"] = ham_file
+        self.data["wf"] = wf_file
+        self.data["method"] = method
+        self.data["blocks"] = n_blocks
+        self.data["steps"] = n_steps
+        self.data["timestep"] = timestep
+        self.data["walkers"] = walkers
+        self.data["warmup"] = warmup
+        self.data["substeps"] = substeps
+
+        self.button = ttk.Button(self, text=f"Save file")
+        self.button["command"] = self.print_file
+        self.button.pack(pack_opt, pady=(20, 10))
+
+        self.cores = tk.StringVar()
+        self.data_entry("Cores (for the estimate):", self.cores)
+        self.estimate = tk.StringVar()
+        self.estimate_button = ttk.Button(self, text="Estimate cost")
+        self.estimate_button["command"] = self.show_estimate
+        self.estimate_button.pack(pack_opt, pady=(10, 0))
+        self.estimate_label = ttk.Label(
+            self, textvariable=self.estimate, wraplength=600, padding=5
+        )
+        self.estimate_label.pack(pack_opt, pady=(0, 10))
+
+    def make_title(self):
+        self.label = ttk.Label(
+            self,
+            text="Input generator for QMCPack",
+            font=("Helvetica", 14, "bold"),
+            padding=5,
+        ).pack()
+        self.label2 = ttk.Label(
+            self,
+            text="The files with information on the system and wave function are"
+            " assumed to be created with the pw2qmcpack script!",
+            font=("Helvetica", 12),
+            padding=5,
+            wraplength=600,
+        ).pack()
+        self.title("QMCPack input generator")
+        self.bind("<Control-q>", lambda x: self.destroy())
+        self.bind("<Control-w>", lambda x: self.destroy())
+
+    def data_entry(self, descr, variable, default=None, toFocus=False):
+        label = ttk.Label(self, text=descr)
+        if default:
+            variable.set(default)
+        label.pack(pack_opt, pady=(10, 0))
+        entry = ttk.Entry(self, textvariable=variable)
+        entry.pack(pack_opt)
+        if toFocus:
+            entry.focus()
+
+    def print_file(self):
+        params = {key: variable.get() for key, variable in self.data.items()}
+        filename = write_input(params)
+        print(f"Output written to the {filename} file!")
+
+    def show_estimate(self):
+        params = {key: variable.get() for key, variable in self.data.items()}
+        try:
+            cores = int(self.cores.get()) if self.cores.get() else None
+            self.estimate.set(format_estimate(estimate_cost(params, cores)))
+        except (OSError, ValueError, ElementTree.ParseError) as error:
+            self.estimate.set(f"Cannot estimate the cost: {error}")
+
+
+def main():
+    app = InpBuilder()
+    app.mainloop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,127 @@
 """
 Script to shift an electronic density in xsf format by a 3d vector.
 """
-from typing import Tuple, List, IO, Any
+import os
+import sys
+import io
+import gzip
+import json
+import hashlib
+import lzma
+import time
+import logging
+import itertools
+import argparse
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import (
+    Tuple,
+    List,
+    Dict,
+    IO,
+    Any,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+)
 import numpy
 import numpy.typing as npt
+import instrument
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1 << 22  # bytes of grid data parsed at a time
+BLOCK_LINES = 1 << 16  # lines of grid data formatted at a time
+GRID_LINE = "       %10.8f   %10.8f   %10.8f   %10.8f\n"
+COMPRESSED = (".gz", ".xz", ".zst")
+COARSEN_METHODS = ("block", "fourier")
+CROP_MARGIN = 3.0  # default distance kept around the cropped atoms
+
+logger = logging.getLogger("shift_density")
 
 
 class Atoms:
     """
-    Defines a list of atoms; its members are
+    Defines a list of atoms, stored in arrays whose capacity doubles when
+    they are full; its members are
     nat: int, the number of atoms
-    at_types: list[int], the atomic types (each type corresponds to an atomic number)
-    at_coord: list[np.array], the 3d atomic coordinates
+    type_names: list, the distinct atomic types (each type corresponds to an atomic number)
+    type_codes: np.array[int], the index in type_names of the type of each atom
+    at_types: list, the atomic type of each atom
+    at_coord: np.array, the 3d atomic coordinates (a view of the storage)
     """
 
+    __slots__ = ("nat", "type_names", "_type_index", "_codes", "_coord")
+
     def __init__(
         self,
         nat: int = 1,
         at_types: List[Any] = [1],
         at_coord: npt.NDArray = numpy.array([[0, 0, 0]]),
     ) -> None:
-        self.nat = nat
-        self.at_types = []
-        for at_type in at_types:
-            self.at_types.append(at_type)
-        self.at_coord = numpy.empty_like(at_coord)
-        self.at_coord[:] = at_coord
+        self.nat = 0
+        self.type_names: List[Any] = []
+        self._type_index: Dict[Any, int] = {}
+        self._codes = numpy.empty(0, dtype=numpy.int32)
+        self._coord = numpy.empty((0, 3))
+        self.extend(at_types, at_coord)
+        if self.nat != nat:
+            raise ValueError(f"{nat} atoms expected, {self.nat} given.")
 
-    def shift_coord(self, shift: npt.NDArray = numpy.array([0, 0, 0])) -> None:
+    @property
+    def at_coord(self) -> npt.NDArray:
         """
-        Moves the atomic coordinates by the vector shift
+        The coordinates of the atoms, a view of the first nat rows of the storage
+        """
+        return self._coord[: self.nat]
+
+    @at_coord.setter
+    def at_coord(self, at_coord: npt.NDArray) -> None:
+        self._coord[: self.nat] = at_coord
+
+    @property
+    def type_codes(self) -> npt.NDArray:
+        """
+        The integer code of the type of each atom
+        """
+        return self._codes[: self.nat]
+
+    @property
+    def at_types(self) -> List[Any]:
+        """
+        The type of each atom, as found in type_names
+        """
+        return [self.type_names[code] for code in self.type_codes.tolist()]
+
+    def _code(self, at_type: Any) -> int:
+        """
+        Returns the integer code of at_type, adding it to type_names if new
+        """
+        code = self._type_index.get(at_type)
+        if code is None:
+            code = len(self.type_names)
+            self._type_index[at_type] = code
+            self.type_names.append(at_type)
+        return code
+
+    def reserve(self, capacity: int) -> None:
+        """
+        Makes room for at least capacity atoms, at least doubling the storage
         """
-        for i in range(3):
-            self.at_coord[i] += shift[i]
+        if capacity <= len(self._codes):
+            return
+        capacity = max(capacity, 2 * len(self._codes), 16)
+        codes = numpy.empty(capacity, dtype=numpy.int32)
+        codes[: self.nat] = self.type_codes
+        coord = numpy.empty((capacity, 3))
+        coord[: self.nat] = self.at_coord
+        self._codes, self._coord = codes, coord
 
     def add_atom(
         self, at_type: Any = 1, at_coord: npt.NDArray = numpy.array([[0, 0, 0]])
@@ -41,101 +130,753 @@ class Atoms:
         """
         Adds an atom to the Atom list
         """
-        self.at_types.append(at_type)
-        self.at_coord = numpy.append(self.at_coord, at_coord, axis=0)
+        self.reserve(self.nat + 1)
+        self._codes[self.nat] = self._code(at_type)
+        self._coord[self.nat] = numpy.reshape(at_coord, 3)
         self.nat += 1
 
+    def extend(self, at_types: List[Any], at_coord: npt.NDArray) -> None:
+        """
+        Adds many atoms to the Atom list at once
+        """
+        at_coord = numpy.reshape(at_coord, (-1, 3))
+        if len(at_types) != len(at_coord):
+            raise ValueError("Atomic types and coordinates have different lengths.")
+        nat = self.nat + len(at_types)
+        self.reserve(nat)
+        self._codes[self.nat : nat] = [self._code(at_type) for at_type in at_types]
+        self._coord[self.nat : nat] = at_coord
+        self.nat = nat
+
+    def copy(self) -> "Atoms":
+        """
+        Returns an independent copy of the Atom list
+        """
+        return Atoms(self.nat, self.at_types, self.at_coord)
 
-def read_input() -> Tuple[npt.NDArray, str, str]:
+    def shift_coord(self, shift: npt.NDArray = numpy.array([0, 0, 0])) -> None:
+        """
+        Moves the atomic coordinates by the vector shift
+        """
+        self.at_coord += shift
+
+    def wrap(self, cell: npt.NDArray) -> None:
+        """
+        Brings the atoms back into the cell, wrapping their fractional coordinates in [0,1)
+        """
+        frac = self.at_coord @ numpy.linalg.inv(cell)
+        frac -= numpy.floor(frac)
+        self.at_coord = frac @ cell
+
+
+def read_input() -> Tuple[npt.NDArray, str, str, bool]:
     """
-    Reads the file name of the original density and the shift.
-    Also builds the name of the output file.
+    Reads the file name of the original density, the shift and whether
+    the shift should keep its sub-voxel part. Also builds the name of the output file.
     """
     filename = input("Insert the input file name: ").strip()
     shifts = input("Insert DX, DY and DZ:  ").split()
     delta = numpy.zeros(3)
     for i in range(3):
         delta[i] = shifts[i]
-    fileout = filename[:-4] + "_shifted.xsf"
-    return delta, filename, fileout
+    subvoxel = input("Exact sub-voxel (Fourier) shift? [y/N] ").strip().lower() == "y"
+    fileout = output_name(filename)
+    return delta, filename, fileout, subvoxel
 
 
-def read_data(
-    filein: str = "",
-) -> Tuple[npt.NDArray, Atoms, npt.NDArray, npt.NDArray, List[str]]:
+class _TokenReader:
     """
-    Reads from the filein file information on the physical system and the density.
+    Returns the whitespace separated tokens of a binary file one at a time,
+    reading it a line at a time so that the rest of the file is left untouched.
+    It also works as a buffered stream for read_values, which can give back
+    the data it read past the end of a grid; nbytes counts the bytes read
+    from the file.
+    """
+
+    def __init__(self, file_in: IO[bytes]) -> None:
+        self.file_in = file_in
+        self.tokens: List[bytes] = []
+        self.position = 0
+        self.pending = b""
+        self.nbytes = 0
+
+    def readline(self) -> bytes:
+        """
+        Returns the next line of the file
+        """
+        if self.pending:
+            end = self.pending.find(b"\n") + 1
+            if end:
+                line, self.pending = self.pending[:end], self.pending[end:]
+                return line
+            line, self.pending = self.pending, b""
+        else:
+            line = b""
+        more = self.file_in.readline()
+        self.nbytes += len(more)
+        return line + more
+
+    def read(self, size: int) -> bytes:
+        """
+        Returns up to size bytes, those given back with unread first
+        """
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        data = self.file_in.read(size)
+        self.nbytes += len(data)
+        return data
+
+    def unread(self, data: bytes) -> None:
+        """
+        Gives back data, that will be returned by the next reads
+        """
+        self.pending = data + self.pending
+
+    def next(self, required: bool = True) -> bytes:
+        """
+        Returns the next token; at the end of the file raises a ValueError,
+        or returns an empty token if required is False
+        """
+        while self.position == len(self.tokens):
+            line = self.readline()
+            if not line:
+                if required:
+                    raise ValueError("Unexpected end of the xsf file.")
+                return b""
+            self.tokens = line.split()
+            self.position = 0
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def skip_to(self, keyword: bytes) -> bytes:
+        """
+        Discards tokens up to (and including) the first one starting with
+        keyword, and returns it
+        """
+        token = self.next()
+        while not token.startswith(keyword):
+            token = self.next()
+        return token
+
+    def rest(self) -> bytes:
+        """
+        Returns the tokens left on the current line, joined by spaces
+        """
+        rest = b" ".join(self.tokens[self.position :])
+        self.position = len(self.tokens)
+        return rest
+
+
+def open_xsf(filename: str, mode: str = "r") -> IO:
+    """
+    Opens an xsf file, as a binary stream for reading ("r") or as a text
+    stream for writing ("w"). Files ending in .gz, .xz and .zst (the latter
+    needs the zstandard module) are (de)compressed on the fly, and "-"
+    stands for the standard input or output.
+    """
+    if mode not in ("r", "w"):
+        raise ValueError(f"Invalid mode {mode}, should be r or w.")
+    options: Dict[str, Any] = {} if mode == "r" else {"encoding": "utf-8"}
+    file_mode = "rb" if mode == "r" else "wt"
+    if filename == "-":
+        # the original streams, even if sys.stdout is redirected
+        stream = sys.__stdin__ if mode == "r" else sys.__stdout__
+        return open(stream.fileno(), file_mode, closefd=False, **options)
+    if filename.endswith(".gz"):
+        return gzip.open(filename, file_mode, compresslevel=6, **options)
+    if filename.endswith(".xz"):
+        return lzma.open(filename, file_mode, **options)
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("The zstandard module is needed for .zst files.")
+        if mode == "r":
+            return io.BufferedReader(zstandard.open(filename, file_mode))
+        return zstandard.open(filename, file_mode, **options)
+    return open(filename, file_mode, **options)
+
+
+def output_name(filein: str, suffix: str = "_shifted") -> str:
+    """
+    Builds the name of an output file adding suffix to the name of filein,
+    keeping its compression; the output of the standard input is the standard output.
+    """
+    if filein == "-":
+        return "-"
+    base, compression = filein, ""
+    for extension in COMPRESSED:
+        if base.endswith(extension):
+            base, compression = base[: -len(extension)], extension
+    if base.endswith(".xsf"):
+        base = base[:-4]
+    return base + suffix + ".xsf" + compression
+
+
+def iter_values(
+    file_in: IO[bytes],
+    nvalues: int,
+    dtype: npt.DTypeLike = numpy.float64,
+    head: bytes = b"",
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[npt.NDArray]:
+    """
+    Parses nvalues numbers from file_in, in chunks of chunk_size bytes, and
+    yields them as arrays of type dtype, one per chunk; head holds text already
+    read from the file that comes before the values. Parsing stops at the first
+    END_DATAGRID marker, and the number of values read must match nvalues. If
+    file_in can unread (see _TokenReader), it gets back what was read past the
+    marker.
     """
-    with open(filein, "r", encoding="utf-8") as file_in:
-        content = file_in.read().split()
-    cursor = content.index("PRIMVEC") + 1
+    filled = 0
+    pending = head
+    done = False
+    while not done:
+        chunk = file_in.read(chunk_size)
+        done = not chunk
+        text = pending + chunk
+        ending = text.find(b"END_DATAGRID_3D")
+        if ending >= 0:
+            if hasattr(file_in, "unread"):
+                file_in.unread(text[ending:])
+            text = text[:ending]
+            done = True
+            pending = b""
+        elif not done:
+            split = max(text.rfind(b"\n"), text.rfind(b" "))
+            if split < 0:
+                pending = text
+                continue
+            text, pending = text[:split], text[split:]
+        if not text or text.isspace():
+            continue
+        parsed = numpy.fromstring(text, dtype=dtype, sep=" ")
+        if filled + parsed.size > nvalues:
+            raise ValueError(f"More than the expected {nvalues} values in the grid.")
+        filled += parsed.size
+        yield parsed
+    if filled != nvalues:
+        raise ValueError(f"Read {filled} values, expected {nvalues}.")
+
+
+def read_values(
+    file_in: IO[bytes],
+    nvalues: int,
+    dtype: npt.DTypeLike = numpy.float64,
+    head: bytes = b"",
+    chunk_size: int = CHUNK_SIZE,
+) -> npt.NDArray:
+    """
+    Same as iter_values, but parses the values into a single preallocated array.
+    """
+    values = numpy.empty(nvalues, dtype=dtype)
+    filled = 0
+    with instrument.phase("parse"):
+        for parsed in iter_values(file_in, nvalues, dtype, head, chunk_size):
+            values[filled : filled + parsed.size] = parsed
+            filled += parsed.size
+    return values
+
+
+def _read_structure(tokens: _TokenReader) -> Tuple[npt.NDArray, Atoms]:
+    """
+    Reads the primitive cell and the atoms.
+    """
+    tokens.skip_to(b"PRIMVEC")
     cell = numpy.zeros((3, 3))
     for i in range(3):
         for j in range(3):
-            cell[i][j] = float(content[cursor])
-            cursor += 1
-    print(cell)
-    print(numpy.linalg.inv(cell))
-    cursor = content.index("PRIMCOORD") + 1
-    nat = int(content[cursor])
-    cursor += 2  # skip the dummy 1
+            cell[i][j] = float(tokens.next())
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("PRIMVEC:\n%s\ninverse:\n%s", cell, numpy.linalg.inv(cell))
+    tokens.skip_to(b"PRIMCOORD")
+    nat = int(tokens.next())
+    tokens.next()  # skip the dummy 1
     at_types = []
     at_coord = numpy.zeros((nat, 3))
     for i in range(nat):
-        at_types.append(content[cursor])
-        cursor += 1
+        at_types.append(tokens.next().decode())
         for j in range(3):
-            at_coord[i][j] = content[cursor]
-            cursor += 1
-    atoms = Atoms(nat, at_types, at_coord)
-    cursor = content.index("BEGIN_DATAGRID_3D_density") + 1
+            at_coord[i][j] = float(tokens.next())
+    return cell, Atoms(nat, at_types, at_coord)
+
+
+def _read_grid_head(
+    tokens: _TokenReader,
+) -> Tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+    """
+    Reads the number of points, origin and spanning vectors of a grid.
+    """
     nind = numpy.zeros(3).astype(int)
     for i in range(3):
-        nind[i] = int(content[cursor])
-        cursor += 1
+        nind[i] = int(tokens.next())
     start_coord = numpy.zeros(3)
     for i in range(3):
-        start_coord[i] = content[cursor]
-        cursor += 1
+        start_coord[i] = float(tokens.next())
+    span = numpy.zeros((3, 3))
     for i in range(3):
         for j in range(3):
-            cell[i][j] = float(content[cursor])
-            cursor += 1
-    ending = content.index("END_DATAGRID_3D_density")
-    values = numpy.array(content[cursor:ending])
-    values = numpy.reshape(values,tuple(nind))
+            span[i][j] = float(tokens.next())
+    return nind, start_coord, span
+
+
+def read_structure(filein: str = "") -> Tuple[npt.NDArray, Atoms]:
+    """
+    Reads the primitive cell and the atoms from the filein file.
+    """
+    with open_xsf(filein) as file_in:
+        return _read_structure(_TokenReader(file_in))
+
+
+def read_head(
+    filein: str = "",
+) -> Tuple[npt.NDArray, Atoms, npt.NDArray, npt.NDArray, npt.NDArray]:
+    """
+    Reads the primitive cell, the atoms and the nind, start_coord and
+    spanning vectors of the first grid of filein, without its values.
+    """
+    with open_xsf(filein) as file_in:
+        tokens = _TokenReader(file_in)
+        cell, atoms = _read_structure(tokens)
+        tokens.skip_to(b"BEGIN_DATAGRID_3D_")
+        return (cell, atoms, *_read_grid_head(tokens))
+
+
+def index_xsf(filein: str = "", chunk_size: int = CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Builds the index of the DATAGRID blocks of filein in a single pass,
+    searching the markers chunk by chunk without tokenizing the grids.
+    Each block has a name and a list of grids; each grid has its name,
+    nind, start_coord, spanning vectors, and the byte offsets of its header
+    (right after the BEGIN_DATAGRID_3D line) and of its END_DATAGRID_3D line.
+    """
+    markers = []
+    with instrument.phase("index"), open_xsf(filein) as file_in:
+        offset = 0
+        buffer = b""
+        while True:
+            chunk = file_in.read(chunk_size)
+            buffer += chunk
+            end = buffer.rfind(b"\n") + 1 if chunk else len(buffer)
+            found = buffer.find(b"DATAGRID_3D", 0, end)
+            while found >= 0:
+                line_start = buffer.rfind(b"\n", 0, found) + 1
+                line_end = buffer.find(b"\n", found, end)
+                if line_end < 0:
+                    line_end = end
+                keyword = buffer[line_start:line_end].strip().decode()
+                markers.append((keyword, offset + line_start, offset + line_end + 1))
+                found = buffer.find(b"DATAGRID_3D", line_end, end)
+            offset += end
+            buffer = buffer[end:]
+            if not chunk:
+                break
+        blocks: List[Dict[str, Any]] = []
+        for keyword, line_start, line_end in markers:
+            if keyword == "BEGIN_BLOCK_DATAGRID_3D":
+                file_in.seek(line_end)
+                name = file_in.readline().strip().decode()
+                blocks.append({"name": name, "grids": []})
+            elif keyword.startswith("BEGIN_DATAGRID_3D_"):
+                if not blocks:
+                    raise ValueError(f"{keyword} outside of a DATAGRID block.")
+                file_in.seek(line_end)
+                nind, start_coord, span = _read_grid_head(_TokenReader(file_in))
+                blocks[-1]["grids"].append(
+                    {
+                        "name": keyword[len("BEGIN_DATAGRID_3D_") :],
+                        "nind": nind.tolist(),
+                        "start_coord": start_coord.tolist(),
+                        "span": span.tolist(),
+                        "header": line_end,
+                    }
+                )
+            elif keyword.startswith("END_DATAGRID_3D_"):
+                blocks[-1]["grids"][-1]["end"] = line_start
+    stat = os.stat(filein)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "blocks": blocks}
+
+
+def save_index(index: Dict[str, Any], fileidx: str) -> None:
+    """
+    Writes the index of an xsf file in json format.
+    """
+    os.makedirs(os.path.dirname(fileidx) or ".", exist_ok=True)
+    with open(fileidx, "w", encoding="utf-8") as file_out:
+        json.dump(index, file_out, indent=1)
+
+
+def index_file(filein: str) -> Optional[str]:
+    """
+    Returns the file the index of filein is saved to: a json file named
+    after its absolute path in XSF_CACHE_DIR, or None without a cache.
+    """
+    cache_dir = os.environ.get("XSF_CACHE_DIR")
+    if not cache_dir:
+        return None
+    path = os.path.abspath(filein).encode()
+    return os.path.join(
+        cache_dir, hashlib.blake2b(path, digest_size=16).hexdigest() + ".idx.json"
+    )
+
+
+_indexes: Dict[str, Dict[str, Any]] = {}  # the indexes built by this process
+
+
+def load_index(filein: str = "", save: bool = True) -> Dict[str, Any]:
+    """
+    Returns the index of filein, taken from those already built by this
+    process or from the file given by index_file if it matches the size and
+    modification time of filein, otherwise built with index_xsf (and saved
+    there, if save is set).
+    """
+    path = os.path.abspath(filein)
+    fileidx = index_file(filein)
+    stat = os.stat(filein)
+    index = _indexes.get(path)
+    if index is None and fileidx and os.path.exists(fileidx):
+        with open(fileidx, "r", encoding="utf-8") as file_in:
+            index = json.load(file_in)
+    if index and index["size"] == stat.st_size and index["mtime"] == stat.st_mtime_ns:
+        _indexes[path] = index
+        return index
+    index = _indexes[path] = index_xsf(filein)
+    if save and fileidx:
+        try:
+            save_index(index, fileidx)
+        except OSError:
+            print(f"Could not save the index in {fileidx}")
+    return index
+
+
+def find_grid(index: Dict[str, Any], grid: str) -> Dict[str, Any]:
+    """
+    Returns the index entry of the grid called grid, or <block>/<grid>.
+    """
+    for block in index["blocks"]:
+        for entry in block["grids"]:
+            if grid in (entry["name"], f"{block['name']}/{entry['name']}"):
+                return entry
+    raise KeyError(f"No DATAGRID_3D_{grid} in the xsf file.")
+
+
+def read_data(
+    filein: str = "",
+    dtype: npt.DTypeLike = numpy.float64,
+    grid: Optional[str] = None,
+) -> Tuple[npt.NDArray, Atoms, npt.NDArray, npt.NDArray, npt.NDArray]:
+    """
+    Reads from the filein file information on the physical system and the density.
+    The header is tokenized a line at a time, the density is parsed in chunks
+    straight into an array of type dtype (float64 or float32) with shape
+    (nz, ny, nx), so that the peak memory is close to the size of the grid.
+    By default the first grid of the file is read; a grid given by name is
+    reached directly through the file index (see load_index).
+    Note that the returned cell holds the spanning vectors of the grid.
+    """
+    start = time.perf_counter()
+    with open_xsf(filein) as file_in:
+        tokens = _TokenReader(file_in)
+        cell, atoms = _read_structure(tokens)
+        if grid is None:
+            tokens.skip_to(b"BEGIN_DATAGRID_3D_")
+        else:
+            file_in.seek(find_grid(load_index(filein), grid)["header"])
+            tokens = _TokenReader(file_in)
+        nind, start_coord, cell = _read_grid_head(tokens)
+        nbytes = -tokens.nbytes
+        values = read_values(tokens, int(numpy.prod(nind)), dtype, tokens.rest())
+        nbytes += tokens.nbytes
+    values = numpy.reshape(values, tuple(nind[::-1]))
+    elapsed = time.perf_counter() - start
+    print(
+        f"Read {nbytes / 1e6:.1f} MB in {elapsed:.2f} s"
+        f" ({nbytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+    )
     return cell, atoms, nind, start_coord, values
 
 
+def load_data(
+    filein: str = "",
+    grid: Optional[str] = None,
+) -> Tuple[npt.NDArray, Atoms, npt.NDArray, npt.NDArray, npt.NDArray]:
+    """
+    Same as read_data, but if XSF_CACHE_DIR is set the parsed density is
+    cached there and memory-mapped on later calls (see xsf_cache).
+    """
+    cache_dir = os.environ.get("XSF_CACHE_DIR")
+    if not cache_dir:
+        return read_data(filein, grid=grid)
+    from xsf_cache import XsfCache
+
+    return XsfCache(cache_dir).load(filein, grid)
+
+
+def iter_grids(
+    tokens: _TokenReader, dtype: npt.DTypeLike = numpy.float64
+) -> Iterator[Tuple[Dict[str, Any], npt.NDArray]]:
+    """
+    Reads the grids of an xsf file sequentially, in a single pass, after its
+    structure (see _read_structure). For each grid yields a dictionary like
+    the entries of index_xsf, also holding the number and name of its block,
+    and the grid values.
+    """
+    block, block_name = -1, ""
+    token = tokens.next(required=False)
+    while token:
+        if token == b"BEGIN_BLOCK_DATAGRID_3D":
+            block += 1
+            block_name = tokens.next().decode()
+        elif token.startswith(b"BEGIN_DATAGRID_3D_"):
+            nind, start_coord, span = _read_grid_head(tokens)
+            values = read_values(tokens, int(numpy.prod(nind)), dtype, tokens.rest())
+            entry = {
+                "block": block,
+                "block_name": block_name,
+                "name": token[len(b"BEGIN_DATAGRID_3D_") :].decode(),
+                "nind": nind,
+                "start_coord": start_coord,
+                "span": span,
+            }
+            yield entry, numpy.reshape(values, tuple(nind[::-1]))
+        token = tokens.next(required=False)
+
+
 def get_shift(
     delta: npt.NDArray = numpy.array([0, 0, 0]),
     nind: npt.NDArray = numpy.array([1, 1, 1]),
     cell: npt.NDArray = numpy.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
-) -> List[int]:
+) -> npt.NDArray:
     """
-    Takes the real space shift and converts it in discrete increments for the three directions
+    Takes the real space shift and converts it in (fractional) voxel increments
+    for the three directions; the periodic grid has nind-1 distinct points
+    along each spanning vector, the last one repeating the first.
     """
     rotated = delta @ numpy.linalg.inv(cell)
-    print("rotated:\n", rotated)
-    print("nind:\n", nind)
-    dr = []
-    for i in range(3):
-        dr.append(int(rotated[i] * nind[i]))
-    print("dr:\n", dr)
+    dr = rotated * (nind - 1)
+    logger.debug(
+        "shift %s: fractional %s, nind %s, voxels %s", delta, rotated, nind, dr
+    )
     return dr
 
 
-def write_head(
+def close_grid(core: npt.NDArray) -> npt.NDArray:
+    """
+    Builds the full xsf grid from its periodic core, copying the first face,
+    edge and corner points in the closing planes.
+    """
+    return numpy.pad(core, [(0, 1)] * 3, mode="wrap")
+
+
+def fourier_shift(core: npt.NDArray, dr: npt.NDArray) -> npt.NDArray:
+    """
+    Shifts the periodic core of a grid by the (possibly fractional) number of
+    voxels dr, ordered as (x, y, z), applying phase factors to its Fourier
+    transform. The Nyquist components of even-sized axes get the real part of
+    their phase, so that the result stays real.
+    """
+    spectrum = numpy.fft.rfftn(core)
+    for axis, shift in zip(range(3), dr[::-1]):
+        size = core.shape[axis]
+        if axis == 2:
+            freq = numpy.fft.rfftfreq(size)
+        else:
+            freq = numpy.fft.fftfreq(size)
+        phase = numpy.exp(-2j * numpy.pi * freq * shift)
+        if size % 2 == 0:
+            phase[size // 2] = numpy.cos(numpy.pi * shift)
+        shape = [1, 1, 1]
+        shape[axis] = phase.size
+        spectrum *= phase.reshape(shape)
+    return numpy.fft.irfftn(spectrum, s=core.shape)
+
+
+def shift_grid(
+    values: npt.NDArray, dr: npt.NDArray, subvoxel: bool = False
+) -> npt.NDArray:
+    """
+    Shifts the (nz, ny, nx) grid values by dr voxels along (x, y, z), with
+    periodic boundary conditions. By default the shift is rounded to whole
+    voxels and done with a single roll of the periodic core; with subvoxel
+    the exact shift is applied in Fourier space.
+    """
+    core = values[:-1, :-1, :-1]
+    with instrument.phase("shift"):
+        if subvoxel:
+            return close_grid(fourier_shift(core, dr))
+        whole = numpy.rint(dr).astype(int)
+        if not numpy.allclose(whole, dr):
+            print(f"Shift rounded to {whole} voxels (sub-voxel part {dr - whole} lost)")
+        return close_grid(numpy.roll(core, tuple(whole[::-1]), axis=(0, 1, 2)))
+
+
+def block_coarsen(core: npt.NDArray, factors: npt.NDArray) -> npt.NDArray:
+    """
+    Coarsens the periodic core of a grid by the integer factors (x, y, z),
+    averaging each block of factors voxels in one.
+    """
+    shape = []
+    for size, factor in zip(core.shape, factors[::-1]):
+        shape += [size // factor, factor]
+    return core.reshape(shape).mean(axis=(1, 3, 5))
+
+
+def fourier_coarsen(core: npt.NDArray, factors: npt.NDArray) -> npt.NDArray:
+    """
+    Coarsens the periodic core of a grid to size // factor points along each
+    axis (factors ordered as x, y, z), keeping only the Fourier components
+    that the coarse grid can represent; the sizes need not be multiples of
+    the factors.
+    """
+    shape = tuple(size // factor for size, factor in zip(core.shape, factors[::-1]))
+    spectrum = numpy.fft.rfftn(core)
+    # the frequencies of the coarse grid, negative ones counted from the end
+    index = [numpy.fft.fftfreq(size, 1.0 / size).astype(int) for size in shape[:2]]
+    index.append(numpy.arange(shape[2] // 2 + 1))
+    spectrum = spectrum[numpy.ix_(*index)]
+    return numpy.fft.irfftn(spectrum, s=shape, axes=(0, 1, 2)) * (
+        numpy.prod(shape) / core.size
+    )
+
+
+class GridResize:
+    """
+    Defines how a (shifted) periodic grid is reduced before it is written;
+    its members are
+    factors: np.array[int], the coarsening factors along x, y and z
+    method: str, "block" (block averaging) or "fourier" (Fourier truncation)
+    crop_atoms: list, the indices of the atoms around which the grid is
+        cropped; if empty the whole cell is kept
+    margin: float, the distance from the atoms kept in the cropped box
+    """
+
+    __slots__ = ("factors", "method", "crop_atoms", "margin")
+
+    def __init__(
+        self,
+        factors: Union[int, List[int]] = 1,
+        method: str = "block",
+        crop_atoms: Optional[List[int]] = None,
+        margin: float = CROP_MARGIN,
+    ) -> None:
+        self.factors = numpy.broadcast_to(numpy.asarray(factors, dtype=int), 3).copy()
+        if numpy.any(self.factors < 1):
+            raise ValueError(f"Invalid coarsening factors {self.factors}.")
+        if method not in COARSEN_METHODS:
+            raise ValueError(f"The method must be one of {', '.join(COARSEN_METHODS)}.")
+        if margin < 0:
+            raise ValueError(f"Invalid crop margin {margin}.")
+        self.method = method
+        self.crop_atoms = list(crop_atoms or [])
+        self.margin = margin
+
+    def check(self, nat: int, ninds: Iterable[Sequence[int]]) -> None:
+        """
+        Raises a ValueError if a cropped atom is not among the nat atoms, or
+        if the block coarsening factors do not divide the grids of size ninds
+        (nind of each grid, closing planes included).
+        """
+        for atom in self.crop_atoms:
+            if not 0 <= atom < nat:
+                raise ValueError(
+                    f"Cannot crop around atom {atom + 1}: the atoms are 1 to {nat}."
+                )
+        self._check_factors(ninds)
+
+    def _check_factors(self, ninds: Iterable[Sequence[int]]) -> None:
+        """
+        Raises a ValueError if the block coarsening factors do not divide
+        the grids of size ninds.
+        """
+        if self.method != "block":
+            return
+        for nind in ninds:
+            npoints = numpy.asarray(nind) - 1
+            if numpy.any(npoints % self.factors):
+                raise ValueError(
+                    f"A grid of {npoints} voxels cannot be block averaged by"
+                    f" {self.factors}; use the fourier method."
+                )
+
+    def coarsen(
+        self, values: npt.NDArray, start_coord: npt.NDArray, span: npt.NDArray
+    ) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Coarsens the full (periodic) grid values; returns the new origin and
+        the new grid. Block averages are centred between the original points,
+        so the origin moves by (factor - 1) / 2 original voxels.
+        """
+        if numpy.all(self.factors == 1):
+            return start_coord, values
+        core = values[:-1, :-1, :-1]
+        npoints = numpy.array(core.shape[::-1])
+        if self.method == "fourier":
+            return start_coord, close_grid(fourier_coarsen(core, self.factors))
+        self._check_factors([values.shape[::-1]])
+        offset = (self.factors - 1) / (2.0 * npoints)
+        return start_coord + offset @ span, close_grid(
+            block_coarsen(core, self.factors)
+        )
+
+    def crop_limits(
+        self,
+        atoms: Atoms,
+        npoints: npt.NDArray,
+        start_coord: npt.NDArray,
+        span: npt.NDArray,
+    ) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Returns the first and last grid points (x, y, z, possibly outside of
+        the periodic core) of the smallest box holding the chosen atoms and
+        the margin around them; whole axes are kept where the box would not fit.
+        """
+        inverse = numpy.linalg.inv(span)
+        frac = (atoms.at_coord[self.crop_atoms] - start_coord) @ inverse
+        # the periodic images closest to the first atom
+        frac -= numpy.rint(frac - frac[0])
+        # distance between the planes of the grid, in fractional units
+        margin = self.margin * numpy.linalg.norm(inverse, axis=0)
+        first = numpy.floor((frac.min(axis=0) - margin) * npoints).astype(int)
+        last = numpy.ceil((frac.max(axis=0) + margin) * npoints).astype(int)
+        whole = last - first >= npoints
+        first[whole] = 0
+        last[whole] = npoints[whole]
+        return first, last
+
+    def apply(
+        self,
+        values: npt.NDArray,
+        nind: npt.NDArray,
+        start_coord: npt.NDArray,
+        span: npt.NDArray,
+        atoms: Atoms,
+    ) -> Tuple[npt.NDArray, npt.NDArray, npt.NDArray, npt.NDArray]:
+        """
+        Coarsens and crops the full grid values, with atoms in the same frame;
+        returns the new nind, start_coord, spanning vectors and grid.
+        """
+        with instrument.phase("resize"):
+            start_coord, values = self.coarsen(values, start_coord, span)
+            nind = numpy.array(values.shape[::-1])
+            if not self.crop_atoms:
+                return nind, start_coord, span, values
+            npoints = nind - 1
+            first, last = self.crop_limits(atoms, npoints, start_coord, span)
+            core = values[:-1, :-1, :-1]
+            for axis, begin, end, size in zip((2, 1, 0), first, last, npoints):
+                core = numpy.take(core, numpy.arange(begin, end + 1) % size, axis=axis)
+            start_coord = start_coord + (first / npoints) @ span
+            span = span * ((last - first) / npoints)[:, None]
+            return last - first + 1, start_coord, span, core
+
+
+def write_structure(
     file_out: IO,
     cell: npt.NDArray = numpy.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
     atoms: Atoms = Atoms(),
-    nind: npt.NDArray = numpy.array([1, 1, 1]),
-    start_coord: npt.NDArray = numpy.array([0, 0, 0]),
 ) -> None:
     """
-    Writes the initial part of the output file.
+    Writes the primitive cell and the atoms.
     """
-    print(type(file_out))
     file_out.write(" CRYSTAL\n")
     file_out.write(" PRIMVEC\n")
     for i in range(3):
@@ -144,83 +885,529 @@ def write_head(
         )
     file_out.write(" PRIMCOORD\n")
     file_out.write(f"   {atoms.nat} 1\n")
-    for i in range(atoms.nat):
-        file_out.write(
-            f"     {atoms.at_types[i]}  {atoms.at_coord[i][0]:11.8f}  "
-            f"{atoms.at_coord[i][1]:11.8f}  {atoms.at_coord[i][2]:11.8f}\n"
+    file_out.write(
+        "".join(
+            f"     {at_type}  {coord[0]:11.8f}  {coord[1]:11.8f}  {coord[2]:11.8f}\n"
+            for at_type, coord in zip(atoms.at_types, atoms.at_coord.tolist())
         )
+    )
+
+
+def write_block_head(file_out: IO, name: str = "density") -> None:
+    """
+    Opens a DATAGRID block.
+    """
     file_out.write(" BEGIN_BLOCK_DATAGRID_3D\n")
-    file_out.write("   density\n")
-    file_out.write("   BEGIN_DATAGRID_3D_density\n")
+    file_out.write(f"   {name}\n")
+
+
+def write_grid_head(
+    file_out: IO,
+    name: str = "density",
+    nind: npt.NDArray = numpy.array([1, 1, 1]),
+    start_coord: npt.NDArray = numpy.array([0, 0, 0]),
+    span: npt.NDArray = numpy.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
+) -> None:
+    """
+    Opens a grid, writing its number of points, origin and spanning vectors.
+    """
+    file_out.write(f"   BEGIN_DATAGRID_3D_{name}\n")
     file_out.write(f"     {int(nind[0])} {int(nind[1])} {int(nind[2])}\n")
     file_out.write(
         f"    {start_coord[0]:11.8f}  {start_coord[1]:11.8f}  {start_coord[2]:11.8f}\n"
     )
     for i in range(3):
         file_out.write(
-            f"    {cell[i][0]:11.8f}  {cell[i][1]:11.8f}  {cell[i][2]:11.8f}\n"
+            f"    {span[i][0]:11.8f}  {span[i][1]:11.8f}  {span[i][2]:11.8f}\n"
         )
 
 
+def write_head(
+    file_out: IO,
+    cell: npt.NDArray = numpy.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
+    atoms: Atoms = Atoms(),
+    nind: npt.NDArray = numpy.array([1, 1, 1]),
+    start_coord: npt.NDArray = numpy.array([0, 0, 0]),
+    span: Optional[npt.NDArray] = None,
+) -> None:
+    """
+    Writes the initial part of the output file; the spanning vectors of the
+    grid are those of the cell unless given.
+    """
+    logger.debug("writing to %s", getattr(file_out, "name", type(file_out).__name__))
+    write_structure(file_out, cell, atoms)
+    write_block_head(file_out)
+    write_grid_head(
+        file_out, "density", nind, start_coord, cell if span is None else span
+    )
+
+
+def _format_lines(values: npt.NDArray) -> str:
+    """
+    Formats values (a multiple of 4 of them) as xsf grid lines.
+    """
+    return (GRID_LINE * (values.size // 4)) % tuple(values.tolist())
+
+
+def write_lines(
+    file_out: IO, values: npt.NDArray, block_lines: int = BLOCK_LINES
+) -> None:
+    """
+    Writes values (a multiple of 4 of them) as full grid lines, formatting
+    block_lines lines at a time; the grid is then completed by write_data.
+    """
+    block_size = 4 * block_lines
+    for start in range(0, values.size, block_size):
+        with instrument.phase("format"):
+            text = _format_lines(values[start : start + block_size])
+        with instrument.phase("write"):
+            file_out.write(text)
+
+
+def write_data(
+    file_out: IO,
+    values: Union[npt.NDArray, Iterable[npt.NDArray]],
+    block_lines: int = BLOCK_LINES,
+) -> None:
+    """
+    Writes the grid values, 4 per line in the 10.8f format, formatting and
+    writing block_lines lines at a time. values can also be an iterable of
+    arrays, which are written out as they come, so that a grid can be streamed.
+    """
+    if isinstance(values, numpy.ndarray):
+        values = [values]
+    pending = numpy.empty(0)
+    for chunk in values:
+        chunk = numpy.ravel(chunk)
+        if pending.size:
+            needed = 4 - pending.size
+            pending = numpy.concatenate((pending, chunk[:needed]))
+            chunk = chunk[needed:]
+            if pending.size < 4:
+                continue
+            file_out.write(_format_lines(pending))
+        full = chunk.size - chunk.size % 4
+        write_lines(file_out, chunk[:full], block_lines)
+        pending = chunk[full:]
+    file_out.write("       ")
+    if pending.size:
+        file_out.write("".join(f"{value:10.8f}   " for value in pending) + "\n")
+
+
+def write_grid_tail(file_out: IO, name: str = "density") -> None:
+    """
+    Closes a grid.
+    """
+    file_out.write(f"   END_DATAGRID_3D_{name}\n")
+
+
+def write_block_tail(file_out: IO) -> None:
+    """
+    Closes a DATAGRID block.
+    """
+    file_out.write(" END_BLOCK_DATAGRID_3D\n")
+
+
 def write_tail(file_out: IO) -> None:
     """
     Writes the final part of the output file
     """
-    file_out.write("   END_DATAGRID_3D_density\n")
-    file_out.write(" END_BLOCK_DATAGRID_3D\n")
+    write_grid_tail(file_out)
+    write_block_tail(file_out)
 
 
-def main() -> None:
+def shift_atoms(
+    atoms: Atoms, delta: npt.NDArray, cell: Optional[npt.NDArray] = None
+) -> Atoms:
     """
-    Main function - call the others to shift the density/atomic positions
+    Returns a copy of the atoms moved by the real space vector delta and,
+    if a cell is given, wrapped back into it.
     """
-    delta, filein, fileout = read_input()
-    cell, atoms, nind, start_coord, values = read_data(filein)
-    nindm1 = nind - 1
-    for i in range(atoms.nat):
-        for j in range(3):
-            atoms.at_coord[i][j] += delta[j]
-    dr = get_shift(delta, nind, cell)
-    print(dr)
-    data = numpy.zeros(tuple(nindm1))
-    for i in range(nindm1[2]):
-        for j in range(nindm1[1]):
-            for k in range(nindm1[0]):
-                ix = int((k + dr[0]) % (nindm1[0]))
-                iy = int((j + dr[1]) % (nindm1[1]))
-                iz = int((i + dr[2]) % (nindm1[2]))
-                data[iz][iy][ix] = values[i][j][k]
-    
-    density = numpy.zeros(tuple(nind),dtype=float)
-    density[:nindm1[2],:nindm1[1],:nindm1[0]] = data[:,:,:] # volume copy
-    density[        -1,:nindm1[1],:nindm1[0]] = data[0,:,:] # face copies
-    density[:nindm1[2],        -1,:nindm1[0]] = data[:,0,:]
-    density[:nindm1[2],:nindm1[1],        -1] = data[:,:,0]
-    density[        -1,        -1,:nindm1[0]] = data[0,0,:] # edge copies
-    density[        -1,:nindm1[1],        -1] = data[0,:,0]
-    density[:nindm1[2],        -1,        -1] = data[:,0,0]
-    density[        -1,        -1,        -1] = data[0,0,0] # corner copy
-    density.shape = tuple(nind)
-
-
-    with open(fileout, "w", encoding="utf-8") as file_out:
-        write_head(file_out, cell, atoms, nind, start_coord)
-        count = 0
-        file_out.write("       ")
-        for i in range(int(nind[2])):
-            for j in range(int(nind[1])):
-                for k in range(int(nind[0])):
-                    file_out.write(f"{density[i][j][k]:10.8f}")
-                    count += 1
-                    if count == 4:
-                        file_out.write("\n       ")
-                        count = 0
-                    else:
-                        file_out.write("   ")
-        if count != 0:
-            file_out.write("\n")
+    shifted = atoms.copy()
+    shifted.shift_coord(delta)
+    if cell is not None:
+        shifted.wrap(cell)
+    return shifted
+
+
+def write_shifted_grid(
+    file_out: IO,
+    name: str,
+    values: npt.NDArray,
+    nind: npt.NDArray,
+    start_coord: npt.NDArray,
+    span: npt.NDArray,
+    delta: npt.NDArray,
+    subvoxel: bool = False,
+    resize: Optional[GridResize] = None,
+    atoms: Optional[Atoms] = None,
+) -> None:
+    """
+    Shifts a grid by the real space vector delta, coarsens and crops it if
+    resize is given (around the shifted atoms), and writes it.
+    """
+    values = shift_grid(values, get_shift(delta, nind, span), subvoxel)
+    if resize is not None:
+        nind, start_coord, span, values = resize.apply(
+            values, nind, start_coord, span, atoms
+        )
+    write_grid_head(file_out, name, nind, start_coord, span)
+    write_data(file_out, values)
+    write_grid_tail(file_out, name)
+
+
+def write_shifted_grids(
+    file_out: IO,
+    cell: npt.NDArray,
+    atoms: Atoms,
+    grids: Iterable[Tuple[Dict[str, Any], npt.NDArray]],
+    delta: npt.NDArray,
+    subvoxel: bool = False,
+    resize: Optional[GridResize] = None,
+) -> None:
+    """
+    Writes the atoms and the grids (entries and values as given by
+    iter_grids) shifted by the real space vector delta, keeping the cell and
+    the block structure; the grids are shifted (and resized, see GridResize)
+    one at a time, as they come.
+    """
+    shifted = shift_atoms(atoms, delta, cell)
+    write_structure(file_out, cell, shifted)
+    block = -1
+    for entry, values in grids:
+        if entry["block"] != block:
+            if block >= 0:
+                write_block_tail(file_out)
+            write_block_head(file_out, entry["block_name"])
+            block = entry["block"]
+        write_shifted_grid(
+            file_out,
+            entry["name"],
+            values,
+            entry["nind"],
+            entry["start_coord"],
+            entry["span"],
+            delta,
+            subvoxel,
+            resize,
+            shifted,
+        )
+    if block >= 0:
+        write_block_tail(file_out)
+
+
+def iter_indexed_grids(
+    filein: str, index: Dict[str, Any]
+) -> Iterator[Tuple[Dict[str, Any], npt.NDArray]]:
+    """
+    Loads the grids of filein one at a time through its index (see
+    load_index and load_data), yielding them as iter_grids does.
+    """
+    for number, block in enumerate(index["blocks"]):
+        for grid in block["grids"]:
+            span, _, nind, start_coord, values = load_data(
+                filein, f"{block['name']}/{grid['name']}"
+            )
+            entry = {
+                "block": number,
+                "block_name": block["name"],
+                "name": grid["name"],
+                "nind": nind,
+                "start_coord": start_coord,
+                "span": span,
+            }
+            yield entry, values
+
+
+def index_ninds(index: Dict[str, Any]) -> List[List[int]]:
+    """
+    Returns the nind of every grid in the index of a file (see index_xsf).
+    """
+    return [grid["nind"] for block in index["blocks"] for grid in block["grids"]]
+
+
+def shift_file(
+    filein: str,
+    fileout: str,
+    delta: npt.NDArray,
+    subvoxel: bool = False,
+    resize: Optional[GridResize] = None,
+) -> None:
+    """
+    Shifts the atoms and every grid of filein by the real space vector delta
+    and writes them to fileout, keeping the block structure of the file.
+    The grids are loaded, shifted (and resized, see GridResize) and written
+    one at a time: in a single pass (see shift_stream) or, with a cache
+    (XSF_CACHE_DIR), through the file index, so that each grid is cached.
+    """
+    if not os.environ.get("XSF_CACHE_DIR"):
+        shift_stream(filein, fileout, delta, subvoxel, resize)
+        return
+    index = load_index(filein)
+    cell, atoms = read_structure(filein)
+    if resize is not None:
+        resize.check(atoms.nat, index_ninds(index))
+    with open_xsf(fileout, "w") as file_out:
+        write_shifted_grids(
+            file_out,
+            cell,
+            atoms,
+            iter_indexed_grids(filein, index),
+            delta,
+            subvoxel,
+            resize,
+        )
+
+
+def write_xsf(
+    fileout: str,
+    cell: npt.NDArray,
+    atoms: Atoms,
+    nind: npt.NDArray,
+    start_coord: npt.NDArray,
+    density: npt.NDArray,
+    span: Optional[npt.NDArray] = None,
+) -> None:
+    """
+    Writes a full xsf file with a single density grid.
+    """
+    with open_xsf(fileout, "w") as file_out:
+        write_head(file_out, cell, atoms, nind, start_coord, span)
+        write_data(file_out, density)
         write_tail(file_out)
 
 
+def shift_stream(
+    filein: str,
+    fileout: str,
+    delta: npt.NDArray,
+    subvoxel: bool = False,
+    resize: Optional[GridResize] = None,
+) -> None:
+    """
+    Same as shift_file, but reads filein sequentially in a single pass
+    (see iter_grids), without an index, so that it also works on compressed
+    files and on the standard input.
+    """
+    with open_xsf(filein) as file_in:
+        tokens = _TokenReader(file_in)
+        cell, atoms = _read_structure(tokens)
+        grids = iter_grids(tokens)
+        # the first grid is read before fileout is opened, to check the resize
+        first = next(grids, None)
+        if resize is not None:
+            ninds = [] if first is None else [first[0]["nind"]]
+            resize.check(atoms.nat, ninds)
+        if first is not None:
+            grids = itertools.chain([first], grids)
+        with open_xsf(fileout, "w") as file_out:
+            write_shifted_grids(file_out, cell, atoms, grids, delta, subvoxel, resize)
+
+
+_shared: Dict[str, Any] = {}
+
+
+def _attach_grids(entries: List[Dict[str, Any]], instrumented: bool) -> None:
+    """
+    Pool initializer: attaches the worker to the shared memory blocks holding
+    the grids, described by entries (see shift_batch), and records its phases
+    if instrumented is set.
+    """
+    instrument.worker_setup(instrumented, "shift_density")
+    _shared["memories"] = []
+    _shared["grids"] = []
+    for entry in entries:
+        memory = shared_memory.SharedMemory(name=entry["memory"])
+        _shared["memories"].append(memory)
+        values = numpy.ndarray(
+            tuple(entry["nind"][::-1]), dtype=entry["dtype"], buffer=memory.buf
+        )
+        _shared["grids"].append((entry, values))
+
+
+def _shift_job(
+    job: Tuple[str, npt.NDArray, Atoms, npt.NDArray, bool, Optional[GridResize]]
+) -> Tuple[str, Dict[str, Dict[str, float]]]:
+    """
+    Pool task: shifts the shared grids by one vector and writes them; returns
+    the output file and the phases recorded meanwhile.
+    """
+    fileout, cell, atoms, delta, subvoxel, resize = job
+    with open_xsf(fileout, "w") as file_out:
+        write_shifted_grids(
+            file_out, cell, atoms, _shared["grids"], delta, subvoxel, resize
+        )
+    return fileout, instrument.take_phases()
+
+
+def shift_batch(
+    filein: str,
+    shifts: npt.NDArray,
+    processes: Optional[int] = None,
+    subvoxel: bool = False,
+    resize: Optional[GridResize] = None,
+) -> List[str]:
+    """
+    Parses filein once and writes a copy shifted by each of the vectors in
+    shifts to <name>_shifted_<k>.xsf, with every block and grid of filein
+    (as shift_file does), using a pool of processes that read the grids from
+    shared memory. Returns the names of the written files.
+    """
+    index = load_index(filein)
+    cell, atoms = read_structure(filein)
+    if resize is not None:
+        resize.check(atoms.nat, index_ninds(index))
+    memories = []
+    try:
+        entries = []
+        for entry, values in iter_indexed_grids(filein, index):
+            memory = shared_memory.SharedMemory(create=True, size=values.nbytes)
+            memories.append(memory)
+            shared = numpy.ndarray(values.shape, dtype=values.dtype, buffer=memory.buf)
+            shared[:] = values
+            entry.update(memory=memory.name, dtype=values.dtype.str)
+            del values, shared
+            entries.append(entry)
+        jobs = [
+            (output_name(filein, f"_shifted_{k}"), cell, atoms, delta, subvoxel, resize)
+            for k, delta in enumerate(shifts)
+        ]
+        written = []
+        with multiprocessing.Pool(
+            processes,
+            initializer=_attach_grids,
+            initargs=(entries, instrument.enabled()),
+        ) as pool:
+            for fileout, phases in pool.imap_unordered(_shift_job, jobs):
+                instrument.add_phases(phases)
+                print(f"Written {fileout}")
+                written.append(fileout)
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    return written
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Shifts the density (all the grids) and the atoms of an xsf file"
+        " by a 3d vector, with periodic boundary conditions. Files ending in .gz,"
+        " .xz and .zst are (de)compressed on the fly, - is the standard input/output."
+    )
+    parser.add_argument("input", help="the xsf file, or - for the standard input")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-s", "--shift", nargs=3, type=float, metavar=("DX", "DY", "DZ"))
+    group.add_argument(
+        "--shifts",
+        metavar="FILE",
+        help="batch mode: a file with a DX DY DZ shift per line, each written"
+        " to <input>_shifted_<k>.xsf",
+    )
+    parser.add_argument(
+        "-o", "--output", help="the output file (default <input>_shifted.xsf)"
+    )
+    parser.add_argument(
+        "--subvoxel", action="store_true", help="exact sub-voxel (Fourier) shift"
+    )
+    parser.add_argument(
+        "-j", "--processes", type=int, help="processes used in batch mode"
+    )
+    parser.add_argument(
+        "--cache", metavar="DIR", help="cache parsed densities in DIR (XSF_CACHE_DIR)"
+    )
+    parser.add_argument(
+        "--coarsen",
+        nargs="+",
+        type=int,
+        metavar="F",
+        help="coarsen the grids by an integer factor (or one per axis)",
+    )
+    parser.add_argument(
+        "--coarsen-method",
+        choices=COARSEN_METHODS,
+        help=f"block averaging or Fourier truncation (default {COARSEN_METHODS[0]})",
+    )
+    parser.add_argument(
+        "--crop",
+        nargs="+",
+        type=int,
+        metavar="ATOM",
+        help="crop the grids to a box around these atoms (counted from 1)",
+    )
+    parser.add_argument(
+        "--margin",
+        type=float,
+        help=f"distance kept around the cropped atoms (default {CROP_MARGIN})",
+    )
+    instrument.add_arguments(parser)
+    parsed = parser.parse_args(args)
+    if parsed.coarsen and len(parsed.coarsen) not in (1, 3):
+        parser.error("--coarsen takes one factor or three")
+    if parsed.shifts and parsed.input == "-":
+        parser.error("the batch mode needs an input file")
+    if parsed.crop and min(parsed.crop) < 1:
+        parser.error("the atoms to crop around are counted from 1")
+    if parsed.coarsen_method and not parsed.coarsen:
+        parser.error("--coarsen-method needs --coarsen")
+    if parsed.margin is not None and not parsed.crop:
+        parser.error("--margin needs --crop")
+    parsed.resize = None
+    if parsed.coarsen or parsed.crop:
+        try:
+            parsed.resize = GridResize(
+                parsed.coarsen or 1,
+                parsed.coarsen_method or COARSEN_METHODS[0],
+                [atom - 1 for atom in parsed.crop or []],
+                CROP_MARGIN if parsed.margin is None else parsed.margin,
+            )
+            # checked on the first grid here; the grids that follow once read,
+            # before the output is opened (see shift_stream and shift_batch)
+            if parsed.input != "-":
+                _, atoms, nind, _, _ = read_head(parsed.input)
+                parsed.resize.check(atoms.nat, [nind])
+        except ValueError as error:
+            parser.error(str(error))
+    return parsed
+
+
+def main() -> None:
+    """
+    Main function - call the others to shift the density/atomic positions.
+    Without arguments, asks for the file and the shift (see parse_args).
+    """
+    if len(sys.argv) == 1:
+        instrument.setup("shift_density")
+        delta, filein, fileout, subvoxel = read_input()
+        shift_file(filein, fileout, delta, subvoxel)
+        return
+    args = parse_args(sys.argv[1:])
+    instrument.setup("shift_density", args.instrument, args.debug)
+    if args.cache:
+        os.environ["XSF_CACHE_DIR"] = args.cache
+    fileout = args.output or output_name(args.input)
+    resize = args.resize
+    # keep the standard output clean when the density is written there
+    with contextlib.redirect_stdout(sys.stderr if fileout == "-" else sys.stdout):
+        if args.shifts:
+            shifts = numpy.loadtxt(args.shifts, ndmin=2)
+            if shifts.shape[1] != 3:
+                raise ValueError(
+                    f"{args.shifts} should have a DX DY DZ shift per line."
+                )
+            shift_batch(args.input, shifts, args.processes, args.subvoxel, resize)
+        elif args.input == "-" or args.input.endswith(COMPRESSED):
+            shift_stream(
+                args.input, fileout, numpy.array(args.shift), args.subvoxel, resize
+            )
+        else:
+            shift_file(
+                args.input, fileout, numpy.array(args.shift), args.subvoxel, resize
+            )
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+"""
+Tests of det_hist.read_coefficients (run with pytest).
+"""
+import numpy
+import pytest
+from det_hist import read_coefficients
+
+WAVEFUNCTION = """<?xml version="1.0"?>
+<qmcsystem>
+<wavefunction name="psi0">
+<determinantset><multideterminant optimize="no" spo_up="spo-up" spo_dn="spo-dn">
+<detlist size="1" type="DETS" nca="0" ncb="0" nea="1" neb="1" nstates="2" cutoff="1e-3">
+<ci id="CIcoeff_0" coeff="0.9" alpha="10" beta="10"/>
+<ci id="CIcoeff_1" coeff="-0.1" alpha="01" beta="10"/>
+</detlist></multideterminant></determinantset>
+</wavefunction>
+<wavefunction name="psi1">
+<determinantset><multideterminant optimize="no" spo_up="spo-up" spo_dn="spo-dn">
+<detlist size="2" type="DETS" nca="0" ncb="0" nea="1" neb="1" nstates="2" cutoff="1e-2">
+<ci id="CIcoeff_0" coeff="0.8" alpha="10" beta="10"/>
+<ci id="CIcoeff_1" coeff="0.2" alpha="10" beta="01"/>
+<ci id="CIcoeff_2" coeff="0.1" alpha="01" beta="01"/>
+</detlist></multideterminant></determinantset>
+</wavefunction>
+</qmcsystem>
+"""
+
+
+@pytest.mark.parametrize("chunk_size", [16, 1 << 20])
+def test_two_detlists(tmp_path, chunk_size):
+    """
+    The coefficients of a second detlist are appended to those of the first
+    one, whatever the sizes given in the files.
+    """
+    filename = tmp_path / "two.wfs.xml"
+    filename.write_text(WAVEFUNCTION)
+    coeffs, cutoff, alpha, beta = read_coefficients(
+        str(filename), strings=True, chunk_size=chunk_size
+    )
+    numpy.testing.assert_allclose(coeffs, [0.9, -0.1, 0.8, 0.2, 0.1])
+    assert cutoff == pytest.approx(1e-3)
+    assert alpha == ["10", "01", "10", "10", "01"]
+    assert beta == ["10", "10", "10", "01", "01"]
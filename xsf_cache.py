@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Cache of parsed xsf densities: the grid is stored as a .npy file that later
+runs open through numpy.memmap instead of parsing the text file again, next
+to a small json file with the cell, atoms, nind and start_coord.
+Entries are keyed by the content hash of the xsf file, found from its path,
+size and modification time when these did not change; the total size of the
+cache is bounded, evicting the least recently used entries. Runs sharing
+a cache directory merge their changes into index.json under a file lock.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import contextlib
+from typing import Tuple, List, Dict, Any, Iterator, Optional
+import numpy
+import numpy.typing as npt
+from shift_density import Atoms, read_data
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 10 * 1024**3
+HASH_CHUNK = 1 << 22
+
+
+def file_hash(filein: str) -> str:
+    """
+    Returns the blake2b hash of the content of filein
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filein, "rb") as file_in:
+        for chunk in iter(lambda: file_in.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class XsfCache:
+    """
+    Defines a cache of parsed xsf files; its members are
+    cache_dir: str, the directory holding the cache entries and index.json
+    max_bytes: int, the maximum total size of the cached grids
+    index: dict, the known files, the cache entries and the hit/miss counters
+    saved: dict, the hit/miss counters when the index was last read or saved
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._read_index()
+        self.saved = {"hits": self.index["hits"], "misses": self.index["misses"]}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def _read_index(self) -> Dict[str, Any]:
+        index: Dict[str, Any] = {"files": {}, "entries": {}, "hits": 0, "misses": 0}
+        index_file = self._path("index.json")
+        if os.path.exists(index_file):
+            with open(index_file, "r", encoding="utf-8") as file_in:
+                index.update(json.load(file_in))
+        return index
+
+    @contextlib.contextmanager
+    def _lock(self) -> Iterator[None]:
+        """
+        Holds an exclusive lock on the cache directory (none where fcntl is
+        not available).
+        """
+        with open(self._path("index.lock"), "a", encoding="utf-8") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _merge(self, index: Dict[str, Any]) -> None:
+        """
+        Merges the changes of this run into index, as read from disk: the
+        files and entries of both are kept (the latest use of an entry, and
+        only the entries whose grid was not evicted), and the hits and misses
+        of this run are added to the counters.
+        """
+        index["files"].update(self.index["files"])
+        entries = index["entries"]
+        for key, entry in self.index["entries"].items():
+            if key in entries:
+                entry["last_used"] = max(entry["last_used"], entries[key]["last_used"])
+            entries[key] = entry
+        for key in list(entries):
+            if not os.path.exists(self._path(key + ".npy")):
+                del entries[key]
+        for counter in ("hits", "misses"):
+            index[counter] += self.index[counter] - self.saved[counter]
+            self.saved[counter] = index[counter]
+        self.index = index
+
+    def _save_index(self, keep: str = "") -> None:
+        """
+        Merges the index with the one on disk, evicts the least recently used
+        entries (except keep) and writes it back, with the directory locked so
+        that concurrent runs do not lose each other's entries.
+        """
+        with self._lock():
+            self._merge(self._read_index())
+            self.evict(keep)
+            temp = self._path(f"index.json.{os.getpid()}")
+            with open(temp, "w", encoding="utf-8") as file_out:
+                json.dump(self.index, file_out, indent=1)
+            os.replace(temp, self._path("index.json"))
+
+    def key(self, filein: str) -> str:
+        """
+        Returns the cache key of filein, hashing its content only when its
+        size or modification time changed since the last time it was seen.
+        """
+        path = os.path.abspath(filein)
+        stat = os.stat(path)
+        known = self.index["files"].get(path)
+        if (
+            known
+            and known["size"] == stat.st_size
+            and known["mtime"] == stat.st_mtime_ns
+        ):
+            return known["hash"]
+        key = file_hash(path)
+        self.index["files"][path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": key,
+        }
+        return key
+
+    def load(
+        self, filein: str, grid: Optional[str] = None
+    ) -> Tuple[npt.NDArray, Atoms, npt.NDArray, npt.NDArray, npt.NDArray]:
+        """
+        Returns the same data as read_data, with the grid memory-mapped from
+        the cache (read only); on a miss the file is parsed and stored.
+        Each grid of a file has its own entry.
+        """
+        key = self.key(filein)
+        if grid is not None:
+            key += "-" + hashlib.blake2b(grid.encode(), digest_size=4).hexdigest()
+        entry = self.index["entries"].get(key)
+        if entry and os.path.exists(self._path(key + ".npy")):
+            self.index["hits"] += 1
+            print(f"Cache hit for {filein} ({key})")
+            with open(self._path(key + ".json"), "r", encoding="utf-8") as file_in:
+                meta = json.load(file_in)
+            values = numpy.load(self._path(key + ".npy"), mmap_mode="r")
+            cell = numpy.array(meta["cell"])
+            atoms = Atoms(meta["nat"], meta["at_types"], numpy.array(meta["at_coord"]))
+            nind = numpy.array(meta["nind"])
+            start_coord = numpy.array(meta["start_coord"])
+            entry["last_used"] = time.time()
+            self._save_index(keep=key)
+        else:
+            self.index["misses"] += 1
+            print(f"Cache miss for {filein} ({key})")
+            cell, atoms, nind, start_coord, values = read_data(filein, grid=grid)
+            self.store(key, cell, atoms, nind, start_coord, values)
+        return cell, atoms, nind, start_coord, values
+
+    def store(
+        self,
+        key: str,
+        cell: npt.NDArray,
+        atoms: Atoms,
+        nind: npt.NDArray,
+        start_coord: npt.NDArray,
+        values: npt.NDArray,
+    ) -> None:
+        """
+        Writes a cache entry and saves the index, evicting the least recently
+        used entries if the cache grew beyond max_bytes.
+        """
+        meta = {
+            "cell": cell.tolist(),
+            "nat": atoms.nat,
+            "at_types": [str(at_type) for at_type in atoms.at_types],
+            "at_coord": numpy.asarray(atoms.at_coord).tolist(),
+            "nind": [int(n) for n in nind],
+            "start_coord": start_coord.tolist(),
+        }
+        with open(self._path(key + ".json"), "w", encoding="utf-8") as file_out:
+            json.dump(meta, file_out)
+        temp = self._path(f"{key}.{os.getpid()}.npy")
+        numpy.save(temp, values)
+        os.replace(temp, self._path(key + ".npy"))
+        self.index["entries"][key] = {"bytes": values.nbytes, "last_used": time.time()}
+        self._save_index(keep=key)
+
+    def evict(self, keep: str = "") -> List[str]:
+        """
+        Removes the least recently used entries (except keep) until the
+        cache fits in max_bytes; returns the removed keys. Grids left in the
+        directory without an entry (e.g. by an interrupted run) count towards
+        the size, last used when they were written. Called by _save_index,
+        with the directory locked.
+        """
+        entries = self.index["entries"]
+        sizes = {key: entry["bytes"] for key, entry in entries.items()}
+        used = {key: entry["last_used"] for key, entry in entries.items()}
+        for name in os.listdir(self.cache_dir):
+            key = name[: -len(".npy")]
+            # key.<pid>.npy files are being written by other runs
+            if name.endswith(".npy") and "." not in key and key not in entries:
+                stat = os.stat(self._path(name))
+                sizes[key], used[key] = stat.st_size, stat.st_mtime
+        total = sum(sizes.values())
+        removed = []
+        for key in sorted(sizes, key=used.__getitem__):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= sizes[key]
+            for suffix in (".npy", ".json"):
+                if os.path.exists(self._path(key + suffix)):
+                    os.remove(self._path(key + suffix))
+            entries.pop(key, None)
+            removed.append(key)
+        if removed:
+            print(f"Evicted {len(removed)} cache entries")
+        return removed
+
+
+def main() -> None:
+    """
+    Prints the hit/miss counters and the entries of the cache given as an argument.
+    """
+    if len(sys.argv) < 2:
+        print("Usage: xsf_cache.py <cache directory>")
+        return
+    cache = XsfCache(sys.argv[1])
+    entries = cache.index["entries"]
+    total = sum(entry["bytes"] for entry in entries.values())
+    print(f"Hits: {cache.index['hits']}  Misses: {cache.index['misses']}")
+    print(f"{len(entries)} entries, {total / 1e6:.1f} MB")
+    for path, known in cache.index["files"].items():
+        # one entry per grid, keyed by the file hash and a hash of the grid name
+        grids = [key for key in entries if key.startswith(known["hash"])]
+        if grids:
+            size = sum(entries[key]["bytes"] for key in grids)
+            print(
+                f"  {known['hash']}  {path}  ({len(grids)} grids, {size / 1e6:.1f} MB)"
+            )
+
+
+if __name__ == "__main__":
+    main()